@@ -0,0 +1,8 @@
+"""Runs maintenance commands for the ublog database."""
+
+# Application
+from ublog import maintenance
+
+
+if __name__ == '__main__':
+  maintenance.main()
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+"""Tests for the cache invalidation of the admin pages."""
+
+# Standard modules
+import unittest
+from unittest import mock
+
+# Application components
+from ublog import batch
+from ublog import cache
+from ublog import pages
+
+
+class SidebarTest(unittest.TestCase):
+  """Tests that admin writes drop the sidebar datasets they change."""
+
+  def setUp(self):
+    self.pagemaker = pages.PageMaker.__new__(pages.PageMaker)
+    self.loads = []
+    self.batches = 0
+    patcher = mock.patch.object(pages.PageMaker, '_RunBatch', self._RunBatch)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    patcher = mock.patch.object(pages.PageMaker, '_QueryBatch',
+                                lambda pagemaker: batch.QueryBatch(None))
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    cache.SIDEBAR.backend.Clear()
+    self.addCleanup(cache.SIDEBAR.backend.Clear)
+
+  def _RunBatch(self, querybatch):
+    """Answers the sidebar queries of a batch with numbered datasets."""
+    self.batches += 1
+    results = {}
+    for key, _name, _params in querybatch.queries:
+      self.loads.append(key[1])
+      results[key] = [{'name': '%s%d' % (key[1], len(self.loads))}]
+    querybatch.queries = []
+    return results
+
+  def _LoadAll(self):
+    return dict((block, self.pagemaker._Sidebar(block))
+                for block in cache.SIDEBAR_BLOCKS)
+
+  def testCached(self):
+    """The datasets are read from the database once."""
+    first = self._LoadAll()
+    self.assertEqual(self._LoadAll(), first)
+    self.assertEqual(sorted(self.loads), sorted(cache.SIDEBAR_BLOCKS))
+
+  def testMenusInOneBatch(self):
+    """The missing sidebar menus are loaded together."""
+    self.pagemaker._SidebarMenus()
+    self.assertEqual(self.batches, 1)
+    self.assertEqual(sorted(self.loads), sorted(pages.SIDEBAR_MENUS))
+    self.pagemaker._SidebarMenus()
+    self.assertEqual(self.batches, 1)
+
+  def testInvalidateBlock(self):
+    """A write drops the named dataset only."""
+    first = self._LoadAll()
+    self.pagemaker._InvalidateSidebar('authors')
+    second = self._LoadAll()
+    self.assertNotEqual(second['authors'], first['authors'])
+    for block in cache.SIDEBAR_BLOCKS:
+      if block != 'authors':
+        self.assertEqual(second[block], first[block])
+    self.assertEqual(len(self.loads), len(cache.SIDEBAR_BLOCKS) + 1)
+
+  def testInvalidateAll(self):
+    """Without names every dataset is dropped."""
+    first = self._LoadAll()
+    self.pagemaker._InvalidateSidebar()
+    second = self._LoadAll()
+    for block in cache.SIDEBAR_BLOCKS:
+      self.assertNotEqual(second[block], first[block])
+    self.assertEqual(len(self.loads), 2 * len(cache.SIDEBAR_BLOCKS))
+
+  def testTagWrite(self):
+    """Tag writes drop the full cloud and its top in the menu."""
+    first = self._LoadAll()
+    self.pagemaker._InvalidateSidebar('tagcloud', 'toptags')
+    second = self._LoadAll()
+    self.assertNotEqual(second['toptags'], first['toptags'])
+    self.assertNotEqual(second['tagcloud'], first['tagcloud'])
+    self.assertEqual(second['authors'], first['authors'])
+
+
+class CountsTest(unittest.TestCase):
+  """Tests that admin writes drop the cached article totals."""
+
+  def testInvalidateCounts(self):
+    pagemaker = pages.PageMaker.__new__(pages.PageMaker)
+    for public in (True, False):
+      cache.COUNTS.Get(('articles', public), lambda: 10)
+    pagemaker._InvalidateCounts()
+    for public in (True, False):
+      self.assertEqual(cache.COUNTS.Get(('articles', public), lambda: 11), 11)
+
+
+class PurgePagesTest(unittest.TestCase):
+  """Tests that admin writes purge the cached pages they change."""
+
+  ARTICLE = {'ID': 12, 'date': '2020-04-30 10:14:46', 'user': 3}
+
+  def setUp(self):
+    cache.PAGES.backend.Clear()
+    self.addCleanup(cache.PAGES.backend.Clear)
+    self.pagemaker = pages.PageMaker.__new__(pages.PageMaker)
+
+  def _Store(self, key, generation=None):
+    cache.PAGES.Set(self.pagemaker._PageKey(key, generation), 'page')
+
+  def _Cached(self, key, generation=None):
+    return cache.PAGES.Peek(
+        self.pagemaker._PageKey(key, generation)) is not None
+
+  def testArticlePages(self):
+    """The pages that show the article are purged, others are kept."""
+    purged = [(('Article', (12,)), None),
+              (('ArticlesByDate', (2020, 4, 2)), ('ArticlesByDate', 2020, 4)),
+              (('ArticlesByDate', (2020, None, 1)),
+               ('ArticlesByDate', 2020, None)),
+              (('ArticlesByUser', (3, 1)), ('ArticlesByUser', 3)),
+              (('ArticlesByTag', ('python', 1)), ('ArticlesByTag', 'python'))]
+    kept = [(('Article', (13,)), None),
+            (('ArticlesByDate', (2020, 5, 1)), ('ArticlesByDate', 2020, 5)),
+            (('ArticlesByTag', ('rust', 1)), ('ArticlesByTag', 'rust'))]
+    for key, generation in purged + kept:
+      self._Store(key, generation)
+    self.pagemaker._PurgePages(self.ARTICLE, ['python'])
+    for key, generation in purged:
+      self.assertFalse(self._Cached(key, generation), key)
+    for key, generation in kept:
+      self.assertTrue(self._Cached(key, generation), key)
+
+  def testAllPages(self):
+    """The all* pages are cached under their own names, and purged."""
+    keys = []
+    with mock.patch.object(pages.PageMaker, '_CachedPage',
+                           lambda pagemaker, key, generation, render:
+                           keys.append(key)):
+      for name in ('alltags', 'allauthors', 'allmonths'):
+        getattr(self.pagemaker, name)()
+    self.assertEqual(keys, [('alltags', ()), ('allauthors', ()),
+                            ('allmonths', ())])
+    for key in keys:
+      self._Store(key)
+    self.pagemaker._PurgePages(self.ARTICLE)
+    for key in keys:
+      self.assertFalse(self._Cached(key), key)
+
+  def testIndex(self):
+    """Every page of the index is purged."""
+    for page in range(1, 4):
+      self._Store(('Index', (page, None)), 'index')
+    self.pagemaker._PurgePages(self.ARTICLE)
+    for page in range(1, 4):
+      self.assertFalse(self._Cached(('Index', (page, None)), 'index'))
+
+  def testPurgeAll(self):
+    """Writes that touch many articles purge every page."""
+    self._Store(('Article', (12,)))
+    self._Store(('Index', (1, None)), 'index')
+    self.pagemaker._PurgeAllPages()
+    self.assertFalse(self._Cached(('Article', (12,))))
+    self.assertFalse(self._Cached(('Index', (1, None)), 'index'))
+
+
+if __name__ == '__main__':
+  unittest.main()
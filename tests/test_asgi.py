@@ -0,0 +1,170 @@
+#!/usr/bin/python
+"""Tests for the async presenters and routing of ublog.asgi."""
+
+# Standard modules
+import asyncio
+import datetime
+import re
+import unittest
+from unittest import mock
+
+# Application components
+from ublog import ROUTES
+from ublog import asgi
+from ublog import cache
+from ublog import rendering
+
+BLOG = {'name': 'ublog', 'title': 'Title', 'subtitle': 'Sub', 'url': '/'}
+
+
+class FakeParser(object):
+  """Renders a template as its name and the xsrf token it was given."""
+
+  def Parse(self, template, **kwds):
+    return '%s %s' % (template, kwds.get('xsrftoken'))
+
+  def ParseStatic(self, template, key, **kwds):
+    return self.Parse(template, **kwds)
+
+  def ParseFragment(self, template, key, **kwds):
+    return self.Parse(template, **kwds)
+
+
+class FakeApp(object):
+  """The parts of asgi.Application an AsyncPageMaker uses."""
+
+  def __init__(self):
+    self.config = {'blog': BLOG}
+    self.parser = FakeParser()
+
+
+class AsyncPageMakerTest(unittest.TestCase):
+  """Tests the async presenters against canned query results."""
+
+  def setUp(self):
+    for store in (cache.SIDEBAR, cache.COUNTS, cache.PAGES, cache.RENDERED):
+      store.backend.Clear()
+      self.addCleanup(store.backend.Clear)
+    patcher = mock.patch.object(rendering, 'Creole',
+                                side_effect=lambda text: '<p>%s</p>' % text)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.rows = {}
+    self.fetched = []
+
+  def _PageMaker(self, xsrf='token', query=b''):
+    pagemaker = asgi.AsyncPageMaker(FakeApp(), {'query_string': query},
+                                    {'xsrf': xsrf})
+
+    async def fetch(name, **params):
+      self.fetched.append((name, params))
+      return [dict(row) for row in self.rows.get(name, [])]
+    pagemaker._Fetch = fetch
+    return pagemaker
+
+  def _Article(self, number):
+    return {'ID': number, 'title': 'Title', 'titlehtml': '<p>Title</p>',
+            'excerpt': 'cut %d' % number,
+            'author': 'Elmer', 'user': 3, 'comments': 0,
+            'date': datetime.datetime(2020, 4, 30, 10, 14, 46),
+            'lastchange': '2020-04-30 10:14:46'}
+
+  def testGetBefore(self):
+    """The keyset ID is read from the query string, if it is a number."""
+    self.assertEqual(self._PageMaker(query=b'before=20')._GetBefore(), 20)
+    self.assertIsNone(self._PageMaker(query=b'before=x')._GetBefore())
+    self.assertIsNone(self._PageMaker()._GetBefore())
+
+  def testListingArticles(self):
+    """Listing rows are shaped like model.Article, with an excerpt."""
+    article, = asgi.AsyncPageMaker._ListingArticles([self._Article(12)])
+    self.assertEqual(article['date'], '2020-04-30 10:14:46')
+    self.assertEqual(article['user'], {'ID': 3, 'author': 'Elmer'})
+    self.assertEqual(article['excerpt'], 'cut 12')
+    self.assertEqual(article['titlehtml'], '<p>Title</p>')
+
+  def testStoreRendered(self):
+    """Rows without a stored excerpt or title get them rendered and stored."""
+    self.rows = {'article_content': [{'content': 'body'}]}
+    rows = [self._Article(3), dict(self._Article(2), titlehtml=None),
+            dict(self._Article(1), excerpt=None)]
+    asyncio.run(self._PageMaker()._StoreRendered(rows))
+    self.assertEqual([row['excerpt'] for row in rows],
+                     ['cut 3', 'cut 2', '<p>body</p>'])
+    self.assertEqual(rows[1]['titlehtml'], '<p>Title</p>')
+    self.assertEqual(self.fetched, [
+        ('article_setrendered', {'article': 2, 'excerpt': 'cut 2',
+                                 'titlehtml': '<p>Title</p>'}),
+        ('article_content', {'article': 1}),
+        ('article_setrendered', {'article': 1, 'excerpt': '<p>body</p>',
+                                 'titlehtml': '<p>Title</p>'})])
+
+  def testIndexCached(self):
+    """The index is read once, and every visitor gets their own token."""
+    self.rows = {'article_count': [{'count': 2}],
+                 'article_lastn': [self._Article(2), self._Article(1)]}
+    first = asyncio.run(self._PageMaker('first').Index())
+    second = asyncio.run(self._PageMaker('second').Index())
+    self.assertEqual(first.content, 'index.html first')
+    self.assertEqual(second.content, 'index.html second')
+    names = [name for name, _params in self.fetched]
+    self.assertEqual(names.count('article_lastn'), 1)
+    self.assertEqual(names.count('article_count'), 1)
+
+  def testIndexKeyset(self):
+    """With a keyset ID the page starts below it rather than at an offset."""
+    self.rows = {'article_count': [{'count': 30}]}
+    asyncio.run(self._PageMaker(query=b'before=20').Index('2'))
+    params = dict(self.fetched)['article_lastn']
+    self.assertEqual(params, {'public': 'true', 'before': 20, 'count': 10,
+                              'offset': 0})
+
+  def testArticleMissing(self):
+    """A missing article redirects to the index and is not cached."""
+    response = asyncio.run(self._PageMaker().Article('12', 'title'))
+    self.assertEqual(response.httpcode, 303)
+    self.assertEqual(response.headers, {'Location': '/'})
+    asyncio.run(self._PageMaker().Article('12', 'title'))
+    names = [name for name, _params in self.fetched]
+    self.assertEqual(names.count('article_byid'), 2)
+
+
+class ApplicationTest(unittest.TestCase):
+  """Tests the routing and WSGI fallback environment of Application."""
+
+  def setUp(self):
+    self.app = asgi.Application.__new__(asgi.Application)
+    self.app.routes = [(re.compile('^%s$' % pattern), name)
+                       for pattern, name in ROUTES]
+
+  def testRoute(self):
+    """Paths of async presenters are routed, with their arguments."""
+    self.assertEqual(self.app._Route('/'), ('Index', []))
+    self.assertEqual(self.app._Route('/article/12/title'),
+                     ('Article', ['12', 'title']))
+    self.assertEqual(self.app._Route('/articles/2020/4'),
+                     ('ArticlesByDate', ['2020', '4']))
+
+  def testRouteFallback(self):
+    """Paths of other presenters, and unknown paths, are not routed."""
+    for path in ('/login', '/admin/users', '/no/such/page'):
+      self.assertEqual(self.app._Route(path), (None, ()))
+
+  def testEnviron(self):
+    """Headers, the query string and the body end up in the environment."""
+    scope = {'method': 'POST', 'path': '/addcomment',
+             'query_string': b'a=1', 'client': ('10.0.0.1', 4000),
+             'headers': [(b'content-type', b'text/plain'),
+                         (b'cookie', b'a=1'), (b'cookie', b'b=2')]}
+    environ = asgi.Application._Environ(scope, b'body')
+    self.assertEqual(environ['REQUEST_METHOD'], 'POST')
+    self.assertEqual(environ['PATH_INFO'], '/addcomment')
+    self.assertEqual(environ['QUERY_STRING'], 'a=1')
+    self.assertEqual(environ['REMOTE_ADDR'], '10.0.0.1')
+    self.assertEqual(environ['CONTENT_TYPE'], 'text/plain')
+    self.assertEqual(environ['HTTP_COOKIE'], 'a=1,b=2')
+    self.assertEqual(environ['wsgi.input'].read(), b'body')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+"""Tests for the parallel query batches in ublog.batch."""
+
+# Standard modules
+import threading
+import unittest
+from unittest import mock
+
+# Application components
+from ublog import batch
+from ublog import pool
+from ublog import queries
+
+QUERIES = {'rows': 'select %(count)s rows',
+           'wait': 'wait %(label)s',
+           'fail': 'fail'}
+
+
+class FakeConnection(object):
+  """A sqltalk connection whose cursor answers the QUERIES above."""
+
+  def __init__(self, fakepool):
+    self.pool = fakepool
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    return False
+
+  def EscapeValues(self, value):
+    return str(value)
+
+  def Execute(self, statement):
+    self.pool.threads.append(threading.current_thread())
+    self.pool.statements.append(statement)
+    if statement.startswith('wait'):
+      self.pool.barrier.wait()
+    if statement == 'fail':
+      raise ValueError('failed')
+    count = int(statement.split()[1]) if statement.startswith('select') else 1
+    return [{'row': row} for row in range(count)]
+
+
+class FakePool(object):
+  """Hands out a new FakeConnection for every query, unless exhausted."""
+
+  def __init__(self, size=4):
+    self.size = size
+    self.exhausted = False
+    self.checkedout = 0
+    self.threads = []
+    self.statements = []
+    self.barrier = threading.Barrier(2, timeout=5)
+
+  def Checkout(self, timeout=None):
+    if self.exhausted:
+      raise pool.PoolExhaustedError('No connection available')
+    self.checkedout += 1
+    return FakeConnection(self)
+
+  def Checkin(self, connection):
+    self.checkedout -= 1
+
+
+class QueryBatchTest(unittest.TestCase):
+  """Tests that QueryBatch runs its queries together and collects them."""
+
+  def setUp(self):
+    patcher = mock.patch.dict(queries.QUERIES, QUERIES)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.pool = FakePool()
+
+  def testSingleInline(self):
+    """A single query runs in the calling thread."""
+    querybatch = batch.QueryBatch(self.pool)
+    querybatch.Add('key', 'rows', count=2)
+    self.assertEqual(querybatch.Run(), {'key': [{'row': 0}, {'row': 1}]})
+    self.assertEqual(self.pool.threads, [threading.current_thread()])
+    self.assertEqual(self.pool.statements, ['select 2 rows'])
+
+  def testParallel(self):
+    """Queries of one batch run at the same time, on other threads."""
+    querybatch = batch.QueryBatch(self.pool)
+    querybatch.Add('first', 'wait', label='first')
+    querybatch.Add('second', 'wait', label='second')
+    results = querybatch.Run()
+    self.assertEqual(results, {'first': [{'row': 0}], 'second': [{'row': 0}]})
+    self.assertNotIn(threading.current_thread(), self.pool.threads)
+    self.assertEqual(querybatch.queries, [])
+
+  def testTimings(self):
+    """Every query reports its key, name, rows and duration."""
+    querybatch = batch.QueryBatch(self.pool)
+    querybatch.Add('one', 'rows', count=1)
+    querybatch.Add('three', 'rows', count=3)
+    querybatch.Run()
+    self.assertEqual([(timing['key'], timing['query'], timing['rows'])
+                      for timing in querybatch.timings],
+                     [('one', 'rows', 1), ('three', 'rows', 3)])
+    for timing in querybatch.timings:
+      self.assertGreaterEqual(timing['seconds'], 0)
+
+  def testErrorAfterAll(self):
+    """An error is raised once every query of the batch has finished."""
+    querybatch = batch.QueryBatch(self.pool)
+    querybatch.Add('fail', 'fail')
+    querybatch.Add('rows', 'rows', count=1)
+    with self.assertRaises(ValueError):
+      querybatch.Run()
+    self.assertEqual(sorted(self.pool.statements), ['fail', 'select 1 rows'])
+    self.assertEqual(self.pool.checkedout, 0)
+
+  def testOwnConnection(self):
+    """A single query runs on the batch's own connection, if it has one."""
+    querybatch = batch.QueryBatch(self.pool, FakeConnection(self.pool))
+    querybatch.Add('key', 'rows', count=1)
+    self.pool.exhausted = True
+    self.assertEqual(querybatch.Run(), {'key': [{'row': 0}]})
+
+  def testExhausted(self):
+    """With the pool exhausted the queries run on the batch's connection."""
+    querybatch = batch.QueryBatch(self.pool, FakeConnection(self.pool))
+    querybatch.Add('one', 'rows', count=1)
+    querybatch.Add('two', 'rows', count=2)
+    self.pool.exhausted = True
+    results = querybatch.Run()
+    self.assertEqual([len(results['one']), len(results['two'])], [1, 2])
+
+  def testExhaustedWithoutConnection(self):
+    """Without a connection of its own the batch fails on an empty pool."""
+    querybatch = batch.QueryBatch(self.pool)
+    querybatch.Add('one', 'rows', count=1)
+    querybatch.Add('two', 'rows', count=2)
+    self.pool.exhausted = True
+    with self.assertRaises(pool.PoolExhaustedError):
+      querybatch.Run()
+
+
+class ExecutorTest(unittest.TestCase):
+  """Tests the shared thread pool the batches run on."""
+
+  def testGrow(self):
+    """A larger size replaces the pool and shuts the old one down."""
+    patcher = mock.patch.object(batch, '_executor', None)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    small = batch._Executor(2)
+    self.addCleanup(small.shutdown)
+    self.assertIs(batch._Executor(1), small)
+    large = batch._Executor(4)
+    self.addCleanup(large.shutdown)
+    self.assertIsNot(large, small)
+    with self.assertRaises(RuntimeError):
+      small.submit(int)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+"""Tests for the in-process storage of ublog.cache."""
+
+# Standard modules
+import asyncio
+import unittest
+from unittest import mock
+
+# Application components
+from ublog import cache
+
+
+class MemoryBackendTest(unittest.TestCase):
+  """Tests the least recently used eviction of MemoryBackend."""
+
+  def testUnbounded(self):
+    """Without a maxsize nothing is evicted."""
+    backend = cache.MemoryBackend()
+    for number in range(100):
+      backend.Set(number, number)
+    self.assertEqual(backend.Get(0), 0)
+    self.assertEqual(backend.Get(99), 99)
+
+  def testMissingKey(self):
+    """A key that was never stored raises KeyError."""
+    with self.assertRaises(KeyError):
+      cache.MemoryBackend(2).Get('missing')
+
+  def testEvictsOldest(self):
+    """Storing beyond maxsize drops the least recently stored value."""
+    backend = cache.MemoryBackend(2)
+    backend.Set('a', 1)
+    backend.Set('b', 2)
+    backend.Set('c', 3)
+    with self.assertRaises(KeyError):
+      backend.Get('a')
+    self.assertEqual(backend.Get('b'), 2)
+    self.assertEqual(backend.Get('c'), 3)
+
+  def testGetRefreshes(self):
+    """Reading a value makes it the most recently used one."""
+    backend = cache.MemoryBackend(2)
+    backend.Set('a', 1)
+    backend.Set('b', 2)
+    backend.Get('a')
+    backend.Set('c', 3)
+    self.assertEqual(backend.Get('a'), 1)
+    with self.assertRaises(KeyError):
+      backend.Get('b')
+
+  def testSetRefreshes(self):
+    """Overwriting a value makes it the most recently used one."""
+    backend = cache.MemoryBackend(2)
+    backend.Set('a', 1)
+    backend.Set('b', 2)
+    backend.Set('a', 10)
+    backend.Set('c', 3)
+    self.assertEqual(backend.Get('a'), 10)
+    with self.assertRaises(KeyError):
+      backend.Get('b')
+
+  def testDeleteAndClear(self):
+    """Deleting ignores missing keys, clearing drops everything."""
+    backend = cache.MemoryBackend(2)
+    backend.Set('a', 1)
+    backend.Set('b', 2)
+    backend.Delete(['a', 'missing'])
+    with self.assertRaises(KeyError):
+      backend.Get('a')
+    backend.Clear()
+    with self.assertRaises(KeyError):
+      backend.Get('b')
+
+  def testMaxAge(self):
+    """Values are dropped once they are older than max_age."""
+    backend = cache.MemoryBackend(max_age=60)
+    with mock.patch.object(cache.time, 'monotonic', return_value=1000):
+      backend.Set('a', 1)
+    with mock.patch.object(cache.time, 'monotonic', return_value=1059):
+      self.assertEqual(backend.Get('a'), 1)
+    with mock.patch.object(cache.time, 'monotonic', return_value=1060):
+      with self.assertRaises(KeyError):
+        backend.Get('a')
+
+
+class CacheTest(unittest.TestCase):
+  """Tests the loading and counters of Cache."""
+
+  def testLoadsOnce(self):
+    """The loader runs on a miss only."""
+    store = cache.Cache('test')
+    loads = []
+    for _attempt in range(3):
+      self.assertEqual(store.Get('key', lambda: loads.append(1) or 'value'),
+                       'value')
+    self.assertEqual(len(loads), 1)
+    stats = store.Stats()
+    self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+  def testInvalidate(self):
+    """An invalidated key is loaded again."""
+    store = cache.Cache('test')
+    store.Get('key', lambda: 'old')
+    store.Invalidate('key')
+    self.assertEqual(store.Get('key', lambda: 'new'), 'new')
+    self.assertEqual(store.Stats()['invalidations'], 1)
+
+  def testInvalidateOthersKept(self):
+    """Invalidating one key leaves the others cached."""
+    store = cache.Cache('test')
+    store.Get('first', lambda: 'first')
+    store.Get('second', lambda: 'second')
+    store.Invalidate('first')
+    self.assertEqual(store.Get('second', lambda: 'reloaded'), 'second')
+
+  def testNamesSeparateKeys(self):
+    """Caches on a shared backend do not see each other's keys."""
+    backend = cache.MemoryBackend()
+    first = cache.Cache('first', backend=backend)
+    second = cache.Cache('second', backend=backend)
+    first.Get('key', lambda: 1)
+    self.assertEqual(second.Get('key', lambda: 2), 2)
+    self.assertEqual(first.Get('key', lambda: 3), 1)
+
+  def testAsyncGet(self):
+    """AsyncGet awaits the loader on a miss and shares Get's entries."""
+    store = cache.Cache('test')
+    loads = []
+
+    async def loader():
+      loads.append(1)
+      return 'value'
+
+    self.assertEqual(asyncio.run(store.AsyncGet('key', loader)), 'value')
+    self.assertEqual(asyncio.run(store.AsyncGet('key', loader)), 'value')
+    self.assertEqual(store.Get('key', lambda: 'other'), 'value')
+    self.assertEqual(len(loads), 1)
+    stats = store.Stats()
+    self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+
+class GenerationTest(unittest.TestCase):
+  """Tests the generation tokens that drop whole namespaces."""
+
+  def setUp(self):
+    self.store = cache.Cache('test')
+
+  def testStable(self):
+    """A namespace keeps its token until a new generation starts."""
+    self.assertEqual(self.store.Generation('pages'),
+                     self.store.Generation('pages'))
+
+  def testNewGeneration(self):
+    """A new generation changes the token of that namespace only."""
+    pages = self.store.Generation('pages')
+    index = self.store.Generation('index')
+    self.store.NewGeneration('pages')
+    self.assertNotEqual(self.store.Generation('pages'), pages)
+    self.assertEqual(self.store.Generation('index'), index)
+    self.assertEqual(self.store.Stats()['invalidations'], 1)
+
+  def testOldKeysUnreachable(self):
+    """Values stored under an old token are no longer found."""
+    key = self.store.Generation('pages'), 'page'
+    self.store.Set(key, 'old')
+    self.store.NewGeneration('pages')
+    self.assertIsNone(self.store.Peek((self.store.Generation('pages'),
+                                       'page')))
+
+  def testTupleNamespace(self):
+    """Namespaces may be tuples, such as a listing and its arguments."""
+    first = self.store.Generation(('ArticlesByTag', 'python'))
+    other = self.store.Generation(('ArticlesByTag', 'mysql'))
+    self.store.NewGeneration(('ArticlesByTag', 'python'))
+    self.assertNotEqual(
+        self.store.Generation(('ArticlesByTag', 'python')), first)
+    self.assertEqual(self.store.Generation(('ArticlesByTag', 'mysql')), other)
+
+
+class ConfigureTest(unittest.TestCase):
+  """Tests the backends Configure gives the caches."""
+
+  def testMaxAge(self):
+    """The memory backends of all caches get the configured max_age."""
+    self.addCleanup(cache.Configure, {})
+    patcher = mock.patch.object(cache.PAGES, 'maxsize', cache.PAGES.maxsize)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    cache.Configure({'max_age': '30', 'pages_size': '20'})
+    for store in cache.CACHES:
+      self.assertIsInstance(store.backend, cache.MemoryBackend)
+      self.assertEqual(store.backend.max_age, 30)
+    self.assertEqual(cache.PAGES.backend.maxsize, 20)
+    cache.Configure({'max_age': '0'})
+    self.assertIsNone(cache.PAGES.backend.max_age)
+
+
+if __name__ == '__main__':
+  unittest.main()
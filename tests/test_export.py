@@ -0,0 +1,190 @@
+#!/usr/bin/python
+"""Tests for the incremental static export in ublog.export."""
+
+# Standard modules
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# Application components
+from ublog import export
+
+
+def Article(number, **changes):
+  """Returns an export_articles row for article number."""
+  article = {'ID': number, 'title': 'Title %d' % number, 'user': 3,
+             'author': 'Elmer', 'date': datetime.datetime(2020, 4, number),
+             'lastchange': '2020-04-%02d 10:00:00' % number,
+             'comments': 0, 'lastcomment': None}
+  article.update(changes)
+  return article
+
+
+def FakeSite(articles, tags=None):
+  """Returns an export.Site for the given rows, without the database."""
+  site = export.Site.__new__(export.Site)
+  site.articles = articles
+  site.tags = tags or {}
+  site.sidebars = {'tagcloud': [], 'toptags': [], 'authors': [],
+                   'activemonths': []}
+  site.config = {}
+  site._Common = lambda: 'common'
+  return site
+
+
+class PathTest(unittest.TestCase):
+  """Tests the names of the exported files."""
+
+  def testFileName(self):
+    self.assertEqual(export.FileName('/'), 'index.html')
+    self.assertEqual(export.FileName('/article/12/Title'),
+                     'article/12/Title.html')
+
+  def testSlug(self):
+    """Slashes are filtered as in the templates, spaces become +."""
+    self.assertEqual(export._Slug('a/b c'), 'a&-#b+c')
+
+
+class SiteTest(unittest.TestCase):
+  """Tests the pages of the site and the data their digests cover."""
+
+  def setUp(self):
+    self.articles = [Article(number) for number in range(12, 0, -1)]
+    self.tags = {12: ['python'], 1: ['rust']}
+
+  def _Pages(self, articles=None):
+    return FakeSite(articles or self.articles, self.tags).Pages()
+
+  def testPaths(self):
+    """Every listing, article and all* page of the public site is listed."""
+    pages = self._Pages()
+    for path in ('/', '/page/1', '/page/2', '/article/12/Title+12',
+                 '/articles/2020', '/articles/2020/4', '/author/3/Elmer',
+                 '/tags/python', '/tags/rust', '/alltags', '/allmonths',
+                 '/allauthors'):
+      self.assertIn(path, pages)
+    self.assertNotIn('/page/3', pages)
+
+  def testEditedArticle(self):
+    """An edit moves the pages that show the article, and only those."""
+    before = self._Pages()
+    articles = list(self.articles)
+    articles[0] = Article(12, lastchange='2020-05-01 10:00:00')
+    after = self._Pages(articles)
+    changed = set(path for path in before if before[path] != after[path])
+    self.assertEqual(changed, set(['/', '/page/1', '/article/12/Title+12',
+                                   '/articles/2020', '/articles/2020/4',
+                                   '/author/3/Elmer', '/tags/python']))
+
+  def testListingFirstPage(self):
+    """Of a listing only the first page is exported."""
+    before = self._Pages()
+    articles = list(self.articles)
+    articles[-1] = Article(1, lastchange='2020-05-01 10:00:00')
+    after = self._Pages(articles)
+    self.assertEqual(after['/articles/2020/4'], before['/articles/2020/4'])
+    self.assertNotEqual(after['/tags/rust'], before['/tags/rust'])
+
+  def testDateOrder(self):
+    """Date listings start at the newest date, whatever the article ID."""
+    self.articles[-1] = Article(1, date=datetime.datetime(2020, 4, 30))
+    before = self._Pages()
+    articles = list(self.articles)
+    articles[-1] = Article(1, date=datetime.datetime(2020, 4, 30),
+                           lastchange='2020-05-01 10:00:00')
+    after = self._Pages(articles)
+    self.assertNotEqual(after['/articles/2020/4'], before['/articles/2020/4'])
+    self.assertEqual(after['/author/3/Elmer'], before['/author/3/Elmer'])
+
+
+class FakeExecutor(object):
+  """Runs the export in the test process rather than in workers."""
+
+  def __init__(self, **kwds):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    return False
+
+  def map(self, function, *iterables, **kwds):
+    return map(function, *iterables)
+
+
+class ExportTest(unittest.TestCase):
+  """Tests that Export renders changed pages only, and cleans up."""
+
+  def setUp(self):
+    self.output = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.output)
+    self.rendered = []
+    self.missing = set()
+    self.pages = {'/': 'a', '/article/1/Title': 'b'}
+    for target, value in (
+        ('Site', lambda connection, config: mock.Mock(
+            Pages=lambda: dict(self.pages))),
+        ('_application', self._Application)):
+      patcher = mock.patch.object(export, target, value)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    patcher = mock.patch.object(export.concurrent.futures,
+                                'ProcessPoolExecutor', FakeExecutor)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def _Application(self, environ, start_response):
+    path = environ['PATH_INFO']
+    self.rendered.append(path)
+    if path in self.missing:
+      start_response('404 Not Found', [])
+    else:
+      start_response('200 OK', [])
+    return [('page %s' % path).encode('utf-8')]
+
+  def _Export(self, full=False):
+    return export.Export(None, {}, self.output, full=full)
+
+  def testIncremental(self):
+    """Later runs render the pages whose digest changed only."""
+    self.assertEqual(self._Export()['rendered'], 2)
+    with open(os.path.join(self.output, 'article/1/Title.html')) as page:
+      self.assertEqual(page.read(), 'page /article/1/Title')
+    self.rendered = []
+    self.pages['/'] = 'changed'
+    result = self._Export()
+    self.assertEqual(self.rendered, ['/'])
+    self.assertEqual((result['rendered'], result['unchanged']), (1, 1))
+
+  def testFull(self):
+    """A full run renders every page."""
+    self._Export()
+    self.assertEqual(self._Export(full=True)['rendered'], 2)
+
+  def testRemoved(self):
+    """Pages that no longer exist are removed."""
+    self._Export()
+    del self.pages['/article/1/Title']
+    self.assertEqual(self._Export()['removed'], 1)
+    self.assertFalse(os.path.exists(
+        os.path.join(self.output, 'article/1/Title.html')))
+
+  def testFailed(self):
+    """Pages that do not answer 200 are reported and tried again later."""
+    self.missing.add('/article/1/Title')
+    self.assertEqual(self._Export()['failed'], ['/article/1/Title'])
+    with open(os.path.join(self.output, export.MANIFEST)) as manifest:
+      self.assertEqual(list(json.load(manifest)['pages']), ['/'])
+    self.missing.clear()
+    self.rendered = []
+    self._Export()
+    self.assertEqual(self.rendered, ['/article/1/Title'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+"""Tests for the log parsing in ublog.loganalytics."""
+
+# Standard modules
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+# Application components
+from ublog import loganalytics
+
+ACCESS = b"""\
+127.0.0.1 - - [30/04/2020 10:14:46] "GET / 200 HTTP/1.1"
+127.0.0.1 - - [30/04/2020 10:14:47] "GET /article/12/some-title 200 HTTP/1.1"
+127.0.0.1 - - [30/04/2020 10:15:46] "GET /article/13/other?page=2 200 HTTP/1.1"
+127.0.0.1 - - [30/04/2020 10:16:46] "GET /js/missing.js 404 HTTP/1.1"
+not an access line
+{"time": "2020-04-30T10:20:46", "path": "/js/missing.js", "status": 404}
+{"time": "2020-04-30T10:24:46", "path": "/tags/x", "status": 200, "route": "tag"}
+{"time": "invalid", "path": "/", "status": 200}
+"""
+
+EXCEPTION = """\
+UNCAUGHT EXCEPTION:
+Traceback (most recent call last):
+  File "/srv/ublog/ublog/pages.py", line %d, in Article
+    article = model.Article.FromPrimary(self.connection, int(number))
+  File "/srv/uweb3/uweb3/model.py", line 1031, in FromPrimary
+    cls.__name__, pkey_value))
+uweb3.model.NotExistError: There is no 'Article' for primary key %d
+"""
+
+
+class LogTest(unittest.TestCase):
+  """Writes log files into a temporary directory."""
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory)
+
+  def _Write(self, name, content):
+    path = os.path.join(self.directory, name)
+    opener = gzip.open if name.endswith('.gz') else open
+    with opener(path, 'wb') as logfile:
+      logfile.write(content)
+    return path
+
+
+class ParseTest(unittest.TestCase):
+  """Tests the parsing of single values."""
+
+  def testRouteOf(self):
+    """Numbers and the slugs following them are grouped."""
+    for path, route in (('/', '/'),
+                        ('/article/12/some-title', '/article/{n}/{slug}'),
+                        ('/articles/2020/4', '/articles/{n}/{n}'),
+                        ('/page/3?before=20', '/page/{n}'),
+                        ('/tags/python', '/tags/python')):
+      self.assertEqual(loganalytics.RouteOf(path), route)
+
+  def testParseTime(self):
+    self.assertEqual(loganalytics._ParseTime('30/04/2020 10:14:46'),
+                     datetime.datetime(2020, 4, 30, 10, 14, 46))
+    self.assertIsNone(loganalytics._ParseTime('yesterday noon'))
+
+  def testSignature(self):
+    """Line numbers and messages do not change the signature."""
+    first, summary = loganalytics.Signature(EXCEPTION % (290, 1))
+    second, _summary = loganalytics.Signature(EXCEPTION % (312, 2))
+    self.assertEqual(first, second)
+    self.assertEqual(summary['exception'], 'uweb3.model.NotExistError')
+    self.assertEqual(summary['message'],
+                     "There is no 'Article' for primary key 1")
+    self.assertEqual(summary['where'], ['pages.py:Article',
+                                        'model.py:FromPrimary'])
+    other, _summary = loganalytics.Signature(
+        (EXCEPTION % (290, 1)).replace('in Article', 'in ArticlesByTag'))
+    self.assertNotEqual(first, other)
+
+  def testSignatureLastTraceback(self):
+    """Of chained exceptions the last traceback is used."""
+    chained = ('Traceback (most recent call last):\n'
+               '  File "admin.py", line 1, in SaveTags\n'
+               'KeyError: 1\n\n'
+               'During handling of the above exception, another exception '
+               'occurred:\n\n' + EXCEPTION % (290, 1))
+    self.assertEqual(loganalytics.Signature(chained),
+                     loganalytics.Signature(EXCEPTION % (290, 1)))
+
+
+class TopCounterTest(unittest.TestCase):
+  """Tests the bounded counting of TopCounter."""
+
+  def testExact(self):
+    counter = loganalytics.TopCounter(10)
+    for key in 'abacab':
+      counter.Add(key)
+    self.assertEqual(counter.MostCommon(), [('a', 3), ('b', 2), ('c', 1)])
+    self.assertEqual(counter.MostCommon(1), [('a', 3)])
+
+  def testBounded(self):
+    """Frequent keys survive a stream of rare ones."""
+    counter = loganalytics.TopCounter(3)
+    for number in range(100):
+      counter.Add('frequent')
+      counter.Add('rare%d' % number)
+    self.assertEqual(len(counter.counts), 3)
+    self.assertEqual(counter.total, 200)
+    self.assertEqual(counter.MostCommon(1)[0][0], 'frequent')
+
+  def testMerge(self):
+    first = loganalytics.TopCounter(10)
+    second = loganalytics.TopCounter(10)
+    first.Add('a', 2)
+    second.Add('a')
+    second.Add('b')
+    first.Merge(second)
+    self.assertEqual(first.MostCommon(), [('a', 3), ('b', 1)])
+    self.assertEqual(first.total, 4)
+
+
+class AnalyseAccessTest(LogTest):
+  """Tests the reading of access logs."""
+
+  def testFormats(self):
+    """Text and JSON lines are read, lines that do not parse are skipped."""
+    summary = loganalytics.AnalyseAccess(
+        self._Write('access.log', ACCESS)).Summary()
+    self.assertEqual(summary['requests'], 6)
+    self.assertEqual(summary['first'], '2020-04-30T10:14:46')
+    self.assertEqual(summary['last'], '2020-04-30T10:24:46')
+    self.assertEqual(summary['statuses'], [{'status': 200, 'requests': 4},
+                                           {'status': 404, 'requests': 2}])
+    self.assertEqual(summary['notfound'], [{'path': '/js/missing.js',
+                                            'requests': 2}])
+    routes = dict((route['route'], route['requests'])
+                  for route in summary['routes'])
+    self.assertEqual(routes, {'/': 1, '/article/{n}/{slug}': 2,
+                              '/js/missing.js': 2, 'tag': 1})
+
+  def testGzip(self):
+    """Rotated logs are read through gzip."""
+    summary = loganalytics.AnalyseAccess(
+        self._Write('access.log.1.gz', ACCESS)).Summary()
+    self.assertEqual(summary['requests'], 6)
+
+  def testChunks(self):
+    """Analysing a log in chunks gives the same report as in one go."""
+    path = self._Write('access.log', ACCESS * 20)
+    whole = loganalytics.Analyse(access=[path], jobs=1).Summary()
+    chunked = loganalytics.Analyse(access=[path], jobs=1,
+                                   chunksize=100).Summary()
+    self.assertGreater(len(list(loganalytics.Tasks([path], 100))), 1)
+    self.assertEqual(chunked, whole)
+    self.assertEqual(whole['requests'], 120)
+
+
+class AnalyseExceptionsTest(LogTest):
+  """Tests the reading of exception logs."""
+
+  def testGroups(self):
+    """Exceptions are grouped by signature, in text and JSON logs."""
+    content = ''.join(EXCEPTION % (line, line) for line in (10, 20, 30))
+    content += json.dumps({'time': '2020-04-30T10:20:46',
+                           'exception': EXCEPTION % (40, 4)}) + '\n'
+    content += json.dumps({'time': '2020-04-30T10:20:46',
+                           'message': 'no exception'}) + '\n'
+    summary = loganalytics.AnalyseExceptions(
+        self._Write('error.log', content.encode('utf-8'))).Summary()
+    self.assertEqual(len(summary['exceptions']), 1)
+    self.assertEqual(summary['exceptions'][0]['occurrences'], 4)
+
+  def testChunks(self):
+    """An exception running across a chunk border is counted once."""
+    path = self._Write('error.log', ''.join(
+        EXCEPTION % (line, line) for line in range(30)).encode('utf-8'))
+    whole = loganalytics.Analyse(exceptions=[path], jobs=1).Summary()
+    chunked = loganalytics.Analyse(exceptions=[path], jobs=1,
+                                   chunksize=256).Summary()
+    self.assertEqual(chunked, whole)
+    self.assertEqual(whole['exceptions'][0]['occurrences'], 30)
+
+
+if __name__ == '__main__':
+  unittest.main()
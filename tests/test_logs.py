@@ -0,0 +1,125 @@
+#!/usr/bin/python
+"""Tests for the queued JSON logging in ublog.logs."""
+
+# Standard modules
+import json
+import logging
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+# Application components
+from ublog import logs
+
+
+class JsonFormatterTest(unittest.TestCase):
+  """Tests the JSON lines written for each record."""
+
+  def _Record(self, message='GET %s', args=('/',), **kwds):
+    return logging.LogRecord('ublog.access', logging.INFO, __file__, 1,
+                             message, args, kwds.pop('exc_info', None),
+                             **kwds)
+
+  def testFields(self):
+    """The extra fields are merged into the object."""
+    record = self._Record()
+    record.fields = {'status': 200, 'route': '/'}
+    entry = json.loads(logs.JsonFormatter().format(record))
+    self.assertEqual(entry['message'], 'GET /')
+    self.assertEqual(entry['logger'], 'ublog.access')
+    self.assertEqual((entry['status'], entry['route']), (200, '/'))
+
+  def testException(self):
+    """A traceback becomes the exception field."""
+    try:
+      raise ValueError('broken')
+    except ValueError:
+      record = self._Record('failed', (), exc_info=sys.exc_info())
+    entry = json.loads(logs.JsonFormatter().format(record))
+    self.assertIn('ValueError: broken', entry['exception'])
+
+
+class QueueHandlerTest(unittest.TestCase):
+  """Tests that the queue handler never blocks."""
+
+  def testDropsWhenFull(self):
+    """Records that do not fit are counted rather than waited for."""
+    handler = logs.QueueHandler(queue.Queue(2))
+    logger = logging.getLogger('ublog.test.queue')
+    logger.addHandler(handler)
+    logger.propagate = False
+    self.addCleanup(logger.removeHandler, handler)
+    for number in range(5):
+      logger.warning('record %d', number)
+    self.assertEqual(handler.queue.qsize(), 2)
+    self.assertEqual(handler.dropped, 3)
+
+  def testPrepare(self):
+    """The message is formatted and the traceback rendered on queueing."""
+    handler = logs.QueueHandler(queue.Queue())
+    try:
+      raise KeyError('missing')
+    except KeyError:
+      record = logging.LogRecord('ublog.error', logging.ERROR, __file__, 1,
+                                 'failed for %s', ('/',), sys.exc_info())
+    record = handler.prepare(record)
+    self.assertEqual((record.msg, record.args), ('failed for /', None))
+    self.assertIsNone(record.exc_info)
+    self.assertIn("KeyError: 'missing'", record.exc_text)
+
+
+class ConfigureTest(unittest.TestCase):
+  """Tests that queued records end up in their log files."""
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.directory)
+    patcher = mock.patch.multiple(logs, _listener=None, _handler=None,
+                                  _files=(), _configured=None)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    for name in logs.LOGGERS:
+      logger = logging.getLogger(name)
+      self.addCleanup(setattr, logger, 'handlers', list(logger.handlers))
+      self.addCleanup(setattr, logger, 'propagate', logger.propagate)
+      self.addCleanup(logger.setLevel, logger.level)
+    self.addCleanup(self._Close)
+
+  def _Close(self):
+    logs.Flush()
+    for filehandler in logs._files:
+      filehandler.close()
+
+  def _Read(self, filename):
+    with open(os.path.join(self.directory, filename)) as logfile:
+      return [json.loads(line) for line in logfile]
+
+  def testFiles(self):
+    """Access records go to access.log, errors and slow queries elsewhere."""
+    logs.Configure({'directory': 'logs'}, self.directory)
+    logging.getLogger('ublog.access').info(
+        'GET /', extra={'fields': {'status': 200}})
+    logging.getLogger('ublog.error').error('failed')
+    logging.getLogger('ublog.slowquery').warning('slow')
+    logs.Flush()
+    self.directory = os.path.join(self.directory, 'logs')
+    access, = self._Read('access.log')
+    self.assertEqual((access['message'], access['status']), ('GET /', 200))
+    self.assertEqual([entry['message'] for entry in self._Read('error.log')],
+                     ['failed', 'slow'])
+
+  def testSameOptions(self):
+    """Configuring again with the same options keeps the writer."""
+    logs.Configure({}, self.directory)
+    handler = logs._handler
+    logs.Configure({}, self.directory)
+    self.assertIs(logs._handler, handler)
+    self.assertEqual(logs.Dropped(), 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
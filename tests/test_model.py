@@ -0,0 +1,600 @@
+#!/usr/bin/python
+"""Tests for the database independent parts of ublog.model."""
+
+# Standard modules
+import datetime
+import re
+import unittest
+from unittest import mock
+
+# Third-party modules
+import uweb3
+
+# Application components
+from ublog import model
+
+
+class FakeConnection(object):
+  """A sqltalk connection that hands out the given cursor."""
+
+  def __init__(self, cursor):
+    self.cursor = cursor
+
+  def __enter__(self):
+    return self.cursor
+
+  def __exit__(self, *exc_info):
+    return False
+
+  def EscapeValues(self, value):
+    if isinstance(value, int):
+      return str(value)
+    return "'%s'" % value.replace('\\', '\\\\').replace("'", "\\'")
+
+
+class ResultCursor(object):
+  """Records the queries run on it and answers each with the given rows."""
+
+  def __init__(self, *results):
+    self.results = list(results)
+    self.queries = []
+
+  def _Result(self):
+    return self.results.pop(0)
+
+  def Execute(self, statement):
+    self.queries.append(' '.join(statement.split()))
+    return self._Result()
+
+
+class TagsCursor(object):
+  """Answers the statements of Articletags.Sync from in-memory tables.
+
+  Arguments:
+    tags: dict of tag name to tag ID, the tags table.
+    links: set of the tag IDs linked to the article.
+    public: str, the public column of the article.
+  """
+
+  def __init__(self, tags, links, public='true'):
+    self.tags = tags
+    self.links = links
+    self.public = public
+    self.counts = {}
+    self.statements = []
+
+  def Execute(self, statement):
+    statement = ' '.join(statement.split())
+    self.statements.append(statement)
+    names = [re.sub(r'\\(.)', r'\1', name)
+             for name in re.findall(r"'((?:[^'\\]|\\.)*)'", statement)]
+    if statement.startswith('select ID, name from tags'):
+      wanted = set(name.lower() for name in names)
+      return [{'ID': tagid, 'name': name} for name, tagid in self.tags.items()
+              if name.lower() in wanted]
+    if statement.startswith('insert into tags'):
+      for name in names:
+        self.tags[name] = max(self.tags.values() or [0]) + 1
+      return []
+    if statement.startswith('select articletags.tagid, tags.name'):
+      byid = dict((tagid, name) for name, tagid in self.tags.items())
+      return [{'tagid': tagid, 'name': byid[tagid]}
+              for tagid in sorted(self.links)]
+    if statement.startswith('delete from articletags'):
+      self.links -= set(int(tagid) for tagid in re.search(
+          r'tagid in \(([^)]*)\)', statement).group(1).split(','))
+      return []
+    if statement.startswith('insert into articletags'):
+      self.links |= set(int(tagid) for _articleid, tagid in re.findall(
+          r'\((\d+), (\d+)\)', statement))
+      return []
+    if statement.startswith('select public from article'):
+      return [{'public': self.public}]
+    if statement.startswith('insert into tagcounts'):
+      for tagid, delta in re.findall(r'\((\d+), (-?\d+)\)', statement):
+        self.counts[int(tagid)] = self.counts.get(int(tagid), 0) + int(delta)
+      return []
+    raise AssertionError('Unexpected statement: %s' % statement)
+
+  def Count(self, prefix):
+    """Returns the number of statements run that start with prefix."""
+    return sum(statement.startswith(prefix) for statement in self.statements)
+
+
+class DeleteCursor(object):
+  """Deletes rows from in-memory tables of row counts per condition."""
+
+  def __init__(self, rows):
+    self.rows = rows
+    self.statements = []
+
+  def Execute(self, statement):
+    statement = ' '.join(statement.split())
+    self.statements.append(statement)
+    match = re.match(r'delete from (\w+) where (.*?)(?: limit (\d+))?$',
+                     statement)
+    key = match.group(1), match.group(2)
+    affected = self.rows.get(key, 0)
+    if match.group(3):
+      affected = min(affected, int(match.group(3)))
+    self.rows[key] = self.rows.get(key, 0) - affected
+    return mock.Mock(affected=affected)
+
+
+class CountingConnection(FakeConnection):
+  """A FakeConnection that counts its transactions."""
+
+  transactions = 0
+
+  def __enter__(self):
+    self.transactions += 1
+    return self.cursor
+
+
+class UserCommentsTest(unittest.TestCase):
+  """Tests the paged comments of a user."""
+
+  def testArticleJoined(self):
+    """The commented article is read in the same query."""
+    cursor = ResultCursor([
+        {'ID': 7, 'content': 'Nice', 'date': datetime.datetime(2020, 4, 30),
+         'user': 3, 'article': 12, 'title': 'Caching'}])
+    user = model.User(FakeConnection(cursor), {'ID': 3})
+    comments = list(user.Comments(FakeConnection(cursor), offset=20))
+    self.assertEqual(comments[0]['article'], {'ID': 12, 'title': 'Caching'})
+    self.assertNotIn('title', comments[0])
+    self.assertEqual(len(cursor.queries), 1)
+    self.assertTrue(cursor.queries[0].endswith('limit 10 offset 20'))
+
+  def testCommentCount(self):
+    """Only comments on existing articles are counted."""
+    cursor = ResultCursor([{'count': 23}])
+    user = model.User(FakeConnection(cursor), {'ID': 3})
+    self.assertEqual(user.CommentCount(FakeConnection(cursor)), 23)
+    self.assertIn('join article on (article.ID = comment.article)',
+                  cursor.queries[0])
+    self.assertIn('where comment.user = 3', cursor.queries[0])
+
+
+class CommentCountTest(unittest.TestCase):
+  """Tests that comment writes keep the counters on the article."""
+
+  def testCommentAdded(self):
+    """A new comment is counted without reading the comment table."""
+    cursor = ResultCursor([])
+    model.Article.CommentAdded(FakeConnection(cursor), 12,
+                               datetime.datetime(2020, 4, 30, 10, 14, 46))
+    self.assertEqual(len(cursor.queries), 1)
+    self.assertIn('comment_count = comment_count + 1', cursor.queries[0])
+    self.assertIn("greatest(coalesce(lastcomment, '2020-04-30 10:14:46'), "
+                  "'2020-04-30 10:14:46')", cursor.queries[0])
+    self.assertIn('where ID = 12', cursor.queries[0])
+
+  def testRecount(self):
+    """A recount is limited to the given articles."""
+    cursor = ResultCursor([], [])
+    model.Article.RecountComments(FakeConnection(cursor), [12, 13])
+    self.assertTrue(cursor.queries[0].endswith(
+        'where article.ID in (12, 13)'))
+    model.Article.RecountComments(FakeConnection(cursor))
+    self.assertNotIn('where article.ID', cursor.queries[1])
+
+  def testRecountNothing(self):
+    """Recounting no articles runs no query."""
+    cursor = ResultCursor()
+    model.Article.RecountComments(FakeConnection(cursor), [])
+    self.assertEqual(cursor.queries, [])
+
+  def testCreate(self):
+    """Creating a comment counts it on its article."""
+    with mock.patch.object(uweb3.model.Record, 'Create'), \
+        mock.patch.object(model.Article, 'CommentAdded') as added:
+      model.Comment.Create('connection', {'article': 12, 'date': 'now'})
+    added.assert_called_once_with('connection', 12, 'now')
+
+  def testDelete(self):
+    """Deleting a comment recounts its article."""
+    for article in (12, {'ID': 12, 'title': 'Caching'}):
+      comment = model.Comment('connection', {'ID': 7, 'article': article})
+      with mock.patch.object(uweb3.model.Record, 'Delete'), \
+          mock.patch.object(model.Article, 'RecountComments') as recount:
+        comment.Delete()
+      recount.assert_called_once_with('connection', [12])
+
+
+class ArticleTagTest(unittest.TestCase):
+  """Tests the listing of the articles with a tag."""
+
+  def testEscaped(self):
+    """The tag name is escaped into the query."""
+    cursor = ResultCursor([])
+    list(model.Article.Tag(FakeConnection(cursor), "it's"))
+    self.assertIn("tags.name = 'it\\'s'", cursor.queries[0])
+
+
+class ArticletagsSyncTest(unittest.TestCase):
+  """Tests that Articletags.Sync only writes what differs."""
+
+  def _Sync(self, names, tags, links, public='true'):
+    cursor = TagsCursor(tags, links, public)
+    result = model.Articletags.Sync(FakeConnection(cursor), 5, names)
+    return cursor, result
+
+  def testCreatesMissingTags(self):
+    """Unknown tags are created with a single insert, then linked."""
+    cursor, result = self._Sync(['python', 'MySQL', 'Caching'],
+                                {'python': 1}, set())
+    self.assertEqual(result, {'added': ['python', 'MySQL', 'Caching'],
+                              'removed': []})
+    self.assertEqual(cursor.Count('insert into tags'), 1)
+    self.assertEqual(cursor.links, set([1, 2, 3]))
+    self.assertEqual(sorted(cursor.tags), ['Caching', 'MySQL', 'python'])
+
+  def testOnlyDifferences(self):
+    """Links that stay are neither deleted nor inserted again."""
+    cursor, result = self._Sync(['python', 'rust'],
+                                {'python': 1, 'mysql': 2, 'rust': 3},
+                                set([1, 2]))
+    self.assertEqual(result, {'added': ['rust'], 'removed': ['mysql']})
+    self.assertEqual(cursor.links, set([1, 3]))
+    self.assertEqual(cursor.Count('insert into tags'), 0)
+    self.assertIn('delete from articletags where articleid = 5 and '
+                  'tagid in (2)', cursor.statements)
+    self.assertIn('insert into articletags (articleid, tagid) values (5, 3)',
+                  cursor.statements)
+
+  def testUnchanged(self):
+    """Syncing the current tags writes nothing."""
+    cursor, result = self._Sync(['python', 'mysql'],
+                                {'python': 1, 'mysql': 2}, set([1, 2]))
+    self.assertEqual(result, {'added': [], 'removed': []})
+    for write in ('insert', 'delete'):
+      self.assertEqual(cursor.Count(write), 0)
+
+  def testCaseInsensitive(self):
+    """Names that differ in case only are the same tag."""
+    cursor, result = self._Sync(['Python', 'python', 'PYTHON'],
+                                {'python': 1}, set())
+    self.assertEqual(result, {'added': ['Python'], 'removed': []})
+    self.assertEqual(cursor.links, set([1]))
+    self.assertEqual(cursor.Count('insert into tags'), 0)
+
+  def testEscapesNames(self):
+    """Tag names are escaped into the statements."""
+    cursor, result = self._Sync(["it's"], {}, set())
+    self.assertEqual(result['added'], ["it's"])
+    self.assertEqual(cursor.tags, {"it's": 1})
+
+  def testRemoveAll(self):
+    """Syncing no names removes every link."""
+    cursor, result = self._Sync([], {'python': 1, 'mysql': 2}, set([1, 2]))
+    self.assertEqual(sorted(result['removed']), ['mysql', 'python'])
+    self.assertEqual(cursor.links, set())
+
+  def testPublicCounts(self):
+    """Tag counts follow the links of a public article."""
+    cursor, _result = self._Sync(['python', 'rust'],
+                                 {'python': 1, 'mysql': 2, 'rust': 3},
+                                 set([1, 2]))
+    self.assertEqual(cursor.counts, {2: -1, 3: 1})
+
+  def testPrivateCounts(self):
+    """Tags of an article that is not public are not counted."""
+    cursor, _result = self._Sync(['python', 'rust'],
+                                 {'python': 1, 'mysql': 2, 'rust': 3},
+                                 set([1, 2]), public='false')
+    self.assertEqual(cursor.counts, {})
+    self.assertEqual(cursor.Count('insert into tagcounts'), 0)
+
+
+class TagCountsTest(unittest.TestCase):
+  """Tests the upkeep and reading of the tagcounts table."""
+
+  def testTagcloud(self):
+    """The cloud reads the counts, the menu only the top of them."""
+    cursor = ResultCursor([], [])
+    list(model.Tags.Tagcloud(FakeConnection(cursor)))
+    list(model.Tags.Tagcloud(FakeConnection(cursor), limit=10))
+    self.assertIn('from tagcounts, tags', cursor.queries[0])
+    self.assertNotIn('limit', cursor.queries[0])
+    self.assertTrue(cursor.queries[1].endswith(
+        'order by tagcounts.count desc, tagcounts.tagid desc limit 10'))
+
+  def testAdjust(self):
+    """Counts change in one statement, which creates missing rows."""
+    cursor = ResultCursor([])
+    model.Tags.AdjustCounts(FakeConnection(cursor), [1, 2], -1)
+    self.assertEqual(cursor.queries, [
+        'insert into tagcounts (tagid, count) values (1, -1), (2, -1) '
+        'on duplicate key update count = count + values(count)'])
+    model.Tags.AdjustCounts(FakeConnection(cursor), [], 1)
+    self.assertEqual(len(cursor.queries), 1)
+
+  def _Save(self, previous, public):
+    cursor = ResultCursor([{'public': previous, 'title': 'Title',
+                            'content': 'body'}])
+    article = model.Article(FakeConnection(cursor), {
+        'ID': 5, 'public': public, 'date': '2020-04-30 10:14:46',
+        'title': 'Title', 'content': 'body'})
+    with mock.patch.object(uweb3.model.Record, 'Save'), \
+        mock.patch.object(model.rendering, 'Excerpt', return_value='body'), \
+        mock.patch.object(model.rendering, 'TitleHtml', return_value='Title'), \
+        mock.patch.object(model.Article, 'RecountMonths'), \
+        mock.patch.object(model.Article, 'TagIDs', return_value=[1, 2]), \
+        mock.patch.object(model.Tags, 'AdjustCounts') as adjust:
+      article.Save()
+    return adjust
+
+  def testPublished(self):
+    """Publishing an article counts its tags."""
+    self._Save('false', 'true').assert_called_once_with(mock.ANY, [1, 2], 1)
+
+  def testHidden(self):
+    """Hiding an article uncounts its tags."""
+    self._Save('true', 'false').assert_called_once_with(mock.ANY, [1, 2], -1)
+
+  def testUnchanged(self):
+    """Saving without a change of visibility leaves the counts alone."""
+    self.assertFalse(self._Save('true', 'true').called)
+
+
+class DeleteRowsTest(unittest.TestCase):
+  """Tests the set-based deletes of DeleteRows."""
+
+  STEPS = [('comment', 'article = 5'), ('articletags', 'articleid = 5'),
+           ('article', 'ID = 5')]
+
+  def _Connection(self):
+    return CountingConnection(DeleteCursor({
+        ('comment', 'article = 5'): 1200, ('articletags', 'articleid = 5'): 3,
+        ('article', 'ID = 5'): 1}))
+
+  def testSingleTransaction(self):
+    """Without a chunksize every step runs once, in one transaction."""
+    connection = self._Connection()
+    model.DeleteRows(connection, self.STEPS)
+    self.assertEqual(connection.transactions, 1)
+    self.assertEqual(connection.cursor.statements, [
+        'delete from comment where article = 5',
+        'delete from articletags where articleid = 5',
+        'delete from article where ID = 5'])
+    self.assertFalse(any(connection.cursor.rows.values()))
+
+  def testChunks(self):
+    """With a chunksize every step repeats until it runs out of rows."""
+    connection = self._Connection()
+    model.DeleteRows(connection, self.STEPS, chunksize=500)
+    self.assertEqual(connection.cursor.statements[:3], [
+        'delete from comment where article = 5 limit 500'] * 3)
+    self.assertEqual(len(connection.cursor.statements), 5)
+    self.assertEqual(connection.transactions, 5)
+    self.assertFalse(any(connection.cursor.rows.values()))
+
+  def testBackground(self):
+    """In the background the callback runs once all steps are done."""
+    connection = self._Connection()
+    done = []
+    thread = model.DeleteRows(
+        connection, self.STEPS, chunksize=500, background=True,
+        callback=lambda: done.append(dict(connection.cursor.rows)))
+    thread.join(5)
+    self.assertEqual(len(done), 1)
+    self.assertFalse(any(done[0].values()))
+
+  def testBackgroundFailure(self):
+    """A failed background delete is logged, and still calls back."""
+    connection = self._Connection()
+    connection.cursor.Execute = mock.Mock(side_effect=ValueError('gone'))
+    done = []
+    with self.assertLogs('ublog.error'):
+      thread = model.DeleteRows(connection, self.STEPS, background=True,
+                                callback=lambda: done.append(True))
+      thread.join(5)
+    self.assertEqual(done, [True])
+
+  def testRecountFailure(self):
+    """The caller's callback runs even when the recount fails."""
+    connection = self._Connection()
+    article = model.Article(connection, {'ID': 5, 'public': 'false',
+                                         'date': '2020-04-30 10:14:46'})
+    done = []
+    with mock.patch.object(model.Article, 'RecountMonths',
+                           side_effect=ValueError('gone')):
+      with self.assertRaises(ValueError):
+        article.Delete(connection, callback=lambda: done.append(True))
+    self.assertEqual(done, [True])
+
+  def testArticleSteps(self):
+    """An article goes last, after which its month and tags are recounted."""
+    connection = self._Connection()
+    article = model.Article(connection, {'ID': 5, 'public': 'true',
+                                         'date': '2020-04-30 10:14:46'})
+    with mock.patch.object(model.Article, 'TagIDs', return_value=[1, 2]), \
+        mock.patch.object(model.Tags, 'AdjustCounts') as adjust, \
+        mock.patch.object(model.Article, 'RecountMonths') as recount:
+      article.Delete(connection)
+    recount.assert_called_once_with(connection, ['2020-04-30 10:14:46'])
+    adjust.assert_called_once_with(connection, [1, 2], -1)
+    self.assertEqual(connection.cursor.statements[-1],
+                     'delete from article where ID = 5')
+    self.assertFalse(any(connection.cursor.rows.values()))
+
+
+class DateRangeTest(unittest.TestCase):
+  """Tests the half-open date ranges the archive queries select on."""
+
+  def testMonth(self):
+    """A month runs up to the first day of the next month."""
+    self.assertEqual(model.MonthRange(2020, 4),
+                     {'start': '2020-04-01', 'end': '2020-05-01'})
+    self.assertEqual(model.MonthRange(2020, 1),
+                     {'start': '2020-01-01', 'end': '2020-02-01'})
+
+  def testDecember(self):
+    """December ends on the first of January of the next year."""
+    self.assertEqual(model.MonthRange(2019, 12),
+                     {'start': '2019-12-01', 'end': '2020-01-01'})
+
+  def testPadding(self):
+    """Years and months are zero padded, so the strings compare as dates."""
+    self.assertEqual(model.MonthRange(999, 9),
+                     {'start': '0999-09-01', 'end': '0999-10-01'})
+
+  def testInvalidMonth(self):
+    """Months outside 1..12 are refused."""
+    for month in (0, 13, -1):
+      with self.assertRaises(ValueError):
+        model.MonthRange(2020, month)
+
+  def testYear(self):
+    """A year runs up to the first of January of the next year."""
+    self.assertEqual(model.YearRange(2020),
+                     {'start': '2020-01-01', 'end': '2021-01-01'})
+
+
+class ExcerptTest(unittest.TestCase):
+  """Tests that articles are written with their excerpt and title html."""
+
+  def setUp(self):
+    patcher = mock.patch.object(model.rendering, 'Excerpt',
+                                side_effect=lambda content: 'cut %s' % content)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    patcher = mock.patch.object(model.rendering, 'TitleHtml',
+                                side_effect=lambda title: '<b>%s</b>' % title)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def testCreate(self):
+    """A new article is stored with its excerpt and title html."""
+    record = {'title': 'Title', 'content': 'body',
+              'date': '2020-04-30 10:14:46'}
+    with mock.patch.object(uweb3.model.Record, 'Create') as create, \
+        mock.patch.object(model.Article, 'RecountMonths'):
+      model.Article.Create(None, record)
+    self.assertEqual(create.call_args[0][1]['excerpt'], 'cut body')
+    self.assertEqual(create.call_args[0][1]['titlehtml'], '<b>Title</b>')
+
+  def _Save(self, stored, title='Title', **record):
+    cursor = ResultCursor([{'public': 'true', 'title': title,
+                            'content': stored}])
+    article = model.Article(FakeConnection(cursor), dict({
+        'ID': 5, 'public': 'true', 'date': '2020-04-30 10:14:46',
+        'title': 'Title', 'titlehtml': 'kept', 'content': 'body'}, **record))
+    with mock.patch.object(uweb3.model.Record, 'Save'), \
+        mock.patch.object(model.Article, 'RecountMonths'):
+      article.Save()
+    return article
+
+  def testSave(self):
+    """Saving renders the excerpt again only when the content changed."""
+    self.assertEqual(self._Save('old', excerpt='cut old')['excerpt'],
+                     'cut body')
+    self.assertEqual(self._Save('body', excerpt='kept')['excerpt'], 'kept')
+    self.assertEqual(self._Save('body', excerpt=None)['excerpt'], 'cut body')
+
+  def testSaveTitle(self):
+    """Saving renders the title html again only when the title changed."""
+    self.assertEqual(self._Save('body', 'Old', excerpt='kept')['titlehtml'],
+                     '<b>Title</b>')
+    self.assertEqual(self._Save('body', excerpt='kept')['titlehtml'], 'kept')
+    self.assertEqual(
+        self._Save('body', excerpt='kept', titlehtml=None)['titlehtml'],
+        '<b>Title</b>')
+
+  def testStoreMissing(self):
+    """A listing row without an excerpt has it rendered and stored."""
+    cursor = ResultCursor([{'content': 'body'}], [])
+    article = model._StoreRendered(FakeConnection(cursor), {
+        'ID': 5, 'title': 'Title', 'titlehtml': 'kept', 'excerpt': None})
+    self.assertEqual(article['excerpt'], 'cut body')
+    self.assertIn("excerpt = 'cut body'", cursor.queries[1])
+    self.assertIn("titlehtml = 'kept'", cursor.queries[1])
+    stored = {'ID': 6, 'titlehtml': 'kept', 'excerpt': 'stored'}
+    self.assertIs(model._StoreRendered(FakeConnection(cursor), stored), stored)
+    self.assertEqual(len(cursor.queries), 2)
+
+  def testStoreMissingTitle(self):
+    """A listing row without title html has it rendered and stored."""
+    cursor = ResultCursor([])
+    article = model._StoreRendered(FakeConnection(cursor), {
+        'ID': 5, 'title': 'Title', 'titlehtml': None, 'excerpt': 'stored'})
+    self.assertEqual(article['titlehtml'], '<b>Title</b>')
+    self.assertEqual(len(cursor.queries), 1)
+    self.assertIn("titlehtml = '<b>Title</b>'", cursor.queries[0])
+
+  def testRebuild(self):
+    """Excerpts are rebuilt in batches by ID, until no articles are left."""
+    cursor = ResultCursor(
+        [{'ID': 1, 'title': 'A', 'content': 'a'},
+         {'ID': 4, 'title': 'B', 'content': 'b'}], [], [],
+        [{'ID': 7, 'title': 'C', 'content': 'c'}], [], [])
+    updated = model.Article.RebuildExcerpts(FakeConnection(cursor), batch=2)
+    self.assertEqual(updated, 3)
+    selects = [query for query in cursor.queries if query.startswith('select')]
+    self.assertEqual(len(selects), 3)
+    self.assertIn('> 4', selects[1])
+    self.assertIn("'cut c'", cursor.queries[4])
+    self.assertIn("'<b>C</b>'", cursor.queries[4])
+
+
+class RecountMonthsTest(unittest.TestCase):
+  """Tests the upkeep of the month histogram."""
+
+  def testMonths(self):
+    """Every month the dates fall in is recounted once."""
+    cursor = ResultCursor([], [])
+    model.Article.RecountMonths(FakeConnection(cursor), [
+        '2020-04-30 10:14:46', datetime.datetime(2020, 4, 1),
+        '2019-12-31 23:59:59'])
+    self.assertEqual(len(cursor.queries), 2)
+    for query in cursor.queries:
+      self.assertTrue(query.startswith('replace into articlemonths'))
+    self.assertIn("replace into articlemonths (year, month, count) "
+                  "select 2019, 12, count(*) from article where "
+                  "public = 'true' and date >= '2019-12-01' and "
+                  "date < '2020-01-01'", cursor.queries)
+
+  def testRebuild(self):
+    """Without dates the whole histogram is rebuilt."""
+    cursor = ResultCursor([], [])
+    model.Article.RecountMonths(FakeConnection(cursor))
+    self.assertEqual(cursor.queries[0], 'delete from articlemonths')
+    self.assertTrue(cursor.queries[1].startswith('insert into articlemonths'))
+
+
+class SearchTest(unittest.TestCase):
+  """Tests the full-text search queries."""
+
+  def testSearchQuery(self):
+    """Words are required prefixes, short and excess words are dropped."""
+    self.assertEqual(model.Article.SearchQuery('MySQL caching'),
+                     '+MySQL* +caching*')
+    self.assertEqual(model.Article.SearchQuery('a to the'), '+the*')
+    self.assertEqual(model.Article.SearchQuery(
+        ' '.join('word%d' % number for number in range(20))),
+                     ' '.join('+word%d*' % number for number in range(10)))
+
+  def testSearchQueryOperators(self):
+    """Boolean mode operators in the input are not passed on."""
+    self.assertEqual(model.Article.SearchQuery('-"drop" (table)* ~x>y'),
+                     '+drop* +table*')
+    self.assertEqual(model.Article.SearchQuery(None), '')
+
+  def testEscaped(self):
+    """The query is escaped into the statement."""
+    cursor = ResultCursor([{'count': 0}])
+    model.Article.SearchCount(FakeConnection(cursor), "+it's*")
+    self.assertIn("against ('+it\\'s*' in boolean mode)", cursor.queries[0])
+
+  def testEmpty(self):
+    """An empty query finds nothing without asking the database."""
+    cursor = ResultCursor()
+    self.assertEqual(model.Article.SearchCount(FakeConnection(cursor), ''), 0)
+    self.assertEqual(list(model.Article.Search(FakeConnection(cursor), '')),
+                     [])
+    self.assertEqual(cursor.queries, [])
+
+
+if __name__ == '__main__':
+  unittest.main()
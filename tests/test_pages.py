@@ -0,0 +1,439 @@
+#!/usr/bin/python
+"""Tests for the request independent parts of ublog.pages."""
+
+# Standard modules
+import datetime
+import email.utils
+import time
+import unittest
+from unittest import mock
+
+# Third-party modules
+import uweb3
+
+# Application components
+from ublog import cache
+from ublog import model
+from ublog import pages
+from ublog import pool
+from ublog import timing
+
+
+class MakePaginationTest(unittest.TestCase):
+  """Tests PageMaker.MakePagination."""
+
+  def setUp(self):
+    self.pagemaker = pages.PageMaker.__new__(pages.PageMaker)
+
+  def testNoPages(self):
+    """Without posts there is nothing to paginate."""
+    self.assertIsNone(self.pagemaker.MakePagination(1, 0))
+
+  def testSinglePage(self):
+    """A single page links nothing but itself."""
+    pagination = self.pagemaker.MakePagination(1, 7)
+    self.assertEqual(pagination['currentpage'], 1)
+    self.assertEqual(pagination['totalpages'], 1)
+    self.assertEqual(pagination['pagenumbers'], [1])
+    for link in ('previous', 'next', 'first', 'last'):
+      self.assertIsNone(pagination[link])
+
+  def testPartialLastPage(self):
+    """A partially filled last page counts as a page."""
+    self.assertEqual(self.pagemaker.MakePagination(1, 21)['totalpages'], 3)
+    self.assertEqual(self.pagemaker.MakePagination(1, 20)['totalpages'], 2)
+
+  def testMiddlePage(self):
+    """A page in the middle links its neighbours and both ends."""
+    pagination = self.pagemaker.MakePagination(3, 50)
+    self.assertEqual(pagination['previous'], 2)
+    self.assertEqual(pagination['next'], 4)
+    self.assertEqual(pagination['first'], 1)
+    self.assertEqual(pagination['last'], 5)
+    self.assertEqual(pagination['pagenumbers'], [1, 2, 3, 4, 5])
+
+  def testClampsPage(self):
+    """Pages beyond either end are brought back to the nearest page."""
+    self.assertEqual(self.pagemaker.MakePagination(0, 50)['currentpage'], 1)
+    self.assertEqual(self.pagemaker.MakePagination(-4, 50)['currentpage'], 1)
+    pagination = self.pagemaker.MakePagination(99, 50)
+    self.assertEqual(pagination['currentpage'], 5)
+    self.assertIsNone(pagination['next'])
+    self.assertIsNone(pagination['last'])
+
+  def testPageWindow(self):
+    """With many pages only a window around the current page is linked."""
+    pagination = self.pagemaker.MakePagination(50, 1000)
+    self.assertEqual(pagination['pagenumbers'], list(range(45, 56)))
+    pagination = self.pagemaker.MakePagination(2, 1000)
+    self.assertEqual(pagination['pagenumbers'], list(range(1, 8)))
+    pagination = self.pagemaker.MakePagination(100, 1000)
+    self.assertEqual(pagination['pagenumbers'], list(range(95, 101)))
+
+  def testPagePosts(self):
+    """The number of posts per page sets the number of pages."""
+    pagination = self.pagemaker.MakePagination(1, 50, pageposts=25)
+    self.assertEqual(pagination['totalpages'], 2)
+
+
+class ArticlePageTest(unittest.TestCase):
+  """Tests how PageMaker._ArticlePage reads the articles of a page."""
+
+  def setUp(self):
+    self.pagemaker = pages.PageMaker.__new__(pages.PageMaker)
+    patcher = mock.patch.object(pages.PageMaker, 'connection', None,
+                                create=True)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    patcher = mock.patch.object(model.Article, 'LastN', return_value=[
+        {'ID': number, 'lastchange': '2020-04-30 10:14:46', 'title': 'Title',
+         'content': 'text'}
+        for number in (30, 29, 28)])
+    self.lastn = patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def testOffset(self):
+    """Without a keyset ID the page is read at an offset."""
+    pagination = self.pagemaker.MakePagination(3, 50)
+    articles = self.pagemaker._ArticlePage(pagination, True)
+    self.assertEqual(len(articles), 3)
+    self.assertEqual(self.lastn.call_args[1]['offset'], 20)
+    self.assertNotIn('before', self.lastn.call_args[1])
+    self.assertEqual(pagination['before'], 28)
+
+  def testKeyset(self):
+    """With a keyset ID the page starts below it, without an offset."""
+    pagination = self.pagemaker.MakePagination(3, 50)
+    self.pagemaker._ArticlePage(pagination, True, before=31)
+    self.assertEqual(self.lastn.call_args[1]['before'], 31)
+    self.assertNotIn('offset', self.lastn.call_args[1])
+
+  def testNoPages(self):
+    """Without pages nothing is read."""
+    self.assertEqual(self.pagemaker._ArticlePage(None, True), [])
+    self.assertFalse(self.lastn.called)
+
+
+class FakeRequest(object):
+  """The parts of a uWeb3 request that the page cache uses."""
+
+  def __init__(self, method='GET', **headers):
+    self.env = {'REQUEST_METHOD': method}
+    self.env.update(('HTTP_%s' % name.upper(), value)
+                    for name, value in headers.items())
+    self.headers = {}
+
+  def AddHeader(self, name, value):
+    self.headers[name] = value
+
+
+class CachedPageTest(unittest.TestCase):
+  """Tests how PageMaker._CachedPage serves pages from the page cache."""
+
+  def setUp(self):
+    cache.PAGES.backend.Clear()
+    self.addCleanup(cache.PAGES.backend.Clear)
+    self.renders = []
+    self.fingerprint = 'sidebar'
+
+  def _Page(self, method='GET', cookies=None, key=('Article', (1,)),
+            page='<form><input value="%s"></form>'):
+    pagemaker = pages.PageMaker.__new__(pages.PageMaker)
+    pagemaker.req = FakeRequest(method)
+    pagemaker.cookies = cookies or {'xsrf': 'token'}
+    pagemaker._SidebarFingerprint = lambda: self.fingerprint
+    def Render():
+      self.renders.append(key)
+      if isinstance(page, str):
+        return page % pagemaker._GetXSRF()
+      return page
+    return pagemaker._CachedPage(key, None, Render)
+
+  def testCached(self):
+    """A page is rendered once and served to every visitor."""
+    self.assertEqual(self._Page(), '<form><input value="token"></form>')
+    self.assertEqual(self._Page(cookies={'xsrf': 'other'}),
+                     '<form><input value="other"></form>')
+    self.assertEqual(len(self.renders), 1)
+
+  def testPlaceholder(self):
+    """The cached copy holds the placeholder, not a visitor's token."""
+    self._Page()
+    entry = cache.PAGES.Peek(
+        pages.PageMaker.__new__(pages.PageMaker)._PageKey(('Article', (1,))))
+    self.assertIn(pages.PageMaker.XSRF_PLACEHOLDER, entry[1])
+    self.assertNotIn('token', entry[1])
+
+  def testPlaceholderStable(self):
+    """The placeholder does not change between processes."""
+    self.assertEqual(pages.PageMaker.XSRF_PLACEHOLDER,
+                     'ublog-xsrf-placeholder-9c1e5f7a')
+
+  def testNotCached(self):
+    """Logged in visitors and other methods get a fresh render."""
+    self._Page(cookies={'xsrf': 'token', 'login': 'session'})
+    self._Page(method='POST')
+    self.assertEqual(len(self.renders), 2)
+    self.assertEqual(self._Page(), '<form><input value="token"></form>')
+    self.assertEqual(len(self.renders), 3)
+
+  def testSidebarChanged(self):
+    """A page rendered with another sidebar is rendered again."""
+    self._Page()
+    self.fingerprint = 'changed'
+    self._Page()
+    self.assertEqual(len(self.renders), 2)
+
+  def testKeys(self):
+    """Pages are cached per key."""
+    self._Page()
+    self._Page(key=('Article', (2,)))
+    self._Page(key=('Article', (2,)))
+    self.assertEqual(len(self.renders), 2)
+
+  def testValidatorStored(self):
+    """A cached page keeps answering conditional requests with a 304."""
+    stamp = datetime.datetime(2020, 4, 30, 10, 14, 46)
+    def Render(pagemaker):
+      notmodified = pagemaker._NotModified((stamp,), 1)
+      return notmodified or 'page'
+    first = pages.PageMaker.__new__(pages.PageMaker)
+    first.req = FakeRequest()
+    first.cookies = {'xsrf': 'token'}
+    first._SidebarFingerprint = lambda: self.fingerprint
+    self.assertEqual(first._CachedPage(('Article', (1,)), None,
+                                       lambda: Render(first)), 'page')
+    second = pages.PageMaker.__new__(pages.PageMaker)
+    second.req = FakeRequest(if_none_match=first.req.headers['ETag'])
+    second.cookies = {'xsrf': 'token'}
+    second._SidebarFingerprint = lambda: self.fingerprint
+    response = second._CachedPage(('Article', (1,)), None,
+                                  lambda: self.fail('rendered again'))
+    self.assertEqual(response.httpcode, 304)
+
+  def testResponse(self):
+    """Other responses are not cached, but get the token filled in."""
+    response = uweb3.Response(
+        'value="%s"' % pages.PageMaker.XSRF_PLACEHOLDER, httpcode=404)
+    self.assertEqual(self._Page(page=response).content, 'value="token"')
+    self._Page(page=response)
+    self.assertEqual(len(self.renders), 2)
+
+
+class NotModifiedTest(unittest.TestCase):
+  """Tests how PageMaker._NotModified answers conditional requests."""
+
+  STAMPS = (datetime.datetime(2020, 4, 30, 10, 14, 46),
+            datetime.datetime(2020, 5, 1, 8, 0, 0, 500), None)
+
+  def _NotModified(self, request, *identity, cookies=None, stamps=STAMPS):
+    pagemaker = pages.PageMaker.__new__(pages.PageMaker)
+    pagemaker.req = request
+    pagemaker.cookies = cookies or {'xsrf': 'token'}
+    pagemaker._SidebarFingerprint = lambda: 'sidebar'
+    return pagemaker._NotModified(stamps, *identity)
+
+  def _Validators(self, *identity, **kwds):
+    """Returns the headers an unconditional request gets."""
+    request = FakeRequest()
+    self.assertIsNone(self._NotModified(request, *identity, **kwds))
+    return request.headers
+
+  def testValidators(self):
+    """An unconditional request gets an ETag and the newest stamp."""
+    headers = self._Validators(1, 2)
+    self.assertTrue(headers['ETag'].startswith('W/"'))
+    modified = email.utils.parsedate_to_datetime(headers['Last-Modified'])
+    self.assertEqual(modified.timestamp(), time.mktime(
+        self.STAMPS[1].replace(microsecond=0).timetuple()))
+    self.assertEqual(headers['Cache-Control'], 'private, no-cache')
+
+  def testNoStamps(self):
+    """Pages without stamps get no validators."""
+    request = FakeRequest()
+    self.assertIsNone(self._NotModified(request, 1, stamps=(None,)))
+    self.assertEqual(request.headers, {})
+
+  def testOnlyReads(self):
+    """Only GET and HEAD requests are answered with a 304."""
+    etag = self._Validators(1)['ETag']
+    response = self._NotModified(FakeRequest('HEAD', if_none_match=etag), 1)
+    self.assertEqual(response.httpcode, 304)
+    self.assertIsNone(self._NotModified(
+        FakeRequest('POST', if_none_match=etag), 1))
+
+  def testIfNoneMatch(self):
+    """A matching ETag gets a 304, also among others or without W/."""
+    etag = self._Validators(1)['ETag']
+    for header in (etag, etag[2:], '"other", %s' % etag, '*'):
+      response = self._NotModified(FakeRequest(if_none_match=header), 1)
+      self.assertEqual(response.httpcode, 304, header)
+      self.assertEqual(response.headers['ETag'], etag)
+
+  def testIfNoneMatchChanged(self):
+    """The ETag changes with the identity and with the visitor's cookies."""
+    etag = self._Validators(1)['ETag']
+    self.assertIsNone(self._NotModified(FakeRequest(if_none_match=etag), 2))
+    self.assertIsNone(self._NotModified(
+        FakeRequest(if_none_match=etag), 1, cookies={'xsrf': 'other'}))
+    self.assertIsNone(self._NotModified(
+        FakeRequest(if_none_match=etag), 1,
+        cookies={'xsrf': 'token', 'login': 'session'}))
+
+  def testIfNoneMatchWins(self):
+    """If-Modified-Since is not looked at when If-None-Match is sent."""
+    modified = self._Validators(1)['Last-Modified']
+    self.assertIsNone(self._NotModified(FakeRequest(
+        if_none_match='"other"', if_modified_since=modified), 1))
+
+  def testIfModifiedSince(self):
+    """A copy as new as the newest stamp gets a 304, an older one does not."""
+    modified = email.utils.parsedate_to_datetime(
+        self._Validators(1)['Last-Modified'])
+    for seconds, fresh in ((0, True), (3600, True), (-1, False)):
+      header = email.utils.format_datetime(
+          modified + datetime.timedelta(seconds=seconds), usegmt=True)
+      response = self._NotModified(FakeRequest(if_modified_since=header), 1)
+      if fresh:
+        self.assertEqual(response.httpcode, 304, seconds)
+      else:
+        self.assertIsNone(response, seconds)
+
+  def testIfModifiedSinceInvalid(self):
+    """A date that does not parse gets the full page."""
+    self.assertIsNone(self._NotModified(
+        FakeRequest(if_modified_since='yesterday'), 1))
+
+  def testListing(self):
+    """Listings are validated on their articles and those articles' IDs."""
+    pagemaker = pages.PageMaker.__new__(pages.PageMaker)
+    pagemaker.req = FakeRequest()
+    pagemaker.cookies = {'xsrf': 'token'}
+    pagemaker._SidebarFingerprint = lambda: 'sidebar'
+    articles = [{'ID': 2, 'lastchange': self.STAMPS[0],
+                 'lastcomment': self.STAMPS[1]},
+                {'ID': 1, 'lastchange': self.STAMPS[0], 'lastcomment': None}]
+    self.assertIsNone(pagemaker._ListingNotModified(articles))
+    self.assertEqual(pagemaker._validator[1], ([2, 1],))
+    etag = pagemaker.req.headers['ETag']
+    pagemaker.req = FakeRequest(if_none_match=etag)
+    self.assertEqual(pagemaker._ListingNotModified(articles).httpcode, 304)
+    pagemaker.req = FakeRequest(if_none_match=etag)
+    self.assertIsNone(pagemaker._ListingNotModified(articles[:1]))
+
+  def testIfModifiedSinceListing(self):
+    """Listings ignore If-Modified-Since, their newest stamp may not move."""
+    modified = self._Validators(1)['Last-Modified']
+    pagemaker = pages.PageMaker.__new__(pages.PageMaker)
+    pagemaker.req = FakeRequest(if_modified_since=modified)
+    pagemaker.cookies = {'xsrf': 'token'}
+    pagemaker._SidebarFingerprint = lambda: 'sidebar'
+    self.assertIsNone(pagemaker._NotModified(self.STAMPS, 1,
+                                             modifiedsince=False))
+    self.assertEqual(pagemaker._validator[2], False)
+
+
+class RequestConnectionTest(unittest.TestCase):
+  """Tests the pooled request connection and the 503 on an empty pool."""
+
+  def setUp(self):
+    self.pool = mock.Mock()
+    patcher = mock.patch.object(pool, 'Configure', return_value=self.pool)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.pagemaker = pages.PageMaker.__new__(pages.PageMaker)
+    self.pagemaker.options = {'blog': {'name': 'ublog'}, 'mysql': {}}
+
+  def testCheckedOutOnce(self):
+    """The request connection is checked out on first use, and once only."""
+    self.assertIs(self.pagemaker.connection, self.pagemaker.connection)
+    self.assertEqual(self.pool.Checkout.call_count, 1)
+
+  def testReleased(self):
+    """Releasing returns the connection to the pool a single time."""
+    connection = self.pagemaker.connection
+    self.pagemaker._ReleaseConnection()
+    self.pagemaker._ReleaseConnection()
+    self.pool.Checkin.assert_called_once_with(connection)
+
+  def testExhausted(self):
+    """An exhausted pool is answered with 503 and a Retry-After header."""
+    parser = mock.Mock()
+    parser.Parse.return_value = 'busy'
+    error = pool.PoolExhaustedError('No connection available')
+    self.pagemaker.req = FakeRequest()
+    with mock.patch.object(pages.PageMaker, 'parser', parser), \
+        self.assertLogs('ublog.error'):
+      response = self.pagemaker.InternalServerError(
+          pool.PoolExhaustedError, error, None)
+    self.assertEqual(response.httpcode, 503)
+    self.assertEqual(response.headers['Retry-After'], '5')
+    self.assertEqual(response.content, 'busy')
+    self.assertEqual(parser.Parse.call_args[0][0], '503.html')
+
+  def testErrorReleases(self):
+    """Any error gives the connection back once the error page is built."""
+    connection = self.pagemaker.connection
+    self.pagemaker.req = FakeRequest()
+    with mock.patch.object(pages.uweb3.DebuggingPageMaker,
+                           'InternalServerError', create=True,
+                           return_value='error'), \
+        self.assertLogs('ublog.error'):
+      self.pagemaker.InternalServerError(ValueError, ValueError(), None)
+    self.pool.Checkin.assert_called_once_with(connection)
+
+  def testNotFoundReleases(self):
+    """A 404 page gives the connection back as well."""
+    connection = self.pagemaker.connection
+    with mock.patch.object(pages.PageMaker, 'parser', mock.Mock()), \
+        mock.patch.object(pages.PageMaker, 'CommonBlocks', return_value={}):
+      self.assertEqual(self.pagemaker.FourOhFour('/x').httpcode, 404)
+    self.pool.Checkin.assert_called_once_with(connection)
+
+
+class AccessLogTest(unittest.TestCase):
+  """Tests the access record written once a response is built."""
+
+  def _PostRequest(self, timer=None):
+    pagemaker = pages.PageMaker.__new__(pages.PageMaker)
+    pagemaker.req = FakeRequest()
+    pagemaker.req.env['PATH_INFO'] = '/'
+    pagemaker.started = time.perf_counter()
+    pagemaker.options = {}
+    pagemaker.timer = timer
+    pagemaker.querycounter = timing.QueryCounter()
+    pagemaker.querycounter.Add(0.002)
+    pagemaker.querycounter.Add(0.003)
+    with mock.patch.object(pages.uweb3.DebuggingPageMaker, '_PostRequest',
+                           create=True,
+                           side_effect=lambda response: response), \
+        self.assertLogs('ublog.access') as logs:
+      response = pagemaker._PostRequest(uweb3.Response('page'))
+    return response, logs.records[0].fields
+
+  def testQueries(self):
+    """Every request reports its statements, without a Server-Timing."""
+    response, fields = self._PostRequest()
+    self.assertEqual((fields['queries'], fields['query_ms']), (2, 5.0))
+    self.assertNotIn('db_ms', fields)
+    self.assertNotIn('Server-Timing', response.headers)
+
+  def testSampled(self):
+    """Sampled requests get their phase timings as well."""
+    response, fields = self._PostRequest(timing.RequestTimer())
+    self.assertEqual(fields['queries'], 2)
+    self.assertIn('db_ms', fields)
+    self.assertIn('db;dur=', response.headers['Server-Timing'])
+
+
+class RouteTest(unittest.TestCase):
+  """Tests the route lookup for the access log."""
+
+  def testRoute(self):
+    self.assertEqual(pages._Route('/article/12/title'),
+                     ('/article/(\\d+)/(.*)', 'Article'))
+    self.assertEqual(pages._Route('/no/such/page'), ('/(.*)', 'FourOhFour'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+"""Tests for the connection pool in ublog.pool."""
+
+# Standard modules
+import threading
+import time
+import unittest
+from unittest import mock
+
+# Application components
+from ublog import pool
+
+
+class FakeConnection(object):
+  """A connection that records whether it was pinged and closed."""
+
+  def __init__(self, alive=True):
+    self.alive = alive
+    self.pings = 0
+    self.closed = False
+
+  def ping(self):
+    self.pings += 1
+    if not self.alive:
+      raise Exception('MySQL server has gone away')
+
+  def close(self):
+    self.closed = True
+
+  def Query(self, statement):
+    return []
+
+
+class ConnectionPoolTest(unittest.TestCase):
+  """Tests checkout, timeouts and the replacement of connections."""
+
+  def setUp(self):
+    self.connections = []
+    patcher = mock.patch.object(pool.mysql, 'Connect', self._Connect)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def _Connect(self, **options):
+    connection = FakeConnection()
+    self.connections.append(connection)
+    return connection
+
+  def testCheckoutCreates(self):
+    """Connections are created as they are needed, up to the size."""
+    connectionpool = pool.ConnectionPool({}, size=2)
+    first = connectionpool.Checkout()
+    second = connectionpool.Checkout()
+    self.assertIsNot(first, second)
+    self.assertEqual(connectionpool.Stats()['open'], 2)
+    self.assertEqual(connectionpool.Stats()['inuse'], 2)
+
+  def testCheckinReuses(self):
+    """A returned connection is pinged and handed out again."""
+    connectionpool = pool.ConnectionPool({}, size=2)
+    connection = connectionpool.Checkout()
+    connectionpool.Checkin(connection)
+    self.assertIs(connectionpool.Checkout(), connection)
+    self.assertEqual(connection.pings, 1)
+    self.assertEqual(connectionpool.Stats()['created'], 1)
+
+  def testContextManager(self):
+    """Connection returns the connection when its block exits."""
+    connectionpool = pool.ConnectionPool({}, size=1)
+    with self.assertRaises(ValueError):
+      with connectionpool.Connection():
+        raise ValueError
+    self.assertEqual(connectionpool.Stats()['idle'], 1)
+
+  def testExhausted(self):
+    """A checkout without timeout fails at once when all are in use."""
+    connectionpool = pool.ConnectionPool({}, size=1)
+    connectionpool.Checkout()
+    with self.assertRaises(pool.PoolExhaustedError):
+      connectionpool.Checkout(timeout=0)
+    self.assertEqual(connectionpool.Stats()['timeouts'], 1)
+
+  def testTimeout(self):
+    """A checkout waits for the pool's timeout before failing."""
+    connectionpool = pool.ConnectionPool({}, size=1, timeout=0.05)
+    connectionpool.Checkout()
+    start = time.monotonic()
+    with self.assertRaises(pool.PoolExhaustedError):
+      connectionpool.Checkout()
+    self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+  def testWaitsForCheckin(self):
+    """A waiting checkout gets the connection another thread returns."""
+    connectionpool = pool.ConnectionPool({}, size=1, timeout=5)
+    connection = connectionpool.Checkout()
+    timer = threading.Timer(0.05, connectionpool.Checkin, (connection,))
+    timer.start()
+    self.addCleanup(timer.cancel)
+    self.assertIs(connectionpool.Checkout(), connection)
+    stats = connectionpool.Stats()
+    self.assertEqual(stats['waits'], 1)
+    self.assertGreater(stats['maxwait'], 0)
+
+  def testFailedConnectFreesSlot(self):
+    """A connection that cannot be made does not take up a slot."""
+    connectionpool = pool.ConnectionPool({}, size=1)
+    with mock.patch.object(pool.mysql, 'Connect',
+                           side_effect=Exception('refused')):
+      with self.assertRaises(Exception):
+        connectionpool.Checkout(timeout=0)
+    self.assertIsInstance(connectionpool.Checkout(timeout=0), FakeConnection)
+
+  def testRecycle(self):
+    """Connections older than recycle seconds are replaced on checkout."""
+    connectionpool = pool.ConnectionPool({}, size=1, recycle=60)
+    connection = connectionpool.Checkout()
+    connectionpool.Checkin(connection)
+    connectionpool._born[id(connection)] -= 61
+    replacement = connectionpool.Checkout()
+    self.assertIsNot(replacement, connection)
+    self.assertTrue(connection.closed)
+    self.assertEqual(connectionpool.Stats()['recycled'], 1)
+    self.assertEqual(connectionpool.Stats()['open'], 1)
+
+  def testNoRecycle(self):
+    """With recycle 0 connections are kept however old they are."""
+    connectionpool = pool.ConnectionPool({}, size=1, recycle=0)
+    connection = connectionpool.Checkout()
+    connectionpool.Checkin(connection)
+    connectionpool._born[id(connection)] -= 10 ** 6
+    self.assertIs(connectionpool.Checkout(), connection)
+
+  def testPingFailure(self):
+    """A connection the server dropped is replaced on checkout."""
+    connectionpool = pool.ConnectionPool({}, size=1)
+    connection = connectionpool.Checkout()
+    connection.alive = False
+    connectionpool.Checkin(connection)
+    replacement = connectionpool.Checkout()
+    self.assertIsNot(replacement, connection)
+    self.assertTrue(connection.closed)
+    self.assertEqual(connectionpool.Stats()['pingfailures'], 1)
+
+  def testNoPing(self):
+    """Without ping connections are handed out as they are."""
+    connectionpool = pool.ConnectionPool({}, size=1, ping=False)
+    connection = connectionpool.Checkout()
+    connectionpool.Checkin(connection)
+    self.assertIs(connectionpool.Checkout(), connection)
+    self.assertEqual(connection.pings, 0)
+
+  def testMaxIdle(self):
+    """Connections returned beyond max_idle are closed."""
+    connectionpool = pool.ConnectionPool({}, size=2, max_idle=1)
+    first = connectionpool.Checkout()
+    second = connectionpool.Checkout()
+    connectionpool.Checkin(first)
+    connectionpool.Checkin(second)
+    self.assertFalse(first.closed)
+    self.assertTrue(second.closed)
+    stats = connectionpool.Stats()
+    self.assertEqual((stats['open'], stats['idle']), (1, 1))
+
+
+class ConfigureTest(unittest.TestCase):
+  """Tests that the pool is only replaced when its options change."""
+
+  def testSameOptions(self):
+    options = {'host': 'localhost', 'pool_size': '3', 'pool_ping': 'False'}
+    connectionpool = pool.Configure(options)
+    self.assertIs(pool.Configure(dict(options)), connectionpool)
+    self.assertEqual(connectionpool.size, 3)
+    self.assertFalse(connectionpool.ping)
+    self.assertIsNot(pool.Configure(dict(options, pool_size='4')),
+                     connectionpool)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+"""Tests for the query statistics in ublog.profiling."""
+
+# Standard modules
+import unittest
+from unittest import mock
+
+# Application components
+from ublog import pages
+from ublog import profiling
+from ublog import queries
+from ublog import timing
+
+
+class QueryStatsTest(unittest.TestCase):
+  """Tests the counters and percentiles of QueryStats."""
+
+  def _Stats(self, durations):
+    stats = profiling.QueryStats('test')
+    for seconds in durations:
+      stats.Add(seconds, 2, 'PageMaker.Index')
+    return stats
+
+  def testEmpty(self):
+    """Without samples every percentile is zero."""
+    self.assertEqual(profiling.QueryStats('test').Percentile(50), 0.0)
+
+  def testSingle(self):
+    """A single sample is every percentile."""
+    stats = self._Stats([0.25])
+    for percent in (0, 50, 99, 100):
+      self.assertEqual(stats.Percentile(percent), 0.25)
+
+  def testPercentiles(self):
+    """Percentiles are the nearest rank of the sorted samples."""
+    stats = self._Stats([number / 1000.0 for number in range(100, 0, -1)])
+    self.assertEqual(stats.Percentile(0), 0.001)
+    self.assertEqual(stats.Percentile(50), 0.051)
+    self.assertEqual(stats.Percentile(95), 0.096)
+    self.assertEqual(stats.Percentile(99), 0.1)
+    self.assertEqual(stats.Percentile(100), 0.1)
+
+  def testRecentSamples(self):
+    """Only the most recent SAMPLES durations are kept."""
+    stats = self._Stats([1.0] * profiling.SAMPLES + [0.0] *
+                        (profiling.SAMPLES // 2 + 1))
+    self.assertEqual(len(stats.samples), profiling.SAMPLES)
+    self.assertEqual(stats.Percentile(50), 0.0)
+    self.assertEqual(stats.count, profiling.SAMPLES * 3 // 2 + 1)
+    self.assertEqual(stats.maxseconds, 1.0)
+
+  def testSummary(self):
+    """The summary gives durations in milliseconds and counts presenters."""
+    summary = self._Stats([0.001, 0.003]).Summary()
+    self.assertEqual(summary['count'], 2)
+    self.assertEqual(summary['total_ms'], 4.0)
+    self.assertEqual(summary['mean_ms'], 2.0)
+    self.assertEqual(summary['max_ms'], 3.0)
+    self.assertEqual(summary['mean_rows'], 2.0)
+    self.assertEqual(summary['presenters'], {'PageMaker.Index': 2})
+
+
+class FakeConnection(object):
+  """A connection whose cursor returns two rows for every statement.
+
+  Like a sqltalk connection it sends every statement through Query.
+  """
+
+  def __init__(self):
+    self.statements = []
+
+  def EscapeValues(self, value):
+    return str(value)
+
+  def Query(self, statement):
+    self.statements.append(statement)
+    return [{'ID': 1}, {'ID': 2}]
+
+  def Execute(self, statement):
+    return self.Query(statement)
+
+
+class FakePageMaker(pages.PageMaker):
+  """A PageMaker with a presenter that runs a registered query."""
+
+  def __init__(self, connection):
+    self.queryconnection = connection
+
+  def Index(self):
+    return self._Articles()
+
+  def _Articles(self):
+    return queries.Execute(self.queryconnection, self.queryconnection, 'test',
+                           ID=5)
+
+
+class ExecuteTest(unittest.TestCase):
+  """Tests the recording of queries run through queries.Execute."""
+
+  def setUp(self):
+    for name, value in (('ENABLED', True), ('SLOW_SECONDS', None)):
+      patcher = mock.patch.object(profiling, name, value)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    patcher = mock.patch.dict(queries.QUERIES, {
+        'test': 'select * from article where ID < %(ID)s'})
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    profiling.Reset()
+    self.addCleanup(profiling.Reset)
+    self.connection = FakeConnection()
+
+  def testRecorded(self):
+    """Runs are counted under their query name, with the rows returned."""
+    for _run in range(2):
+      queries.Execute(self.connection, self.connection, 'test', ID=5)
+    summary, = profiling.Stats()
+    self.assertEqual((summary['query'], summary['count'], summary['rows']),
+                     ('test', 2, 4))
+    self.assertEqual(summary['presenters'], {'-': 2})
+
+  def testPresenter(self):
+    """The outermost public method of a PageMaker is the presenter."""
+    FakePageMaker(self.connection).Index()
+    self.assertEqual(profiling.Stats()[0]['presenters'],
+                     {'FakePageMaker.Index': 1})
+
+  def testDisabled(self):
+    """Nothing is recorded unless profiling is enabled."""
+    with mock.patch.object(profiling, 'ENABLED', False):
+      queries.Execute(self.connection, self.connection, 'test', ID=5)
+    self.assertEqual(profiling.Stats(), [])
+
+  def testSlow(self):
+    """Slow selects are logged with their EXPLAIN output."""
+    with mock.patch.object(profiling, 'SLOW_SECONDS', 0.0):
+      with self.assertLogs('ublog.slowquery') as logs:
+        queries.Execute(self.connection, self.connection, 'test', ID=5)
+    self.assertEqual(self.connection.statements[-1],
+                     'explain select * from article where ID < 5')
+    self.assertIn('Slow query test', logs.output[0])
+
+  def testNotPresenter(self):
+    """Objects that merely look like a PageMaker are not presenters."""
+    class Lookalike(object):
+      parser = req = None
+
+      def Index(self, connection):
+        return queries.Execute(connection, connection, 'test', ID=5)
+    Lookalike().Index(self.connection)
+    self.assertEqual(profiling.Stats()[0]['presenters'], {'-': 1})
+
+
+class InstrumentTest(unittest.TestCase):
+  """Tests the recording of statements sent through the connection."""
+
+  def setUp(self):
+    for name, value in (('ENABLED', True), ('SLOW_SECONDS', None)):
+      patcher = mock.patch.object(profiling, name, value)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    patcher = mock.patch.dict(queries.QUERIES, {
+        'test': 'select * from article where ID < %(ID)s'})
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    profiling.Reset()
+    self.addCleanup(profiling.Reset)
+    self.connection = profiling.Instrument(FakeConnection())
+
+  def testStatementName(self):
+    """Statements are named by their verb and table."""
+    for statement, name in (
+        ('insert into `comment` (ID) values (1)', 'insert comment'),
+        ('update tagcounts set count = 0', 'update tagcounts'),
+        ('delete from articletags where articleid = 5',
+         'delete articletags'),
+        ('SELECT * FROM article', 'select article'),
+        ('commit', 'commit')):
+      self.assertEqual(profiling.StatementName(statement), name)
+
+  def testRecorded(self):
+    """Statements outside the registry are recorded by the connection."""
+    self.connection.Query('delete from comment where article = 5')
+    self.connection.Query('delete from comment where article = 6')
+    summary, = profiling.Stats()
+    self.assertEqual((summary['query'], summary['count'], summary['rows']),
+                     ('delete comment', 2, 4))
+
+  def testRegisteredOnce(self):
+    """Registered queries are recorded under their name only."""
+    queries.Execute(self.connection, self.connection, 'test', ID=5)
+    self.assertEqual([summary['query'] for summary in profiling.Stats()],
+                     ['test'])
+
+  def testDisabled(self):
+    """Nothing is recorded unless profiling is enabled."""
+    with mock.patch.object(profiling, 'ENABLED', False):
+      self.connection.Query('delete from comment where article = 5')
+    self.assertEqual(profiling.Stats(), [])
+
+  def testCounted(self):
+    """Every statement counts towards the request, enabled or not."""
+    counter = timing.StartCounting()
+    self.addCleanup(timing.Stop)
+    with mock.patch.object(profiling, 'ENABLED', False):
+      self.connection.Query('delete from comment where article = 5')
+    queries.Execute(self.connection, self.connection, 'test', ID=5)
+    self.assertEqual(counter.count, 2)
+
+  def testSlow(self):
+    """Slow selects are logged with their EXPLAIN output."""
+    with mock.patch.object(profiling, 'SLOW_SECONDS', 0.0):
+      with self.assertLogs('ublog.slowquery'):
+        self.connection.Query('select * from article where ID = 5')
+    self.assertEqual(self.connection.statements[-1],
+                     'explain select * from article where ID = 5')
+    self.assertEqual(len(profiling.Stats()), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/python
+"""Tests for the query registry in ublog.queries."""
+
+# Standard modules
+import unittest
+from unittest import mock
+
+# Application components
+from ublog import queries
+
+
+class FakeConnection(object):
+  """Escapes values the way the sqltalk connection does, roughly."""
+
+  def EscapeValues(self, value):
+    if isinstance(value, int):
+      return str(value)
+    return "'%s'" % value.replace("'", "\\'")
+
+
+class PreparedTest(unittest.TestCase):
+  """Tests the conversion of registered queries to ? markers."""
+
+  def testOrder(self):
+    """Parameters are listed in the order their markers appear."""
+    with mock.patch.dict(queries.QUERIES, {'test': """
+        select * from article
+        where date >= %(start)s and date < %(end)s and user = %(user)s
+        """}):
+      text, order = queries.Prepared('test')
+    self.assertEqual(order, ['start', 'end', 'user'])
+    self.assertEqual(text.count('?'), 3)
+    self.assertNotIn('%(', text)
+
+  def testRepeated(self):
+    """A parameter used twice gets a marker, and an entry, for each use."""
+    with mock.patch.dict(queries.QUERIES, {'test': """
+        select match(title) against (%(query)s) as score
+        from article
+        where match(title) against (%(query)s) and ID < %(before)s
+        limit %(count)s
+        """}):
+      text, order = queries.Prepared('test')
+    self.assertEqual(order, ['query', 'query', 'before', 'count'])
+    self.assertEqual(text.count('?'), 4)
+
+  def testNoParameters(self):
+    """A query without parameters is left as it is."""
+    with mock.patch.dict(queries.QUERIES,
+                         {'test': 'select count(*) from tags'}):
+      self.assertEqual(queries.Prepared('test'),
+                       ('select count(*) from tags', []))
+
+  def testRegistry(self):
+    """Every registered query converts completely."""
+    for name, query in queries.QUERIES.items():
+      text, order = queries.Prepared(name)
+      self.assertNotIn('%(', text, name)
+      self.assertEqual(text.count('?'), len(order), name)
+      self.assertEqual(query.count('%('), len(order), name)
+
+  def testReservedParameters(self):
+    """No parameter shares its name with an argument of Execute."""
+    for name in queries.QUERIES:
+      _text, order = queries.Prepared(name)
+      self.assertFalse(set(order) & set(('name', 'connection', 'cursor')),
+                       name)
+
+
+class FormatTest(unittest.TestCase):
+  """Tests the escaping of parameters into the query text."""
+
+  def testFormat(self):
+    """Values are escaped for the connection, None becomes null."""
+    with mock.patch.dict(queries.QUERIES, {
+        'test': 'select * from tags where name = %(tag)s or ID = %(ID)s'}):
+      self.assertEqual(
+          queries.Format(FakeConnection(), 'test', tag="it's", ID=None),
+          "select * from tags where name = 'it\\'s' or ID = null")
+
+
+class FakeCursor(object):
+  """Records statements, failing the first execute if told to."""
+
+  def __init__(self, lost=False):
+    self.lost = lost
+    self.statements = []
+
+  def Execute(self, statement):
+    self.statements.append(statement)
+    if self.lost and statement.startswith('execute'):
+      self.lost = False
+      raise Exception('Unknown prepared statement handler')
+    return []
+
+
+class ExecuteTest(unittest.TestCase):
+  """Tests running named queries as text and as prepared statements."""
+
+  def setUp(self):
+    patcher = mock.patch.dict(queries.QUERIES, {
+        'test': 'select * from article where ID < %(before)s and '
+                'user = %(user)s and ID < %(before)s'})
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def testText(self):
+    """Without prepared statements the values are escaped into the text."""
+    cursor = FakeCursor()
+    with mock.patch.object(queries, 'PREPARED', False):
+      queries.Execute(FakeConnection(), cursor, 'test', before=5, user=3)
+    self.assertEqual(cursor.statements, [
+        'select * from article where ID < 5 and user = 3 and ID < 5'])
+
+  def testPreparedOnce(self):
+    """A statement is prepared on its first use on a connection only."""
+    cursor = FakeCursor()
+    connection = FakeConnection()
+    with mock.patch.object(queries, 'PREPARED', True):
+      queries.Execute(connection, cursor, 'test', before=5, user=3)
+      queries.Execute(connection, cursor, 'test', before=6, user=3)
+    self.assertEqual(cursor.statements, [
+        "prepare ublog_test from 'select * from article where ID < ? and "
+        "user = ? and ID < ?'",
+        'set @ublog_before = 5, @ublog_user = 3',
+        'execute ublog_test using @ublog_before, @ublog_user, @ublog_before',
+        'set @ublog_before = 6, @ublog_user = 3',
+        'execute ublog_test using @ublog_before, @ublog_user, @ublog_before'])
+
+  def testPreparedLost(self):
+    """A statement the server lost is prepared again."""
+    cursor = FakeCursor(lost=True)
+    with mock.patch.object(queries, 'PREPARED', True):
+      queries.Execute(FakeConnection(), cursor, 'test', before=5, user=3)
+    self.assertEqual([statement.split()[0] for statement in cursor.statements],
+                     ['prepare', 'set', 'execute', 'prepare', 'execute'])
+
+  def testConfigure(self):
+    with mock.patch.object(queries, 'PREPARED', False):
+      queries.Configure({'prepared_statements': 'True'})
+      self.assertTrue(queries.PREPARED)
+      queries.Configure({})
+      self.assertFalse(queries.PREPARED)
+
+
+if __name__ == '__main__':
+  unittest.main()
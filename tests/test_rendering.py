@@ -0,0 +1,128 @@
+#!/usr/bin/python
+"""Tests for the cached creole rendering in ublog.rendering."""
+
+# Standard modules
+import unittest
+from unittest import mock
+
+# Application components
+from ublog import cache
+from ublog import rendering
+
+
+class RenderingTest(unittest.TestCase):
+  """Tests that markup is rendered once per article revision and comment."""
+
+  def setUp(self):
+    cache.RENDERED.backend.Clear()
+    self.addCleanup(cache.RENDERED.backend.Clear)
+    patcher = mock.patch.object(rendering, 'Creole',
+                                side_effect=lambda text: '<p>%s</p>' % text)
+    self.creole = patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def testArticleOnce(self):
+    """An article revision is rendered once."""
+    article = {'ID': 1, 'lastchange': '2020-04-30 10:14:46', 'content': 'a'}
+    self.assertEqual(rendering.ArticleHtml(article), '<p>a</p>')
+    self.assertEqual(rendering.ArticleHtml(dict(article)), '<p>a</p>')
+    self.assertEqual(self.creole.call_count, 1)
+
+  def testArticleEdited(self):
+    """An edit changes lastchange, so the new content is rendered."""
+    article = {'ID': 1, 'lastchange': '2020-04-30 10:14:46', 'content': 'a'}
+    rendering.ArticleHtml(article)
+    article.update(lastchange='2020-05-01 08:00:00', content='b')
+    self.assertEqual(rendering.ArticleHtml(article), '<p>b</p>')
+    self.assertEqual(self.creole.call_count, 2)
+
+  def testExcerpt(self):
+    """Excerpts are cut from the rendered html and cached as well."""
+    article = {'ID': 2, 'lastchange': '2020-04-30 10:14:46', 'title': 'a',
+               'content': ' '.join(['word'] * 60)}
+    excerpt = rendering.ArticleExcerpt(article)
+    self.assertTrue(excerpt.endswith(' ...'))
+    self.assertEqual(len(excerpt.split()), 51)
+    rendering.AddExcerpts([article])
+    self.assertEqual(article['excerpt'], excerpt)
+    self.assertEqual(article['titlehtml'], '<p>a</p>')
+    self.assertEqual(self.creole.call_count, 2)
+
+  def testStoredExcerpt(self):
+    """Listing rows use the stored excerpt, without rendering."""
+    article = {'ID': 2, 'lastchange': '2020-04-30 10:14:46',
+               'excerpt': 'stored'}
+    self.assertEqual(rendering.ArticleExcerpt(article), 'stored')
+    self.assertEqual(self.creole.call_count, 0)
+
+  def testMissingExcerpt(self):
+    """Rows without an excerpt or content get an empty one."""
+    article = {'ID': 2, 'lastchange': '2020-04-30 10:14:46', 'excerpt': None}
+    self.assertEqual(rendering.ArticleExcerpt(article), '')
+    article['content'] = 'body'
+    self.assertEqual(rendering.ArticleExcerpt(article), '<p>body</p>')
+
+  def testStoredTitle(self):
+    """Rows use the stored title html, without rendering."""
+    article = {'ID': 2, 'lastchange': '2020-04-30 10:14:46', 'title': 'a',
+               'titlehtml': 'stored'}
+    self.assertEqual(rendering.ArticleTitle(article), 'stored')
+    self.assertEqual(self.creole.call_count, 0)
+
+  def testMissingTitle(self):
+    """Rows without title html have the title rendered, once."""
+    article = {'ID': 2, 'lastchange': '2020-04-30 10:14:46', 'title': 'a',
+               'titlehtml': None}
+    self.assertEqual(rendering.ArticleTitle(article), '<p>a</p>')
+    self.assertEqual(rendering.ArticleTitle(dict(article)), '<p>a</p>')
+    self.assertEqual(self.creole.call_count, 1)
+
+  def testComments(self):
+    """Comments are rendered once per ID."""
+    comments = [{'ID': 3, 'content': 'first'}, {'ID': 4, 'content': 'second'}]
+    rendering.AddCommentHtml(comments)
+    rendering.AddCommentHtml([dict(comment) for comment in comments])
+    self.assertEqual([comment['html'] for comment in comments],
+                     ['<p>first</p>', '<p>second</p>'])
+    self.assertEqual(self.creole.call_count, 2)
+
+  def testIndexText(self):
+    """Texts are cut to 50 words."""
+    self.assertEqual(rendering.indexText('a  b\nc'), 'a b c')
+    self.assertEqual(rendering.indexText(' '.join(['x'] * 50)),
+                     ' '.join(['x'] * 50) + ' ...')
+
+
+class RowsTest(unittest.TestCase):
+  """Tests the fragment keys of listing and comment rows."""
+
+  def setUp(self):
+    self.parser = mock.Mock()
+    self.parser.ParseFragment.side_effect = (
+        lambda template, key, **kwds: '<%s>' % (key,))
+
+  def testArticleRows(self):
+    """Article rows are keyed on ID, lastchange, comments and author."""
+    articles = [{'ID': 2, 'lastchange': '2020-04-30 10:14:46', 'comments': 3,
+                 'author': 'Elmer'},
+                {'ID': 1, 'lastchange': '2020-04-29 10:14:46', 'comments': 0,
+                 'author': 'Bugs'}]
+    rows = rendering.ArticleRows(self.parser, articles)
+    self.assertEqual(rows, "<(2, '2020-04-30 10:14:46', 3, 'Elmer')>"
+                           "<(1, '2020-04-29 10:14:46', 0, 'Bugs')>")
+    self.assertEqual(self.parser.ParseFragment.call_args[0][0],
+                     'blogpost.html')
+    self.assertIs(self.parser.ParseFragment.call_args[1]['article'],
+                  articles[1])
+
+  def testCommentRows(self):
+    """Comment rows are keyed on ID and the author as shown."""
+    comments = [{'ID': 7, 'user': {'author': 'Elmer', 'admin': 'false'}}]
+    self.assertEqual(rendering.CommentRows(self.parser, comments),
+                     "<(7, 'Elmer', 'false')>")
+    self.assertEqual(self.parser.ParseFragment.call_args[0][0],
+                     'comment.html')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+"""Tests for the compiled template parser in ublog.templating."""
+
+# Standard modules
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+# Third-party modules
+from uweb3 import templateparser
+
+# Application components
+from ublog import cache
+from ublog import templating
+
+
+class ParserTest(unittest.TestCase):
+  """Tests compiling a template directory and the static parse cache."""
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.path)
+    self._Write('footer.html', 'footer [year]')
+    os.mkdir(os.path.join(self.path, 'admin'))
+    self._Write('admin/stats.html', 'stats')
+    self._Write('notes.txt', 'not a template')
+
+  def _Write(self, name, text):
+    with open(os.path.join(self.path, name), 'w') as template:
+      template.write(text)
+
+  def testCompile(self):
+    """Every html template below the directory is compiled."""
+    parser = templating.Parser(self.path)
+    self.assertEqual(parser.Compile(), 2)
+    self.assertEqual(sorted(parser), ['admin/stats.html', 'footer.html'])
+
+  def testStrict(self):
+    """In strict mode a changed file is not read again."""
+    parser = templating.Parser(self.path, strict=True)
+    parser.Compile()
+    self._Write('footer.html', 'changed')
+    self.assertEqual(parser.Parse('footer.html', year=2020), 'footer 2020')
+
+  def testStrictMissing(self):
+    parser = templating.Parser(self.path, strict=True)
+    with self.assertRaises(templateparser.TemplateReadError):
+      parser.AddTemplate('missing.html')
+
+  def testParseStatic(self):
+    """In strict mode a template is parsed once for every key."""
+    parser = templating.Parser(self.path, strict=True)
+    with mock.patch.object(parser, 'Parse', return_value='footer') as parse:
+      for _repeat in range(3):
+        parser.ParseStatic('footer.html', (2020,), year=2020)
+      parser.ParseStatic('footer.html', (2021,), year=2021)
+    self.assertEqual(parse.call_count, 2)
+
+  def testParseStaticNotStrict(self):
+    """Without strict mode every call parses the template."""
+    parser = templating.Parser(self.path)
+    for _repeat in range(2):
+      self.assertEqual(parser.ParseStatic('footer.html', (2020,), year=2020),
+                       'footer 2020')
+    self.assertEqual(parser._static, {})
+
+  def testParseStaticBounded(self):
+    """The static outputs are dropped once STATIC_SIZE keys are held."""
+    parser = templating.Parser(self.path, strict=True)
+    with mock.patch.object(templating, 'STATIC_SIZE', 2):
+      for year in (2020, 2021, 2022):
+        parser.ParseStatic('footer.html', (year,), year=year)
+    self.assertEqual(list(parser._static), [('footer.html', (2022,))])
+
+
+class ParseFragmentTest(unittest.TestCase):
+  """Tests the rows kept in the fragment cache."""
+
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.path)
+    self._Write('row.html', 'row [title]')
+    cache.FRAGMENTS.backend.Clear()
+    self.addCleanup(cache.FRAGMENTS.backend.Clear)
+
+  def _Write(self, name, text, mtime=None):
+    filename = os.path.join(self.path, name)
+    with open(filename, 'w') as template:
+      template.write(text)
+    if mtime:
+      os.utime(filename, (mtime, mtime))
+
+  def testCached(self):
+    """A row is parsed once per key."""
+    parser = templating.Parser(self.path)
+    self.assertEqual(parser.ParseFragment('row.html', (1,), title='a'),
+                     'row a')
+    self.assertEqual(parser.ParseFragment('row.html', (1,), title='b'),
+                     'row a')
+    self.assertEqual(parser.ParseFragment('row.html', (2,), title='b'),
+                     'row b')
+
+  def testTemplateChanged(self):
+    """A template file with a new modification time is parsed again."""
+    parser = templating.Parser(self.path)
+    with mock.patch.object(parser, 'Parse', side_effect=['row a', 'new a']):
+      parser.ParseFragment('row.html', (1,), title='a')
+      self._Write('row.html', 'new [title]', mtime=10 ** 9)
+      self.assertEqual(parser.ParseFragment('row.html', (1,), title='a'),
+                       'new a')
+
+  def testStrictDigest(self):
+    """In strict mode rows are keyed on the digest of the template text."""
+    first = templating.Parser(self.path, strict=True)
+    first.Compile()
+    self.assertEqual(first.ParseFragment('row.html', (1,), title='a'),
+                     'row a')
+    self._Write('row.html', 'new [title]')
+    second = templating.Parser(self.path, strict=True)
+    second.Compile()
+    self.assertEqual(second.ParseFragment('row.html', (1,), title='a'),
+                     'new a')
+    self.assertEqual(first.ParseFragment('row.html', (1,), title='a'),
+                     'row a')
+
+
+class ConfigureTest(unittest.TestCase):
+  """Tests that the compiled parser is created once per directory."""
+
+  def testOnce(self):
+    path = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, path)
+    with mock.patch.dict(templating._parsers, clear=True):
+      parser = templating.Configure({'strict': 'True'}, path)
+      self.assertTrue(parser.strict)
+      self.assertIs(templating.Configure({'strict': 'True'}, path), parser)
+      self.assertIsNot(templating.Configure({}, path), parser)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+"""Tests for the request phase timings in ublog.timing."""
+
+# Standard modules
+import contextvars
+import threading
+import unittest
+from unittest import mock
+
+# Application components
+from ublog import timing
+
+
+class RequestTimerTest(unittest.TestCase):
+  """Tests that RequestTimer counts nested phases exclusively."""
+
+  def _Timer(self, clock):
+    """Returns a RequestTimer whose clock reads the given times in turn."""
+    patcher = mock.patch.object(timing.time, 'perf_counter',
+                                side_effect=clock)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    return timing.RequestTimer()
+
+  def testSinglePhase(self):
+    timer = self._Timer([0.0, 1.0, 3.0])
+    timer.Enter('db')
+    timer.Exit()
+    self.assertEqual(timer.phases['db'], 2.0)
+    self.assertEqual(timer.phases['template'], 0.0)
+
+  def testNested(self):
+    """Time in an inner phase is not counted for the outer one."""
+    timer = self._Timer([0.0, 1.0, 3.0, 7.0, 10.0])
+    timer.Enter('template')
+    timer.Enter('creole')
+    timer.Exit()
+    timer.Exit()
+    self.assertEqual(timer.phases['template'], 5.0)
+    self.assertEqual(timer.phases['creole'], 4.0)
+
+  def testDeeplyNested(self):
+    """Every level counts the time between its own inner phases."""
+    timer = self._Timer([0.0, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0])
+    timer.Enter('template')
+    timer.Enter('creole')
+    timer.Enter('db')
+    timer.Exit()
+    timer.Exit()
+    timer.Exit()
+    self.assertEqual(timer.phases, {'template': 1.0 + 16.0,
+                                    'creole': 2.0 + 8.0,
+                                    'db': 4.0,
+                                    'cookie': 0.0})
+
+  def testRepeated(self):
+    """Repeated phases add up."""
+    timer = self._Timer([0.0, 1.0, 2.0, 5.0, 9.0])
+    for _repeat in range(2):
+      timer.Enter('db')
+      timer.Exit()
+    self.assertEqual(timer.phases['db'], 5.0)
+
+  def testUnknownPhase(self):
+    """Phases outside PHASES are counted too."""
+    timer = self._Timer([0.0, 1.0, 1.5])
+    timer.Enter('export')
+    timer.Exit()
+    self.assertEqual(timer.phases['export'], 0.5)
+
+  def testServerTiming(self):
+    """The header lists every phase and the total in milliseconds."""
+    timer = self._Timer([0.0, 0.001, 0.003, 0.010, 0.010])
+    timer.Enter('db')
+    timer.Exit()
+    self.assertEqual(timer.ServerTiming(),
+                     'db;dur=2.0, template;dur=0.0, creole;dur=0.0, '
+                     'cookie;dur=0.0, total;dur=10.0')
+    self.assertEqual(timer.Milliseconds()['total'], 10.0)
+
+
+class PhaseTest(unittest.TestCase):
+  """Tests Phase and Timed for sampled and unsampled requests."""
+
+  def tearDown(self):
+    timing.Stop()
+
+  def testUnsampled(self):
+    """Requests that are not sampled get no timer."""
+    with mock.patch.object(timing, 'SAMPLE_RATE', 0.0):
+      self.assertIsNone(timing.Start())
+    with timing.Phase('db'):
+      self.assertIsNone(timing.Current())
+    self.assertEqual(timing.Timed('db', lambda value: value * 2)(21), 42)
+
+  def testSampled(self):
+    """Phase and Timed report to the timer of a sampled request."""
+    with mock.patch.object(timing, 'SAMPLE_RATE', 1.0):
+      timer = timing.Start()
+    self.assertIs(timing.Current(), timer)
+    with mock.patch.object(timer, 'Enter') as enter, \
+        mock.patch.object(timer, 'Exit') as leave:
+      with timing.Phase('db'):
+        pass
+      self.assertEqual(timing.Timed('creole', lambda: 'html')(), 'html')
+    self.assertEqual(enter.call_args_list, [mock.call('db'),
+                                            mock.call('creole')])
+    self.assertEqual(leave.call_count, 2)
+
+  def testExitOnError(self):
+    """A phase that raises still ends."""
+    with mock.patch.object(timing, 'SAMPLE_RATE', 1.0):
+      timer = timing.Start()
+    with self.assertRaises(ValueError):
+      with timing.Phase('db'):
+        raise ValueError
+    self.assertEqual(timer._stack, [])
+
+  def testTimedParser(self):
+    """Parse calls through a TimedParser count as template time."""
+    parser = mock.Mock()
+    parser.Parse.return_value = 'page'
+    with mock.patch.object(timing, 'SAMPLE_RATE', 1.0):
+      timer = timing.Start()
+    with mock.patch.object(timer, 'Enter') as enter, \
+        mock.patch.object(timer, 'Exit'):
+      self.assertEqual(timing.TimedParser(parser).Parse('index.html'), 'page')
+    enter.assert_called_once_with('template')
+    self.assertIs(timing.TimedParser(parser).AddTemplate,
+                  parser.AddTemplate)
+
+
+class QueryCounterTest(unittest.TestCase):
+  """Tests the counting of the statements of every request."""
+
+  def tearDown(self):
+    timing.Stop()
+
+  def testCounted(self):
+    """Statements count towards the running request until it stops."""
+    counter = timing.StartCounting()
+    timing.CountQuery(0.25)
+    timing.CountQuery(0.5)
+    self.assertEqual((counter.count, counter.seconds), (2, 0.75))
+    timing.Stop()
+    timing.CountQuery(1.0)
+    self.assertEqual(counter.count, 2)
+
+  def testOtherThread(self):
+    """Statements run in a copy of the request's context count as well."""
+    counter = timing.StartCounting()
+    thread = threading.Thread(target=contextvars.copy_context().run,
+                              args=(timing.CountQuery, 0.5))
+    thread.start()
+    thread.join()
+    self.assertEqual(counter.count, 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -2,13 +2,14 @@
 """Html generators for the ublog's admin pages."""
 
 import datetime
+import json
 import pymysql
 
 import uweb3
 # from underdark.libs.sqltalk import sqlresult
 from uweb3.ext_lib.libs.sqltalk import sqlresult
 
-from . import decorators, model
+from . import cache, decorators, logs, model, pool, profiling, rendering
 from uweb3.response import Redirect
 
 
@@ -18,6 +19,10 @@ class PageMaker(object):
 
   Each page as a separate method.
   """
+  # Users with more comments than this are deleted in the background, in
+  # transactions of PURGE_CHUNKSIZE rows.
+  PURGE_BACKGROUND_ROWS = 5000
+  PURGE_CHUNKSIZE = 500
 
   @decorators.adminonly
   @decorators.TemplateParser('admin/users.html', 'Users')
@@ -26,6 +31,29 @@ class PageMaker(object):
     return {'loggedinuser': self._GetUserLoggedIn(),
             'userlist': list(model.User.List(self.connection))}
 
+  @decorators.adminonly
+  @decorators.TemplateParser('admin/stats.html', 'Stats')
+  def Stats(self):
+    """Returns the stats.html template with query, cache and pool figures."""
+    stats = self._StatsDump()
+    for query in stats['queries']:
+      query['presenterlist'] = ', '.join(
+          '%s (%d)' % presenter for presenter in query['presenters'].items())
+    return stats
+
+  @decorators.adminonly
+  def StatsDump(self):
+    """Returns the figures of the stats page as JSON."""
+    return uweb3.Response(json.dumps(self._StatsDump(), indent=2),
+                          content_type='application/json')
+
+  def _StatsDump(self):
+    return {'profiling': profiling.ENABLED,
+            'queries': profiling.Stats(),
+            'caches': cache.Stats(),
+            'pool': pool.Stats(),
+            'droppedlogs': logs.Dropped()}
+
   @decorators.adminonly
   def User(self, userid, name, commentsPage=1, articlesPage=1):
     """Returns the edituser.html template."""
@@ -33,36 +61,32 @@ class PageMaker(object):
       user = model.User.FromPrimary(self.connection, userid)
     except uweb3.model.NotExistError:
       return Redirect('/users', httpcode=303)
-    commentslist = list(user.Comments(self.connection))
-    commentpagination = None
-    if commentslist:
-      if commentsPage is None:
-        commentsPage = 1
-      commentpagination = self.MakePagination(int(commentsPage),
-                                              len(commentslist))
-      if commentpagination:
-        commentslist = commentslist[10*(commentpagination['currentpage']-1):
-                                    10*commentpagination['currentpage']]
+    commentslist = []
+    commentpagination = self.MakePagination(int(commentsPage or 1),
+                                            user.CommentCount(self.connection))
+    if commentpagination:
+      commentslist = list(user.Comments(
+          self.connection,
+          offset=10*(commentpagination['currentpage']-1)))
       rowtype = True
       for comment in commentslist:
         rowtype = not rowtype
         comment['date'] = comment['date'].strftime('%Y-%m-%d %H:%M:%S')
         comment['rowtype'] = rowtype and 'Even' or 'Odd'
         comment['user'] = user
-        comment['article'] = model.Article.FromPrimary(self.connection,
-                                                       comment['article'])
         comment['check'] = True
+      rendering.AddCommentHtml(commentslist)
+    articlesPage = articlesPage if articlesPage else 1
     try:
-      articles = list(model.Article.User(self.connection, userid))
-    except (uweb3.model.NotExistError, ValueError, TypeError):
+      articlePagination = self.MakePagination(
+          int(articlesPage), model.Article.UserCount(self.connection, userid))
+    except (ValueError, TypeError):
       return Redirect('/', httpcode=303)
-    articlesPage = articlesPage if articlesPage else 1
-    articlePagination = None
-    articlePagination = self.MakePagination(int(articlesPage),
-                                            len(articles))
+    articles = []
     if articlePagination:
-      articles = articles[10*(articlePagination['currentpage']-1):
-                          10*articlePagination['currentpage']]
+      articles = rendering.AddExcerpts(list(model.Article.User(
+          self.connection, userid,
+          offset=10*(articlePagination['currentpage']-1))))
     loggedinuser = self._GetUserLoggedIn()
     return self.parser.Parse('admin/edituser.html', user=user,
                              commentslist=commentslist, commentform="",
@@ -107,6 +131,8 @@ class PageMaker(object):
     except pymysql.IntegrityError:
         message = 'The email has already been created.'
         return self.RequestMessage(message, 'Error', '/login')
+    self._InvalidateSidebar('authors')
+    self._PurgeAllPages()
     message = 'The changes have been saved.'
     return self.RequestMessage(message, 'Success', '/admin/users')
 
@@ -144,8 +170,27 @@ class PageMaker(object):
       user = model.User.FromPrimary(self.connection, userid)
     except uweb3.model.NotExistError:
       return Redirect('/admin/users', httpcode=303)
-    user.Delete(self.connection)
-    message = 'The user has been deleted.'
+    if user.CommentCount(self.connection) > self.PURGE_BACKGROUND_ROWS:
+      # The request connection returns to the pool when the response is sent,
+      # the background delete gets a connection of its own.
+      connectionpool = pool.Configure(self.options.get('mysql'))
+      connection = connectionpool.Checkout()
+
+      def _Done():
+        connectionpool.Checkin(connection)
+        self._InvalidateAll()
+      try:
+        user.Delete(connection, chunksize=self.PURGE_CHUNKSIZE,
+                    background=True, callback=_Done)
+      except Exception:
+        # Failed before the background thread took over the connection.
+        connectionpool.Checkin(connection)
+        raise
+      message = 'The user is being deleted in the background.'
+    else:
+      user.Delete(self.connection)
+      self._InvalidateAll()
+      message = 'The user has been deleted.'
     refresh = '/admin/users'
     return {'message': message, 'refresh': refresh, 'article': None}
     loggedinuser = self._GetUserLoggedIn()
@@ -162,7 +207,15 @@ class PageMaker(object):
       comment = model.Comment.FromPrimary(self.connection, commentid)
     except uweb3.model.NotExistError:
       return Redirect('/admin/users', httpcode=303)
+    articleid = comment['article']
+    if isinstance(articleid, dict):
+      articleid = articleid['ID']
     comment.Delete()
+    try:
+      article = model.Article.FromPrimary(self.connection, articleid)
+      self._PurgePages(article, [tag['name'] for tag in article.Tags()])
+    except uweb3.model.NotExistError:
+      self._PurgeAllPages()
     message = 'The comment has been deleted.'
     refresh = '/home'
     return {'message': message, 'refresh': refresh, 'article': None}
@@ -179,7 +232,11 @@ class PageMaker(object):
       article = model.Article.FromPrimary(self.connection, articleid)
     except uweb3.model.NotExistError:
       return Redirect('/', httpcode=303)
+    tags = [tag['name'] for tag in article.Tags()]
     article.Delete(self.connection)
+    self._InvalidateSidebar()
+    self._InvalidateCounts()
+    self._PurgePages(article, tags)
     message = 'The Article has been deleted.'
     refresh = '/home'
     return {'message': message, 'refresh': refresh, 'article': article}
@@ -198,7 +255,8 @@ class PageMaker(object):
     except (uweb3.model.NotExistError, ValueError):
       return Redirect('/', httpcode=303)
     try:
-      commentslist = list(article.Comments(self.connection))
+      commentslist = rendering.AddCommentHtml(
+          list(article.Comments(self.connection)))
       rowtype = True
       for comment in commentslist:
         comment['check'] = False
@@ -214,27 +272,68 @@ class PageMaker(object):
                                                  % article['title'],
                                                  javascripts=javascripts))
 
+  def _InvalidateSidebar(self, *blocks):
+    """Drops the cached sidebar datasets, all of them if none are given."""
+    cache.SIDEBAR.Invalidate('fingerprint',
+                             *(blocks or cache.SIDEBAR_BLOCKS))
+
+  def _PurgePages(self, article, tags=()):
+    """Purges the cached pages that show the given article.
+
+    Arguments:
+      article: the article that was written, deleted or commented on.
+      tags: iterable of the names of the tags the article has or had.
+    """
+    date = article['date']
+    if not isinstance(date, datetime.datetime):
+      date = datetime.datetime.strptime(str(date), '%Y-%m-%d %H:%M:%S')
+    author = article['user']
+    if isinstance(author, dict):
+      author = author['ID']
+    keys = [('Article', (int(article['ID']),)),
+            ('alltags', ()), ('allmonths', ()), ('allauthors', ())]
+    cache.PAGES.Invalidate(*(self._PageKey(key) for key in keys))
+    listings = [('ArticlesByDate', date.year, date.month),
+                ('ArticlesByDate', date.year, None),
+                ('ArticlesByUser', int(author))]
+    listings.extend(('ArticlesByTag', tag) for tag in tags)
+    for namespace in listings + ['index']:
+      cache.PAGES.NewGeneration(namespace)
+
+  def _PurgeAllPages(self):
+    """Purges every cached page, for writes that touch many articles."""
+    cache.PAGES.NewGeneration('pages')
+
+  def _InvalidateAll(self):
+    """Drops all cached data, for writes that touch many articles."""
+    self._InvalidateSidebar()
+    self._InvalidateCounts()
+    self._PurgeAllPages()
+
+  def _InvalidateCounts(self):
+    """Drops the cached article totals used for the index pagination."""
+    cache.COUNTS.Invalidate(('articles', True), ('articles', False))
+
   def SaveTags(self, tags, article):
-    """Saves all the given tags, and adds them to the article."""
+    """Makes the article carry exactly the given tags.
+
+    Tags that are empty or too long are skipped, the others are synced to the
+    article in a single transaction by model.Articletags.Sync.
+
+    Returns:
+      notification about skipped tags, an empty string if there were none.
+    """
     notification = ""
+    names = []
     for tag in tags:
       tag = tag.strip()
       if len(tag) > 0 and len(tag) < 25:
-        try:
-          tag = model.Tags.FromName(self.connection, tag)
-        except (uweb3.model.NotExistError, sqlresult.FieldError):
-          tag = model.Tags.Create(self.connection, {'name': tag[:25]})
-        try:
-          model.Articletags.FromPrimary(self.connection, (tag['ID'],
-                                                          article['ID']))
-        except uweb3.model.NotExistError:
-          model.Articletags.Create(self.connection,
-                                   {'tagid': tag['ID'],
-                                    'articleid': article['ID']})
-          pass
+        names.append(tag)
       elif len(tag) >= 25:
           notification += (
                    "tag '%s' has been skipped because it was too long" % tag)
+    model.Articletags.Sync(self.connection, article['ID'], names)
+    self._InvalidateSidebar('tagcloud', 'toptags')
     return notification
 
   @decorators.adminonly
@@ -260,11 +359,14 @@ class PageMaker(object):
     now = datetime.datetime.now()
     article['lastchange'] = now.strftime("%Y-%m-%d %H:%M:%S")
     article.Save()
-    model.Tags.removeFromArticle(self.connection, article['ID'])
-    notification = ''
-    if self.post.getfirst('tags'):
-      notification = self.SaveTags(self.post.getfirst('tags').split(','),
-                                   article)
+    rendering.Warm(article)
+    tags = set(tag['name'] for tag in article.Tags())
+    notification = self.SaveTags((self.post.getfirst('tags') or '').split(','),
+                                 article)
+    self._InvalidateSidebar()
+    self._InvalidateCounts()
+    tags.update(tag['name'] for tag in article.Tags())
+    self._PurgePages(article, tags)
     message = 'The changes have been saved. %s' % notification
     refresh = '/home'
     return {'message': message, 'refresh': refresh, 'article': article}
@@ -315,10 +417,14 @@ class PageMaker(object):
       article['date'] = now.strftime("%Y-%m-%d %H:%M:%S")
       article['lastchange'] = article['date']
       article = model.Article.Create(self.connection, article)
+      rendering.Warm(article)
       notification = ''
       if self.post.getfirst('tags'):
         notification = self.SaveTags(self.post.getfirst('tags').split(','),
                                      article)
+      self._InvalidateSidebar()
+      self._InvalidateCounts()
+      self._PurgePages(article, [tag['name'] for tag in article.Tags()])
       message = 'The article has been created. %s' % notification
       return self.RequestMessage(message, 'Success', '/home')
     else:
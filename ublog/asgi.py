@@ -0,0 +1,592 @@
+#!/usr/bin/python
+"""ASGI entry point for ublog, with async presenters for the read pages.
+
+Anonymous GET requests for the index, articles, listings and the all* pages
+are handled by AsyncPageMaker, which reads MySQL through an aiomysql pool so a
+slow query does not hold up a worker. Every other request is passed to the
+regular uWeb3 application, which runs in a thread of the default executor.
+
+The date, tag and author listings are streamed: the page up to the first row
+is sent before the rows are read, the rows follow as they come off a
+server-side cursor, then the rest of the page.
+
+Run it with any ASGI server, for example:
+
+  uvicorn ublog.asgi:application
+"""
+
+# Standard modules
+import asyncio
+import binascii
+import hashlib
+import http.cookies
+import io
+import os
+import re
+import sys
+import time
+import urllib.parse
+
+# Third-party modules
+import uweb3
+try:
+  import aiomysql
+except ImportError:
+  aiomysql = None
+
+# Application components
+from . import ROUTES
+from . import main as wsgi_main
+from . import cache
+from . import decorators
+from . import maintenance
+from . import model
+from . import pages
+from . import queries
+from . import rendering
+from . import templating
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+XSRF_MAX_AGE = 108000
+ROWS_PLACEHOLDER = 'ublog-rows-placeholder-3f0b2d8e'
+PAGESIZE = 10
+
+
+class Response(object):
+  """The status, headers and body an async presenter responds with."""
+
+  def __init__(self, content='', httpcode=200, headers=None):
+    self.content = content
+    self.httpcode = httpcode
+    self.headers = dict(headers or {})
+
+
+class StreamingResponse(Response):
+  """A Response whose body is sent in parts, as they are produced.
+
+  Arguments:
+    chunks: async iterable of str, the parts of the body.
+  """
+
+  def __init__(self, chunks, httpcode=200, headers=None):
+    super(StreamingResponse, self).__init__('', httpcode, headers)
+    self.chunks = chunks
+
+
+def Redirect(location, httpcode=303):
+  """Returns a Response that redirects the client to location."""
+  return Response(httpcode=httpcode, headers={'Location': location})
+
+
+class AsyncPageMaker(object):
+  """Async variants of the read-only presenters of pages.PageMaker.
+
+  The presenters render the same templates from the same data, and share the
+  sidebar, counts and page caches with the synchronous PageMaker.
+  """
+
+  XSRF_PLACEHOLDER = pages.PageMaker.XSRF_PLACEHOLDER
+  MakePagination = pages.PageMaker.MakePagination
+  _render_xsrf = None
+
+  def __init__(self, app, scope, cookies):
+    self.app = app
+    self.options = app.config
+    self.parser = app.parser
+    self.scope = scope
+    self.cookies = cookies
+    self.get = urllib.parse.parse_qs(scope.get('query_string', b'').decode(
+        'latin-1'))
+
+  async def _Fetch(self, name, **params):
+    """Returns the rows of one of the named queries as dictionaries."""
+    async with self.app.pool.acquire() as connection:
+      async with connection.cursor(aiomysql.DictCursor) as cursor:
+        await cursor.execute(queries.QUERIES[name], params)
+        return list(await cursor.fetchall())
+
+  async def _Rows(self, name, **params):
+    """Yields the rows of one of the named queries as the server sends them.
+
+    The rows are read through an unbuffered cursor, so they are not held in
+    memory all at once.
+    """
+    async with self.app.pool.acquire() as connection:
+      async with connection.cursor(aiomysql.SSDictCursor) as cursor:
+        await cursor.execute(queries.QUERIES[name], params)
+        while True:
+          rows = await cursor.fetchmany(PAGESIZE)
+          if not rows:
+            break
+          for row in rows:
+            yield row
+
+  async def _StoreRendered(self, rows):
+    """Fills in the excerpt and title html of listing rows missing either.
+
+    This is model._StoreRendered for the async presenters, run on a connection
+    of its own so it does not disturb a listing that is still streaming.
+    """
+    for article in rows:
+      if article['excerpt'] is None or article['titlehtml'] is None:
+        if article['excerpt'] is None:
+          content = await self._Fetch('article_content',
+                                      article=article['ID'])
+          article['excerpt'] = rendering.Excerpt(
+              content[0]['content'] if content else '')
+        if article['titlehtml'] is None:
+          article['titlehtml'] = rendering.TitleHtml(article['title'])
+        await self._Fetch('article_setrendered', article=article['ID'],
+                          excerpt=article['excerpt'],
+                          titlehtml=article['titlehtml'])
+    return rows
+
+  @staticmethod
+  def _ListingArticle(article):
+    """Shapes a listing row the way the templates expect model.Article."""
+    article['date'] = article['date'].strftime('%Y-%m-%d %H:%M:%S')
+    article['user'] = {'ID': article['user'], 'author': article['author']}
+    article['excerpt'] = rendering.ArticleExcerpt(article)
+    article['titlehtml'] = rendering.ArticleTitle(article)
+    return article
+
+  @classmethod
+  def _ListingArticles(cls, rows):
+    """Shapes listing rows the way the templates expect model.Article."""
+    return [cls._ListingArticle(article) for article in rows]
+
+  @decorators.AsyncPageCached(
+      key=lambda self, page=1, unpubpage=1: (int(page), self._GetBefore()),
+      generation='index')
+  async def Index(self, page=1, unpubpage=1):
+    """Returns the index.html template."""
+    count = await cache.COUNTS.AsyncGet(
+        ('articles', True), lambda: self._ArticleCount(True))
+    pagination = self.MakePagination(int(page), count)
+    articles = []
+    if pagination:
+      before = self._GetBefore()
+      rows = await self._Fetch(
+          'article_lastn', public='true', before=before, count=10,
+          offset=0 if before else 10 * (pagination['currentpage'] - 1))
+      articles = self._ListingArticles(await self._StoreRendered(rows))
+      pagination['before'] = articles[-1]['ID'] if articles else None
+    return self.parser.Parse('index.html', articles=articles,
+                             articlerows=rendering.ArticleRows(self.parser,
+                                                               articles),
+                             blogname=self.options['blog']['name'],
+                             pagination=pagination,
+                             unpubpagination=None,
+                             **await self.CommonBlocks('Index'))
+
+  async def _ArticleCount(self, public):
+    rows = await self._Fetch('article_count', public=str(public).lower())
+    return int(rows[0]['count'])
+
+  def _GetBefore(self):
+    """Returns the keyset pagination ID from the query string, if any."""
+    try:
+      return int(self.get['before'][0])
+    except (KeyError, ValueError):
+      return None
+
+  @decorators.AsyncPageCached(key=lambda self, number, title: (int(number),))
+  async def Article(self, number, title):
+    """Returns the singlepost.html template."""
+    rows = await self._Fetch('article_byid', article=int(number))
+    if not rows:
+      return Redirect('/')
+    article = rows[0]
+    tags, comments = await asyncio.gather(
+        self._Fetch('article_tags', article=article['ID']),
+        self._Fetch('article_comments', article=article['ID'],
+                    limit=10, offset=0))
+    article['date'] = article['date'].strftime('%Y-%m-%d %H:%M:%S')
+    article['user'] = {'ID': article['user'], 'author': article['author']}
+    article['html'] = rendering.ArticleHtml(article)
+    article['titlehtml'] = rendering.ArticleTitle(article)
+    first = article['content'].find("{{")
+    if first > 0:
+      last = article['content'].find("|", first)
+      article["image"] = article['content'][first+2:last]
+    else:
+      article["image"] = ""
+    rowtype = True
+    for comment in rendering.AddCommentHtml(comments):
+      rowtype = not rowtype
+      comment['date'] = comment['date'].strftime('%Y-%m-%d %H:%M:%S')
+      comment['rowtype'] = rowtype and 'Even' or 'Odd'
+      comment['user'] = {'ID': comment['user'], 'author': comment['author'],
+                         'admin': comment['admin']}
+    return self.parser.Parse('singlepost.html', article=article, tags=tags,
+                             commentslist=comments,
+                             commentrows=rendering.CommentRows(self.parser,
+                                                               comments),
+                             user=None,
+                             **await self.CommonBlocks(
+                                 article['title'],
+                                 javascripts=['validate.js', 'newcomment.js'],
+                                 OGdata=article))
+
+  @decorators.AsyncPageCached(
+      key=lambda self, year, month=None: (int(year), month and int(month),
+                                          self._GetPage()),
+      generation=lambda self, year, month=None: (
+          'ArticlesByDate', int(year), month and int(month)))
+  async def ArticlesByDate(self, year, month=None):
+    """Streams a page of the articles.html template by date."""
+    try:
+      if month:
+        daterange = model.MonthRange(int(year), int(month))
+        title = 'Month: %s %s' % (year, month)
+        page = 'Month: %s %s' % (month, year)
+      else:
+        daterange = model.YearRange(int(year))
+        title = page = 'Year: %s' % year
+    except ValueError:
+      return Redirect('/')
+    return await self._Listing('article_daterange', title, page, **daterange)
+
+  @decorators.AsyncPageCached(
+      key=lambda self, tag: (tag.replace('&-#', '/'), self._GetPage()),
+      generation=lambda self, tag: ('ArticlesByTag', tag.replace('&-#', '/')))
+  async def ArticlesByTag(self, tag):
+    """Streams a page of the articles.html template by tag."""
+    tag = tag.replace('&-#', '/')
+    title = 'Tag: %s' % tag
+    return await self._Listing('article_tag', title, title, tag=tag)
+
+  @decorators.AsyncPageCached(
+      key=lambda self, user, title: (int(user), self._GetPage()),
+      generation=lambda self, user, title: ('ArticlesByUser', int(user)))
+  async def ArticlesByUser(self, user, title):
+    """Streams a page of the articles.html template by user."""
+    authors = await self._Fetch('user_byid', user=int(user))
+    if authors:
+      title = 'Author: %s' % authors[0]['author']
+      return await self._Listing('article_user', title, title, user=int(user))
+    title = 'no user found'
+    return Response(self.parser.Parse('articles.html', title=title,
+                                      articlerows='', pagination=None,
+                                      path=self.scope['path'],
+                                      **await self.CommonBlocks(title)),
+                    httpcode=404)
+
+  def _GetPage(self):
+    """Returns the page number from the query string, 1 if there is none."""
+    try:
+      return max(int(self.get['page'][0]), 1)
+    except (KeyError, ValueError):
+      return 1
+
+  async def _Listing(self, name, title, page, **params):
+    """Returns a StreamingResponse for a page of a paginated listing.
+
+    Arguments:
+      name: the listing query, the query name + '_count' counts its rows.
+      title: the heading of the listing.
+      page: the page name for the header.
+      **params: the parameters of both queries.
+    """
+    rows = await self._Fetch(name + '_count', **params)
+    pagination = self.MakePagination(self._GetPage(), int(rows[0]['count']))
+    html = str(self.parser.Parse('articles.html', title=title,
+                                 articlerows=ROWS_PLACEHOLDER,
+                                 pagination=pagination,
+                                 path=self.scope['path'],
+                                 **await self.CommonBlocks(page)))
+    before, _sep, after = html.partition(ROWS_PLACEHOLDER)
+    rows = None
+    if pagination:
+      rows = self._Rows(name, count=PAGESIZE,
+                        offset=PAGESIZE * (pagination['currentpage'] - 1),
+                        **params)
+    return StreamingResponse(self._ListingChunks(before, rows, after))
+
+  async def _ListingChunks(self, before, rows, after):
+    """Yields the page up to the rows, a chunk per row, and the rest."""
+    yield before
+    if rows is not None:
+      async for article in rows:
+        await self._StoreRendered([article])
+        yield rendering.ArticleRows(self.parser,
+                                    [self._ListingArticle(article)])
+    yield after
+
+  @decorators.AsyncPageCached()
+  async def alltags(self):
+    """Returns the alltags.html template."""
+    return self.parser.Parse('alltags.html', tags=await self._Sidebar(
+        'tagcloud'), **await self.CommonBlocks('alltags'))
+
+  @decorators.AsyncPageCached()
+  async def allauthors(self):
+    """Returns the allauthors.html template."""
+    return self.parser.Parse('allauthors.html', users=await self._Sidebar(
+        'authors'), **await self.CommonBlocks('allauthors'))
+
+  @decorators.AsyncPageCached()
+  async def allmonths(self):
+    """Returns the allmonths.html template."""
+    return self.parser.Parse('allmonths.html', menuitems=await self._Sidebar(
+        'activemonths'), **await self.CommonBlocks('allmonths'))
+
+  async def CommonBlocks(self, page, javascripts=None, OGdata=None):
+    """Returns a dictionary with the header and footer in it."""
+    xsrftoken = self._GetXSRF()
+    blogOptions = self.options['blog']
+    tags, users, menuitems = await self._SidebarMenus()
+    return {
+        'header': self.parser.Parse('header.html',
+                                    blogname=blogOptions['name'],
+                                    blogtitle=blogOptions['title'],
+                                    blogsubtitle=blogOptions['subtitle'],
+                                    blogurl=blogOptions['url'], page=page,
+                                    javascripts=javascripts,
+                                    menuitems=menuitems, tags=tags, user=None,
+                                    xsrftoken=xsrftoken,
+                                    users=users, OGdata=OGdata),
+        'footer': self.parser.ParseStatic(
+            'footer.html', (time.strftime('%Y'), blogOptions['title'], False),
+            blogcopyright=time.strftime('%Y'), blogtitle=blogOptions['title'],
+            user=None, blogpoweredby=uweb3.__version__),
+        'xsrftoken': xsrftoken}
+
+  async def _Sidebar(self, block):
+    """Returns the full dataset for one of the sidebar blocks."""
+    name, params = queries.SIDEBAR[block]
+    return await cache.SIDEBAR.AsyncGet(
+        block, lambda: self._Fetch(name, **params))
+
+  async def _SidebarMenus(self):
+    """Loads the three sidebar menus concurrently."""
+    tags, users, menuitems = await asyncio.gather(
+        self._Sidebar('toptags'), self._Sidebar('authors'),
+        self._Sidebar('activemonths'))
+    return tags, users[:10], menuitems[:10]
+
+  async def _SidebarFingerprint(self):
+    """Returns a digest of the sidebar menus as shown on every page."""
+    async def fingerprint():
+      return hashlib.sha1(repr(await self._SidebarMenus()).encode(
+          'utf-8')).hexdigest()
+    return await cache.SIDEBAR.AsyncGet('fingerprint', fingerprint)
+
+  def _GetXSRF(self):
+    return self._render_xsrf or self.cookies.get('xsrf')
+
+  async def _CachedPage(self, key, generation, render):
+    """Returns the page for key from the page cache, rendering it on a miss.
+
+    This is the counterpart of PageMaker._CachedPage. Pages rendered here carry
+    no validators, so they are not answered with 304 from the cache. A
+    streamed page is stored once all of it has been sent.
+    """
+    key = (cache.PAGES.Generation('pages'),
+           generation and cache.PAGES.Generation(generation), key)
+    fingerprint = await self._SidebarFingerprint()
+    entry = cache.PAGES.Peek(key)
+    if entry is None or entry[0] != fingerprint:
+      self._render_xsrf = self.XSRF_PLACEHOLDER
+      try:
+        page = await render()
+      finally:
+        self._render_xsrf = None
+      if isinstance(page, StreamingResponse):
+        page.chunks = self._StoreChunks(key, fingerprint, page.chunks)
+        return page
+      if not isinstance(page, str):
+        page.content = page.content.replace(self.XSRF_PLACEHOLDER,
+                                            str(self._GetXSRF()))
+        return page
+      entry = fingerprint, str(page), None
+      cache.PAGES.Set(key, entry)
+    return Response(entry[1].replace(self.XSRF_PLACEHOLDER,
+                                     str(self._GetXSRF())))
+
+  async def _StoreChunks(self, key, fingerprint, chunks):
+    """Passes on the chunks of a page, and caches the page at the end."""
+    parts = []
+    async for chunk in chunks:
+      parts.append(chunk)
+      yield chunk.replace(self.XSRF_PLACEHOLDER, str(self._GetXSRF()))
+    cache.PAGES.Set(key, (fingerprint, ''.join(parts), None))
+
+
+class Application(object):
+  """ASGI application serving ublog.
+
+  The [mysql] section of the configuration provides the database for the
+  aiomysql pool, which is created on the first request or at lifespan startup.
+  """
+
+  PRESENTERS = ('Index', 'Article', 'ArticlesByDate', 'ArticlesByTag',
+                'ArticlesByUser', 'alltags', 'allauthors', 'allmonths')
+
+  def __init__(self, config_path=maintenance.CONFIG):
+    if aiomysql is None:
+      raise ImportError('The ASGI application requires aiomysql.')
+    self.config = maintenance.ReadConfig(config_path)
+    cache.Configure(self.config['cache'] if 'cache' in self.config else None)
+    self.parser = templating.Configure(
+        self.config['templates'] if 'templates' in self.config else None,
+        os.path.join(PATH, 'templates'))
+    self.parser.RegisterFunction('creole', rendering.Creole)
+    self.parser.RegisterFunction('indextext', rendering.indexText)
+    self.parser.RegisterFunction('slashfilter', pages.slashfilter)
+    self.routes = [(re.compile('^%s$' % pattern), name)
+                   for pattern, name in ROUTES]
+    self.wsgi = wsgi_main()
+    self.pool = None
+    self._poollock = asyncio.Lock()
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] == 'lifespan':
+      return await self._Lifespan(receive, send)
+    if scope['type'] != 'http':
+      return
+    if self.pool is None:
+      await self._StartPool()
+    headers = dict((name.decode('latin-1').lower(), value.decode('latin-1'))
+                   for name, value in scope['headers'])
+    cookies = dict((name, morsel.value) for name, morsel in
+                   http.cookies.SimpleCookie(headers.get('cookie', '')).items())
+    presenter, args = self._Route(scope['path'])
+    if scope['method'] != 'GET' or 'login' in cookies or presenter is None:
+      return await self._Fallback(scope, receive, send)
+    if 'xsrf' not in cookies:
+      cookies['xsrf'] = binascii.hexlify(os.urandom(16)).decode('ascii')
+    pagemaker = AsyncPageMaker(self, scope, cookies)
+    response = await getattr(pagemaker, presenter)(*args)
+    response.headers.setdefault('Content-Type', 'text/html; charset=utf-8')
+    headers = [(name, value) for name, value in response.headers.items()]
+    headers.append(('Set-Cookie', 'xsrf=%s; Max-Age=%d; Path=/' % (
+        cookies['xsrf'], XSRF_MAX_AGE)))
+    if isinstance(response, StreamingResponse):
+      return await self._Stream(send, response.httpcode, headers,
+                                response.chunks)
+    await self._Send(send, response.httpcode, headers,
+                     response.content.encode('utf-8'))
+
+  def _Route(self, path):
+    """Returns the async presenter and its arguments for path, if there is one.
+
+    The first matching route decides, as in uWeb3, so paths that are routed
+    to a presenter without an async variant return (None, ()).
+    """
+    for pattern, name in self.routes:
+      match = pattern.match(path)
+      if match:
+        if name in self.PRESENTERS:
+          return name, [arg for arg in match.groups()]
+        return None, ()
+    return None, ()
+
+  async def _StartPool(self):
+    async with self._poollock:
+      if self.pool is None:
+        options = self.config['mysql']
+        self.pool = await aiomysql.create_pool(
+            host=options.get('host', 'localhost'),
+            user=options.get('user'),
+            password=options.get('password'),
+            db=options.get('database'),
+            charset='utf8',
+            autocommit=True,
+            maxsize=int(options.get('pool_size', 4)),
+            pool_recycle=int(options.get('pool_recycle', 3600)))
+
+  async def _Lifespan(self, receive, send):
+    while True:
+      message = await receive()
+      if message['type'] == 'lifespan.startup':
+        await self._StartPool()
+        await send({'type': 'lifespan.startup.complete'})
+      elif message['type'] == 'lifespan.shutdown':
+        if self.pool is not None:
+          self.pool.close()
+          await self.pool.wait_closed()
+        await send({'type': 'lifespan.shutdown.complete'})
+        return
+
+  @staticmethod
+  async def _Send(send, status, headers, body):
+    await send({'type': 'http.response.start',
+                'status': status,
+                'headers': [(name.encode('latin-1'), str(value).encode(
+                    'latin-1')) for name, value in headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+  @staticmethod
+  async def _Stream(send, status, headers, chunks):
+    """Sends the response headers, then each chunk as soon as it is made."""
+    await send({'type': 'http.response.start',
+                'status': status,
+                'headers': [(name.encode('latin-1'), str(value).encode(
+                    'latin-1')) for name, value in headers]})
+    async for chunk in chunks:
+      if chunk:
+        await send({'type': 'http.response.body',
+                    'body': chunk.encode('utf-8'), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+  async def _Fallback(self, scope, receive, send):
+    """Runs the request through the synchronous uWeb3 application."""
+    body = []
+    while True:
+      message = await receive()
+      body.append(message.get('body', b''))
+      if not message.get('more_body'):
+        break
+    environ = self._Environ(scope, b''.join(body))
+    status, headers, content = await asyncio.get_running_loop(
+        ).run_in_executor(None, self._RunWsgi, environ)
+    await self._Send(send, status, headers, content)
+
+  def _RunWsgi(self, environ):
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+      response['status'] = int(status.split(' ', 1)[0])
+      response['headers'] = headers
+
+    result = self.wsgi(environ, start_response)
+    try:
+      content = b''.join(result)
+    finally:
+      if hasattr(result, 'close'):
+        result.close()
+    return response['status'], response['headers'], content
+
+  @staticmethod
+  def _Environ(scope, body):
+    """Returns the WSGI environment for an ASGI http scope."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {'REQUEST_METHOD': scope['method'],
+               'SCRIPT_NAME': scope.get('root_path', ''),
+               'PATH_INFO': scope['path'],
+               'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+               'SERVER_NAME': server[0],
+               'SERVER_PORT': str(server[1]),
+               'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+               'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+               'wsgi.version': (1, 0),
+               'wsgi.url_scheme': scope.get('scheme', 'http'),
+               'wsgi.input': io.BytesIO(body),
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': True,
+               'wsgi.multiprocess': False,
+               'wsgi.run_once': False}
+    for name, value in scope['headers']:
+      name = name.decode('latin-1').upper().replace('-', '_')
+      value = value.decode('latin-1')
+      if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+        environ[name] = value
+      elif 'HTTP_' + name in environ:
+        environ['HTTP_' + name] += ',' + value
+      else:
+        environ['HTTP_' + name] = value
+    return environ
+
+
+application = Application() if aiomysql is not None else None
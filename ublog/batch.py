@@ -0,0 +1,131 @@
+#!/usr/bin/python
+"""Runs the independent queries of a single page in parallel.
+
+A QueryBatch collects named queries from ublog.queries and runs them all at
+once, each on a connection of its own from the connection pool, so a page
+waits for its slowest query instead of the sum of all of them.
+
+Batching multiple statements into one round trip is not used, as the sqltalk
+cursor only returns the result of the first statement.
+"""
+
+# Standard modules
+import concurrent.futures
+import contextvars
+import threading
+import time
+
+# Application components
+from . import pool
+from . import profiling
+from . import queries
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _Executor(workers):
+  """Returns the shared thread pool, growing it if more workers are needed.
+
+  A pool that is replaced is shut down without waiting, so its threads exit
+  once the queries already submitted to it have run.
+  """
+  global _executor
+  with _executor_lock:
+    if _executor is None or _executor._max_workers < workers:
+      previous = _executor
+      _executor = concurrent.futures.ThreadPoolExecutor(
+          max_workers=workers, thread_name_prefix='ublog-query')
+      if previous is not None:
+        previous.shutdown(wait=False)
+    return _executor
+
+
+class QueryBatch(object):
+  """A set of independent queries that are run together.
+
+  The optional connection is used for queries that find the pool exhausted,
+  usually the connection of the request that builds the batch.
+
+  Usage:
+    batch = QueryBatch(pool.POOL, connection)
+    batch.Add('tags', 'article_tags', article=1)
+    batch.Add('comments', 'article_comments', article=1, limit=10, offset=0)
+    results = batch.Run()
+    results['tags']  # list of rows
+
+  After Run, `timings` holds a dictionary for each query with its key, query
+  name, the number of rows and the seconds it took.
+  """
+
+  def __init__(self, connectionpool, connection=None):
+    self.pool = connectionpool
+    self.connection = connection
+    self.queries = []
+    self.timings = []
+    self._lock = threading.Lock()
+
+  def Add(self, key, name, **params):
+    """Adds the named query, its rows will be returned under key."""
+    self.queries.append((key, name, params))
+
+  def _Execute(self, name, params):
+    """Runs a query on a pooled connection.
+
+    When the pool has no connection to spare, the query runs on the batch's
+    own connection instead, one at a time, so a busy pool slows a batch down
+    rather than making it wait for connections held by other requests.
+    """
+    try:
+      pooled = self.pool.Checkout(timeout=0 if self.connection else None)
+    except pool.PoolExhaustedError:
+      if self.connection is None:
+        raise
+      with self._lock:
+        return self._Query(self.connection, name, params)
+    try:
+      return self._Query(pooled, name, params)
+    finally:
+      self.pool.Checkin(pooled)
+
+  @staticmethod
+  def _Query(connection, name, params):
+    start = time.perf_counter()
+    with connection as cursor:
+      rows = [dict(row) for row in queries.Execute(
+          connection, cursor, name, **params)]
+    return rows, time.perf_counter() - start
+
+  def Run(self):
+    """Runs all added queries and returns a dictionary of their rows by key.
+
+    A single query is run in the calling thread, on the batch's own connection
+    if it has one. Errors raised by any of the queries are raised here after
+    all of them have finished.
+    """
+    if len(self.queries) == 1:
+      key, name, params = self.queries[0]
+      if self.connection is not None:
+        outcomes = [(key, name, self._Query(self.connection, name, params))]
+      else:
+        outcomes = [(key, name, self._Execute(name, params))]
+    else:
+      executor = _Executor(self.pool.size)
+      token = profiling.PRESENTER.set(
+          profiling.CurrentPresenter() if profiling.ENABLED else None)
+      try:
+        futures = [(key, name, executor.submit(
+            contextvars.copy_context().run, self._Execute, name, params))
+                   for key, name, params in self.queries]
+      finally:
+        profiling.PRESENTER.reset(token)
+      concurrent.futures.wait([future for _key, _name, future in futures])
+      outcomes = [(key, name, future.result())
+                  for key, name, future in futures]
+    results = {}
+    for key, name, (rows, seconds) in outcomes:
+      results[key] = rows
+      self.timings.append({'key': key, 'query': name, 'rows': len(rows),
+                           'seconds': seconds})
+    self.queries = []
+    return results
@@ -0,0 +1,278 @@
+#!/usr/bin/python
+"""Process-wide caches for ublog, with an optional cross-process backend.
+
+Each Cache instance is a named keyspace on a shared storage backend. By default
+values are held in a dictionary in the running process. When the [cache]
+section of the configuration selects the memcached backend, values are pickled
+and shared between all workers, so an invalidation in one worker is seen by
+all of them.
+
+An invalidation on the memory backend only reaches the worker that made it.
+Other workers keep serving what they stored until it reaches its max_age, so
+sites run with more than one worker should use memcached, or keep max_age as
+short as they can stand stale pages.
+"""
+
+# Standard modules
+import collections
+import binascii
+import hashlib
+import os
+import pickle
+import threading
+import time
+
+# Third-party modules
+try:
+  from pymemcache.client import hash as memcache_hash
+except ImportError:
+  memcache_hash = None
+
+SIDEBAR_BLOCKS = ('tagcloud', 'toptags', 'authors', 'activemonths')
+
+
+class MemoryBackend(object):
+  """Stores values in a dictionary local to the running process.
+
+  When a maxsize is given, the least recently used entries are evicted once
+  more than maxsize values are stored. When a max_age is given, values are
+  dropped once they were stored longer than max_age seconds ago.
+  """
+
+  def __init__(self, maxsize=None, max_age=None):
+    self.maxsize = maxsize
+    self.max_age = max_age
+    self._store = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def Get(self, key):
+    """Returns the value stored under key, raises KeyError if there is none."""
+    with self._lock:
+      expires, value = self._store[key]
+      if expires is not None and expires <= time.monotonic():
+        del self._store[key]
+        raise KeyError(key)
+      if self.maxsize:
+        self._store.move_to_end(key)
+      return value
+
+  def Set(self, key, value):
+    """Stores the value under the given key."""
+    expires = time.monotonic() + self.max_age if self.max_age else None
+    with self._lock:
+      self._store[key] = expires, value
+      if self.maxsize:
+        self._store.move_to_end(key)
+        while len(self._store) > self.maxsize:
+          self._store.popitem(last=False)
+
+  def Delete(self, keys):
+    """Removes the given keys, ignoring those that are not present."""
+    with self._lock:
+      for key in keys:
+        self._store.pop(key, None)
+
+  def Clear(self):
+    """Removes all stored values."""
+    with self._lock:
+      self._store.clear()
+
+
+class MemcachedBackend(object):
+  """Stores pickled values in memcached so all workers share them."""
+
+  def __init__(self, servers, prefix='ublog'):
+    if memcache_hash is None:
+      raise ImportError('The memcached cache backend requires pymemcache.')
+    self.prefix = prefix
+    self.client = memcache_hash.HashClient(
+        [self._ParseServer(server) for server in servers],
+        serializer=self._Serialize, deserializer=self._Deserialize,
+        ignore_exc=True)
+
+  @staticmethod
+  def _ParseServer(server):
+    host, _sep, port = server.strip().partition(':')
+    return host, int(port or 11211)
+
+  @staticmethod
+  def _Serialize(key, value):
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL), 1
+
+  @staticmethod
+  def _Deserialize(key, value, flags):
+    return pickle.loads(value)
+
+  def _Key(self, key):
+    """Memcached keys are limited in size and may not contain whitespace."""
+    return '%s:%s' % (self.prefix, hashlib.sha1(
+        repr(key).encode('utf-8')).hexdigest())
+
+  def Get(self, key):
+    """Returns the value stored under key, raises KeyError if there is none."""
+    value = self.client.get(self._Key(key))
+    if value is None:
+      raise KeyError(key)
+    return value
+
+  def Set(self, key, value):
+    """Stores the value under the given key."""
+    self.client.set(self._Key(key), value)
+
+  def Delete(self, keys):
+    """Removes the given keys from memcached."""
+    self.client.delete_many([self._Key(key) for key in keys])
+
+  def Clear(self):
+    """Memcached is shared, so clearing it is left to the administrator."""
+
+
+class Cache(object):
+  """A named keyspace on a storage backend, with hit and miss counters.
+
+  The maxsize applies when the cache has a backend of its own in memory, a
+  shared memcached backend does its own eviction.
+  """
+
+  def __init__(self, name, maxsize=None, backend=None):
+    self.name = name
+    self.maxsize = maxsize
+    self.backend = backend or MemoryBackend(maxsize)
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+    self._lock = threading.Lock()
+
+  def Get(self, key, loader):
+    """Returns the cached value for key, calling loader to fill it on a miss.
+
+    Arguments:
+      key: hashable, identifies the value within this cache.
+      loader: callable, takes no arguments and returns the value to store.
+    """
+    try:
+      value = self.backend.Get((self.name, key))
+    except KeyError:
+      with self._lock:
+        self.misses += 1
+      value = loader()
+      self.backend.Set((self.name, key), value)
+      return value
+    with self._lock:
+      self.hits += 1
+    return value
+
+  async def AsyncGet(self, key, loader):
+    """Returns the cached value for key, awaiting loader to fill it on a miss.
+
+    Arguments:
+      key: hashable, identifies the value within this cache.
+      loader: coroutine function, takes no arguments and returns the value.
+    """
+    try:
+      value = self.backend.Get((self.name, key))
+    except KeyError:
+      with self._lock:
+        self.misses += 1
+      value = await loader()
+      self.backend.Set((self.name, key), value)
+      return value
+    with self._lock:
+      self.hits += 1
+    return value
+
+  def Peek(self, key):
+    """Returns the cached value for key, or None if it is not cached."""
+    try:
+      value = self.backend.Get((self.name, key))
+    except KeyError:
+      with self._lock:
+        self.misses += 1
+      return None
+    with self._lock:
+      self.hits += 1
+    return value
+
+  def Set(self, key, value):
+    """Stores a value under the given key."""
+    self.backend.Set((self.name, key), value)
+
+  def Generation(self, namespace):
+    """Returns the current generation token of a namespace.
+
+    Including the token in keys lets a whole namespace be dropped at once
+    through NewGeneration, also on backends that cannot enumerate their keys.
+    """
+    return self.Get(('generation', namespace), self._NewToken)
+
+  def NewGeneration(self, namespace):
+    """Makes all keys built from the previous generation unreachable."""
+    self.backend.Set((self.name, ('generation', namespace)), self._NewToken())
+    with self._lock:
+      self.invalidations += 1
+
+  @staticmethod
+  def _NewToken():
+    return binascii.hexlify(os.urandom(8)).decode('ascii')
+
+  def Invalidate(self, *keys):
+    """Drops the given keys so their next Get reloads them."""
+    self.backend.Delete([(self.name, key) for key in keys])
+    with self._lock:
+      self.invalidations += len(keys)
+
+  def Stats(self):
+    """Returns a dictionary with the counters of this cache."""
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {'name': self.name,
+              'backend': type(self.backend).__name__,
+              'hits': self.hits,
+              'misses': self.misses,
+              'invalidations': self.invalidations,
+              'hitratio': float(self.hits) / lookups if lookups else 0.0}
+
+
+SIDEBAR = Cache('sidebar')
+COUNTS = Cache('counts')
+RENDERED = Cache('rendered', maxsize=2000)
+PAGES = Cache('pages', maxsize=500)
+FRAGMENTS = Cache('fragments', maxsize=5000)
+CACHES = [SIDEBAR, COUNTS, RENDERED, PAGES, FRAGMENTS]
+
+_configured = None
+
+
+def Configure(options):
+  """Selects the storage backend for all caches from the [cache] section.
+
+  Recognised options:
+    backend: 'memory' (default) or 'memcached'.
+    servers: comma separated host:port list for the memcached backend.
+    prefix: key prefix for the memcached backend, default 'ublog'.
+    max_age: seconds the memory backend keeps a value, 0 or absent to keep
+        it until it is invalidated or evicted.
+    <name>_size: maximum number of entries in the named in-memory cache.
+
+  Calling this again with the same options is a no-op, so it is safe to call
+  on every request.
+  """
+  global _configured
+  options = dict(options or {})
+  if options == _configured:
+    return
+  shared = None
+  if options.get('backend', 'memory') == 'memcached':
+    servers = options.get('servers', 'localhost:11211').split(',')
+    shared = MemcachedBackend(servers, prefix=options.get('prefix', 'ublog'))
+  max_age = float(options.get('max_age') or 0) or None
+  for cache in CACHES:
+    if '%s_size' % cache.name in options:
+      cache.maxsize = int(options['%s_size' % cache.name])
+    cache.backend = shared or MemoryBackend(cache.maxsize, max_age)
+  _configured = options
+
+
+def Stats():
+  """Returns the counters of all caches."""
+  return [cache.Stats() for cache in CACHES]
@@ -1,4 +1,5 @@
 """This file holds all the decorators we use in this project"""
+import functools
 import uweb3
 from uweb3.response import Redirect
 
@@ -41,6 +42,47 @@ def checkxsrf(f):
     return wrapper
 
 
+def PageCached(key=None, generation=None):
+    """Decorator that serves anonymous GET requests from the page cache.
+
+    Arguments:
+      key: callable (opt), receives the pagemaker and the route arguments and
+          returns the tuple that identifies the page. Defaults to the route
+          arguments themselves.
+      generation: str (opt), namespace whose generation is part of the key, so
+          all pages in it can be purged at once. May also be a callable like
+          key, for a namespace per set of route arguments, such as all pages
+          of one paginated listing.
+    """
+    def cache_decorator(f):
+      def wrapper(*args, **kwargs):
+        pageargs = key(*args, **kwargs) if key else tuple(args[1:])
+        namespace = (generation(*args, **kwargs) if callable(generation)
+                     else generation)
+        return args[0]._CachedPage((f.__name__, pageargs), namespace,
+                                   lambda: f(*args, **kwargs))
+      return wrapper
+    return cache_decorator
+
+
+def AsyncPageCached(key=None, generation=None):
+    """Decorator that serves a coroutine presenter from the page cache.
+
+    Takes the same arguments as PageCached and uses the same page keys, so
+    pages rendered by the synchronous and the asynchronous presenters are
+    interchangeable.
+    """
+    def cache_decorator(f):
+      async def wrapper(*args, **kwargs):
+        pageargs = key(*args, **kwargs) if key else tuple(args[1:])
+        namespace = (generation(*args, **kwargs) if callable(generation)
+                     else generation)
+        return await args[0]._CachedPage((f.__name__, pageargs), namespace,
+                                         lambda: f(*args, **kwargs))
+      return wrapper
+    return cache_decorator
+
+
 import sys
 PYTHON_VERSION = 2
 if (sys.version_info > (3, 0)):
@@ -50,6 +92,7 @@ def TemplateParser(template, *t_args, **t_kwargs):
     """Decorator that wraps the output in a templateparser call if its not
     already something that we prepared for direct output to the client"""
     def template_decorator(f):
+      @functools.wraps(f)
       def wrapper(*args, **kwargs):
         pageresult = f(*args, **kwargs) or {}
         if (
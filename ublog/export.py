@@ -0,0 +1,258 @@
+#!/usr/bin/python
+"""Exports the public pages of the blog as static html files.
+
+Every public page is rendered by the uWeb3 application itself, so the files
+are what an anonymous visitor would be served. A manifest in the output
+directory records a digest of the data each page was built from; later runs
+only render the pages whose digest changed, and remove the pages that no
+longer exist. Pages are rendered by a pool of worker processes.
+
+The files are named after the decoded request path, '/' is index.html, other
+pages get .html appended. Forms on the pages carry the xsrf placeholder of
+the page cache, which nginx replaces by the visitor's cookie. Of paginated
+listings the first page is exported. Requests with a query string, and
+visitors that are logged in or have no xsrf cookie yet, are sent to the
+application:
+
+  map "$cookie_login:$args:$cookie_xsrf" $ublog_static {
+    "~^::."  $uri;
+    default /-;
+  }
+  location / {
+    root /var/www/ublog-static;
+    sub_filter ublog-xsrf-placeholder-9c1e5f7a $cookie_xsrf;
+    sub_filter_once off;
+    try_files $ublog_static.html $ublog_static/index.html @ublog;
+  }
+
+Run it through manage.py:
+
+  python manage.py export-static /var/www/ublog-static
+"""
+
+# Standard modules
+import concurrent.futures
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+import urllib.parse
+
+# Third-party modules
+import uweb3
+
+# Application components
+from . import main as wsgi_main
+from . import pages
+from . import queries
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+MANIFEST = '.ublog-export.json'
+PAGESIZE = 10
+
+_application = None
+
+
+def _Digest(*values):
+  return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+
+def _Slug(text):
+  """Returns a path segment as the templates link it, and nginx decodes it."""
+  return urllib.parse.unquote(urllib.parse.quote_plus(
+      pages.slashfilter(str(text))))
+
+
+def FileName(path):
+  """Returns the file, relative to the output directory, for a page path."""
+  if path == '/':
+    return 'index.html'
+  return path.lstrip('/') + '.html'
+
+
+class Site(object):
+  """The public pages of the blog, and the data each of them shows.
+
+  Articles are summarised by what the listings show of them, so a page's
+  digest changes when the lastchange, comments or author of one of its
+  articles move, and not otherwise.
+  """
+
+  def __init__(self, connection, config):
+    with connection as cursor:
+      self.articles = list(queries.Execute(connection, cursor,
+                                           'export_articles'))
+      taglinks = queries.Execute(connection, cursor, 'export_tags')
+      self.sidebars = dict(
+          (block, [dict(row) for row in queries.Execute(
+              connection, cursor, name, **params)])
+          for block, (name, params) in queries.SIDEBAR.items())
+    self.tags = {}
+    for link in taglinks:
+      self.tags.setdefault(link['articleid'], []).append(link['name'])
+    self.config = config
+
+  def _Common(self):
+    """Returns a digest of what every page shows besides its articles."""
+    templates = []
+    for directory, _dirs, files in sorted(os.walk(os.path.join(PATH,
+                                                               'templates'))):
+      for name in sorted(files):
+        with open(os.path.join(directory, name), 'rb') as template:
+          templates.append(hashlib.sha1(template.read()).hexdigest())
+    blog = dict(self.config['blog']) if 'blog' in self.config else {}
+    return _Digest(templates, sorted(blog.items()), uweb3.__version__,
+                   time.strftime('%Y'), self.sidebars['toptags'],
+                   self.sidebars['authors'][:10],
+                   self.sidebars['activemonths'][:10])
+
+  @staticmethod
+  def _Summary(article):
+    return (article['ID'], str(article['lastchange']),
+            str(article['lastcomment']), article['comments'],
+            article['author'])
+
+  def Pages(self):
+    """Returns a dictionary of the digest of every public page by path."""
+    common = self._Common()
+    summaries = [self._Summary(article) for article in self.articles]
+    pages = {'/alltags': _Digest(common, self.sidebars['tagcloud']),
+             '/allmonths': _Digest(common, self.sidebars['activemonths']),
+             '/allauthors': _Digest(common, self.sidebars['authors'])}
+    totalpages = (len(summaries) + PAGESIZE - 1) // PAGESIZE
+    pages['/'] = _Digest(common, totalpages, summaries[:PAGESIZE])
+    for number in range(1, totalpages + 1):
+      pages['/page/%d' % number] = _Digest(
+          common, totalpages,
+          summaries[PAGESIZE * (number - 1):PAGESIZE * number])
+    listings = {}
+    for article, summary in zip(self.articles, summaries):
+      tags = sorted(self.tags.get(article['ID'], ()))
+      pages['/article/%d/%s' % (article['ID'], _Slug(article['title']))] = (
+          _Digest(common, summary, tags))
+      for path in (['/author/%d/%s' % (article['user'],
+                                       _Slug(article['author']))] +
+                   ['/tags/%s' % _Slug(tag) for tag in tags]):
+        listings.setdefault(path, []).append(summary)
+    # The date listings show the newest date first, like article_daterange.
+    for article, summary in sorted(
+        zip(self.articles, summaries), reverse=True,
+        key=lambda pair: (pair[0]['date'], pair[0]['ID'])):
+      date = article['date']
+      for path in ('/articles/%d' % date.year,
+                   '/articles/%d/%d' % (date.year, date.month)):
+        listings.setdefault(path, []).append(summary)
+    for path, listed in listings.items():
+      pages[path] = _Digest(common, len(listed), listed[:PAGESIZE])
+    return pages
+
+
+def _StartWorker():
+  """Creates the uWeb3 application of a worker process."""
+  global _application
+  _application = wsgi_main()
+
+
+def _Environ(path):
+  """Returns the WSGI environment of an anonymous GET request for path."""
+  return {'REQUEST_METHOD': 'GET',
+          'SCRIPT_NAME': '',
+          'PATH_INFO': path,
+          'QUERY_STRING': '',
+          'SERVER_NAME': 'localhost',
+          'SERVER_PORT': '80',
+          'SERVER_PROTOCOL': 'HTTP/1.1',
+          'REMOTE_ADDR': '127.0.0.1',
+          'HTTP_COOKIE': 'xsrf=%s' % pages.PageMaker.XSRF_PLACEHOLDER,
+          'wsgi.version': (1, 0),
+          'wsgi.url_scheme': 'http',
+          'wsgi.input': io.BytesIO(),
+          'wsgi.errors': sys.stderr,
+          'wsgi.multithread': False,
+          'wsgi.multiprocess': True,
+          'wsgi.run_once': False}
+
+
+def Render(output, path):
+  """Renders the page for path into the output directory.
+
+  The file is replaced atomically, so nginx never serves half a page. Pages
+  that do not answer 200 are not written, and an older copy is removed.
+
+  Returns:
+    (path, HTTP status code)
+  """
+  response = {}
+
+  def start_response(status, headers, exc_info=None):
+    response['status'] = int(status.split(' ', 1)[0])
+
+  result = _application(_Environ(path), start_response)
+  try:
+    content = b''.join(result)
+  finally:
+    if hasattr(result, 'close'):
+      result.close()
+  filename = os.path.join(output, FileName(path))
+  if response['status'] != 200:
+    if os.path.exists(filename):
+      os.remove(filename)
+    return path, response['status']
+  os.makedirs(os.path.dirname(filename), exist_ok=True)
+  temporary = '%s.%d.tmp' % (filename, os.getpid())
+  with open(temporary, 'wb') as page:
+    page.write(content)
+  os.replace(temporary, filename)
+  return path, 200
+
+
+def Export(connection, config, output, full=False, jobs=None):
+  """Brings the static copy of the blog in output up to date.
+
+  Arguments:
+    connection: database connection to read the site's state with.
+    config: the parsed configuration file.
+    output: directory the pages are written to.
+    full: bool, render every page, not only the changed ones.
+    jobs: int, the number of worker processes, one per core by default.
+
+  Returns:
+    dictionary with the number of pages 'rendered', 'unchanged' and
+    'removed', and the paths of the pages that 'failed' to render.
+  """
+  manifestfile = os.path.join(output, MANIFEST)
+  previous = {}
+  if not full and os.path.exists(manifestfile):
+    with open(manifestfile) as manifest:
+      previous = json.load(manifest).get('pages', {})
+  current = Site(connection, config).Pages()
+  changed = sorted(path for path, digest in current.items()
+                   if previous.get(path) != digest)
+  removed = [path for path in previous if path not in current]
+  for path in removed:
+    filename = os.path.join(output, FileName(path))
+    if os.path.exists(filename):
+      os.remove(filename)
+  os.makedirs(output, exist_ok=True)
+  failed = []
+  if changed:
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, mp_context=multiprocessing.get_context('spawn'),
+        initializer=_StartWorker) as executor:
+      outputs = [output] * len(changed)
+      for path, status in executor.map(Render, outputs, changed,
+                                       chunksize=16):
+        if status != 200:
+          failed.append(path)
+          del current[path]
+  temporary = manifestfile + '.tmp'
+  with open(temporary, 'w') as manifest:
+    json.dump({'pages': current}, manifest, indent=0, sort_keys=True)
+  os.replace(temporary, manifestfile)
+  return {'rendered': len(changed) - len(failed),
+          'unchanged': len(current) - len(changed) + len(failed),
+          'removed': len(removed),
+          'failed': failed}
@@ -0,0 +1,374 @@
+#!/usr/bin/python
+"""Offline analysis of the ublog access and exception logs.
+
+Reads the uWeb3 text logs (access_logging.log, uweb3_uncaught_exceptions.log)
+as well as the JSON lines written by ublog.logs (access.log, error.log),
+including rotated and gzipped files, and reports:
+
+  - requests and request rate per route,
+  - the breakdown of response statuses,
+  - the paths most often answered with 404,
+  - exceptions grouped by the signature of their traceback.
+
+Logs are streamed, and every tally keeps a bounded number of keys, so memory
+use does not grow with the size of the logs. Large plain files are split in
+chunks that are analysed in parallel on all cores.
+
+Usage:
+  python -m ublog.loganalytics [--access FILE ...] [--exceptions FILE ...]
+
+Without files, the logs in the ublog package directory are analysed.
+"""
+
+# Standard modules
+import argparse
+import concurrent.futures
+import datetime
+import glob
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_ACCESS = ('access_logging.log*', os.path.join('logs', 'access.log*'))
+DEFAULT_EXCEPTIONS = ('uweb3_uncaught_exceptions.log*',
+                      os.path.join('logs', 'error.log*'))
+CHUNKSIZE = 64 * 1024 * 1024
+CAPACITY = 2000
+
+ACCESS_LINE = re.compile(
+    br'^(?P<remote>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] '
+    br'"(?P<method>\S+) (?P<path>\S*) (?P<status>\d{3})')
+EXCEPTION_MARKER = b'UNCAUGHT EXCEPTION:'
+FRAME_LINE = re.compile(r'^\s+File "(?P<file>[^"]+)", line \d+, in (?P<func>.+)$')
+
+
+class TopCounter(object):
+  """Counts keys with the Space-Saving algorithm, in bounded memory.
+
+  At most `capacity` keys are tracked. When a new key arrives while full, the
+  key with the lowest count is replaced and the new key inherits its count,
+  so counts of frequent keys are exact or slightly overestimated and no key
+  above total / capacity is ever missed.
+  """
+
+  def __init__(self, capacity=CAPACITY):
+    self.capacity = capacity
+    self.counts = {}
+    self.total = 0
+
+  def Add(self, key, count=1):
+    self.total += count
+    if key in self.counts:
+      self.counts[key] += count
+    elif len(self.counts) < self.capacity:
+      self.counts[key] = count
+    else:
+      smallest = min(self.counts, key=self.counts.get)
+      self.counts[key] = self.counts.pop(smallest) + count
+
+  def Merge(self, other):
+    """Adds the counts of another TopCounter to this one."""
+    total = self.total + other.total
+    for key, count in other.counts.items():
+      self.Add(key, count)
+    self.total = total
+
+  def MostCommon(self, limit=None):
+    return sorted(self.counts.items(),
+                  key=lambda item: (-item[1], str(item[0])))[:limit]
+
+
+class Report(object):
+  """The tallies for a set of log records, mergeable between workers."""
+
+  def __init__(self):
+    self.requests = 0
+    self.first = None
+    self.last = None
+    self.routes = TopCounter()
+    self.statuses = TopCounter(100)
+    self.notfound = TopCounter()
+    self.exceptions = TopCounter()
+    self.examples = {}
+
+  def AddRequest(self, time, path, status, route=None):
+    self.requests += 1
+    if time is not None:
+      if self.first is None or time < self.first:
+        self.first = time
+      if self.last is None or time > self.last:
+        self.last = time
+    self.routes.Add(route or RouteOf(path))
+    self.statuses.Add(status)
+    if status == 404:
+      self.notfound.Add(path)
+
+  def AddException(self, text):
+    signature, summary = Signature(text)
+    self.exceptions.Add(signature)
+    if signature not in self.examples:
+      self.examples[signature] = summary
+    if len(self.examples) > 2 * self.exceptions.capacity:
+      self.examples = dict((key, value) for key, value in
+                           self.examples.items()
+                           if key in self.exceptions.counts)
+
+  def Merge(self, other):
+    self.requests += other.requests
+    for time in (other.first, other.last):
+      if time is not None:
+        self.first = min(self.first or time, time)
+        self.last = max(self.last or time, time)
+    self.routes.Merge(other.routes)
+    self.statuses.Merge(other.statuses)
+    self.notfound.Merge(other.notfound)
+    self.exceptions.Merge(other.exceptions)
+    for signature, summary in other.examples.items():
+      self.examples.setdefault(signature, summary)
+
+  def Summary(self, limit=20):
+    """Returns the report as a dictionary that serializes to JSON."""
+    seconds = ((self.last - self.first).total_seconds()
+               if self.first and self.last else 0)
+    minutes = max(seconds / 60.0, 1.0)
+    return {
+        'requests': self.requests,
+        'first': self.first and self.first.isoformat(),
+        'last': self.last and self.last.isoformat(),
+        'routes': [{'route': route, 'requests': count,
+                    'per_minute': round(count / minutes, 3)}
+                   for route, count in self.routes.MostCommon(limit)],
+        'statuses': [{'status': status, 'requests': count}
+                     for status, count in sorted(self.statuses.counts.items())],
+        'notfound': [{'path': path, 'requests': count}
+                     for path, count in self.notfound.MostCommon(limit)],
+        'exceptions': [dict(self.examples.get(signature, {}),
+                            signature=signature, occurrences=count)
+                       for signature, count
+                       in self.exceptions.MostCommon(limit)]}
+
+
+def RouteOf(path):
+  """Groups a path by its route: numbers and the slugs after them go."""
+  parts = []
+  numeric = False
+  for part in path.split('?', 1)[0].split('/'):
+    if part.isdigit():
+      parts.append('{n}')
+      numeric = True
+    elif numeric and part:
+      parts.append('{slug}')
+      numeric = False
+    else:
+      parts.append(part)
+      numeric = False
+  return '/'.join(parts)
+
+
+def Signature(text):
+  """Returns the signature of a traceback and a summary of it.
+
+  The signature covers the exception type and the files and functions of the
+  frames of the last traceback, not line numbers or messages, so the same
+  failure groups together across code edits and differing values.
+  """
+  traceback = text.rsplit('Traceback (most recent call last):', 1)[-1]
+  frames = []
+  final = ''
+  for line in traceback.splitlines():
+    frame = FRAME_LINE.match(line)
+    if frame:
+      frames.append('%s:%s' % (os.path.basename(frame.group('file')),
+                               frame.group('func').strip()))
+    elif line and not line[0].isspace():
+      final = line.strip()
+  exception, _sep, message = final.partition(':')
+  signature = hashlib.sha1(
+      repr((exception, frames)).encode('utf-8')).hexdigest()[:12]
+  return signature, {'exception': exception,
+                     'message': message.strip()[:200],
+                     'where': frames[-3:]}
+
+
+def _ParseTime(text):
+  """Parses '30/04/2020 10:14:46' without the cost of strptime."""
+  try:
+    return datetime.datetime(int(text[6:10]), int(text[3:5]), int(text[0:2]),
+                             int(text[11:13]), int(text[14:16]),
+                             int(text[17:19]))
+  except ValueError:
+    return None
+
+
+def _Open(path):
+  if path.endswith('.gz'):
+    return gzip.open(path, 'rb')
+  return open(path, 'rb')
+
+
+def _Lines(path, start, end):
+  """Yields (offset, line) for the lines that start in [start, end).
+
+  With end None the whole file is read. The line running across start is
+  left to the previous chunk.
+  """
+  with _Open(path) as logfile:
+    offset = 0
+    if start:
+      logfile.seek(start - 1)
+      offset = start - 1 + len(logfile.readline())
+    for line in logfile:
+      yield offset, line
+      offset += len(line)
+      if end is not None and offset >= end:
+        return
+
+
+def AnalyseAccess(path, start=0, end=None):
+  """Returns the Report for the access records in a chunk of a log."""
+  report = Report()
+  for _offset, line in _Lines(path, start, end):
+    if line.startswith(b'{'):
+      try:
+        record = json.loads(line)
+        time = datetime.datetime.fromisoformat(record['time'])
+        report.AddRequest(time, record.get('path') or '',
+                          int(record.get('status') or 0), record.get('route'))
+      except (ValueError, KeyError, TypeError):
+        continue
+      continue
+    match = ACCESS_LINE.match(line)
+    if match:
+      report.AddRequest(_ParseTime(match.group('time').decode('ascii', 'replace')),
+                        match.group('path').decode('utf-8', 'replace'),
+                        int(match.group('status')))
+  return report
+
+
+def AnalyseExceptions(path, start=0, end=None):
+  """Returns the Report for the exceptions that start in a chunk of a log.
+
+  An exception that starts in the chunk is read to its end, even when that
+  lies beyond the end of the chunk.
+  """
+  report = Report()
+  block = None
+  for offset, line in _Lines(path, start, None):
+    if line.startswith(b'{'):
+      if block is not None:
+        report.AddException(b''.join(block).decode('utf-8', 'replace'))
+        block = None
+      if end is not None and offset >= end:
+        break
+      try:
+        record = json.loads(line)
+      except ValueError:
+        continue
+      if record.get('exception'):
+        report.AddException(record['exception'])
+    elif line.startswith(EXCEPTION_MARKER):
+      if block is not None:
+        report.AddException(b''.join(block).decode('utf-8', 'replace'))
+        block = None
+      if end is not None and offset >= end:
+        break
+      block = []
+    elif block is not None:
+      block.append(line)
+  if block is not None:
+    report.AddException(b''.join(block).decode('utf-8', 'replace'))
+  return report
+
+
+def Tasks(paths, chunksize=CHUNKSIZE):
+  """Yields (path, start, end) chunks, gzipped files are read as a whole."""
+  for path in paths:
+    size = os.path.getsize(path)
+    if path.endswith('.gz') or size <= chunksize:
+      yield path, 0, None
+      continue
+    for start in range(0, size, chunksize):
+      yield path, start, min(start + chunksize, size)
+
+
+def Analyse(access=(), exceptions=(), jobs=None, chunksize=CHUNKSIZE):
+  """Returns the merged Report for the given access and exception logs."""
+  work = [(AnalyseAccess, task) for task in Tasks(access, chunksize)]
+  work.extend((AnalyseExceptions, task) for task in Tasks(exceptions,
+                                                          chunksize))
+  report = Report()
+  if jobs == 1 or len(work) < 2:
+    for function, task in work:
+      report.Merge(function(*task))
+    return report
+  with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+    futures = [executor.submit(function, *task) for function, task in work]
+    for future in concurrent.futures.as_completed(futures):
+      report.Merge(future.result())
+  return report
+
+
+def _Expand(patterns):
+  paths = []
+  for pattern in patterns:
+    paths.extend(sorted(glob.glob(pattern)) or [pattern])
+  return [path for path in paths if os.path.isfile(path)]
+
+
+def PrintReport(summary, out=sys.stdout):
+  """Writes a report summary as readable text."""
+  out.write('Requests: %d (%s to %s)\n\n' % (
+      summary['requests'], summary['first'], summary['last']))
+  out.write('%-50s %10s %10s\n' % ('Route', 'Requests', 'Per min'))
+  for route in summary['routes']:
+    out.write('%-50s %10d %10.2f\n' % (
+        route['route'][:50], route['requests'], route['per_minute']))
+  out.write('\n%-10s %10s\n' % ('Status', 'Requests'))
+  for status in summary['statuses']:
+    out.write('%-10s %10d\n' % (status['status'], status['requests']))
+  out.write('\n%-61s %10s\n' % ('404 path', 'Requests'))
+  for path in summary['notfound']:
+    out.write('%-61s %10d\n' % (path['path'][:61], path['requests']))
+  out.write('\nExceptions\n')
+  for exception in summary['exceptions']:
+    out.write('%6d  %s  %s: %s\n' % (
+        exception['occurrences'], exception['signature'],
+        exception.get('exception'), exception.get('message')))
+    for frame in exception.get('where', ()):
+      out.write('                      at %s\n' % frame)
+
+
+def main(argv=None):
+  """Parses the command line, analyses the logs and prints the report."""
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--access', nargs='*', metavar='FILE',
+                      help='access logs, plain, rotated or gzipped')
+  parser.add_argument('--exceptions', nargs='*', metavar='FILE',
+                      help='uncaught exception or error logs')
+  parser.add_argument('--jobs', type=int, default=None,
+                      help='worker processes, default one per core')
+  parser.add_argument('--limit', type=int, default=20,
+                      help='rows per table, default %(default)s')
+  parser.add_argument('--json', action='store_true',
+                      help='print the report as JSON')
+  args = parser.parse_args(argv)
+  if args.access is None and args.exceptions is None:
+    args.access = [os.path.join(PATH, pattern) for pattern in DEFAULT_ACCESS]
+    args.exceptions = [os.path.join(PATH, pattern)
+                       for pattern in DEFAULT_EXCEPTIONS]
+  report = Analyse(_Expand(args.access or ()), _Expand(args.exceptions or ()),
+                   jobs=args.jobs)
+  summary = report.Summary(args.limit)
+  if args.json:
+    json.dump(summary, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+  else:
+    PrintReport(summary)
+
+
+if __name__ == '__main__':
+  main()
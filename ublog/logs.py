@@ -0,0 +1,172 @@
+#!/usr/bin/python
+"""Structured, buffered logging for ublog.
+
+Request threads hand their log records to an in-memory queue and return
+immediately; a single background thread formats them as JSON lines and writes
+them to rotating files. When the queue is full, records are dropped and
+counted rather than blocking the request.
+
+Loggers and the files they write to:
+  ublog.access: access.log, one record per request.
+  ublog.error, ublog.slowquery: error.log, uncaught exceptions and slow
+      queries.
+"""
+
+# Standard modules
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import traceback
+
+LOGGERS = {'ublog.access': 'access.log',
+           'ublog.error': 'error.log',
+           'ublog.slowquery': 'error.log'}
+
+
+class JsonFormatter(logging.Formatter):
+  """Formats a record as a single JSON object per line.
+
+  The dictionary passed as `extra={'fields': {...}}` is merged into the
+  object, so access records carry their route, status and timings as fields.
+  """
+
+  def format(self, record):
+    entry = {'time': datetime.datetime.fromtimestamp(
+                 record.created).isoformat(timespec='milliseconds'),
+             'level': record.levelname,
+             'logger': record.name,
+             'message': record.getMessage()}
+    entry.update(getattr(record, 'fields', {}))
+    if record.exc_info:
+      entry['exception'] = ''.join(
+          traceback.format_exception(*record.exc_info))
+    elif getattr(record, 'exc_text', None):
+      entry['exception'] = record.exc_text
+    return json.dumps(entry, default=str)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+  """Queues records without ever blocking, counting the ones it drops."""
+
+  def __init__(self, recordqueue):
+    super(QueueHandler, self).__init__(recordqueue)
+    self.dropped = 0
+
+  def prepare(self, record):
+    """Renders the traceback here, the writer cannot see the live frames."""
+    if record.exc_info:
+      record.exc_text = ''.join(traceback.format_exception(*record.exc_info))
+      record.exc_info = None
+    record.msg = record.getMessage()
+    record.args = None
+    return record
+
+  def enqueue(self, record):
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      self.dropped += 1
+
+
+class _Writer(logging.Handler):
+  """Sends each record to the file handler of the logger it came from."""
+
+  def __init__(self, handlers):
+    super(_Writer, self).__init__()
+    self.handlers = handlers
+
+  def handle(self, record):
+    handler = self.handlers.get(record.name)
+    if handler is not None:
+      handler.handle(record)
+
+
+_listener = None
+_handler = None
+_files = ()
+_configured = None
+_lock = threading.Lock()
+
+
+def _FileHandler(path, options):
+  if options.get('rotate', 'size') == 'time':
+    handler = logging.handlers.TimedRotatingFileHandler(
+        path, when=options.get('when', 'midnight'),
+        backupCount=int(options.get('backup_count', 7)), encoding='utf-8')
+  else:
+    handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=int(options.get('max_bytes', 10 * 1024 * 1024)),
+        backupCount=int(options.get('backup_count', 7)), encoding='utf-8')
+  handler.setFormatter(JsonFormatter())
+  return handler
+
+
+def Configure(options, default_directory):
+  """Sets up the queue and the background writer from the [logging] section.
+
+  Recognised options:
+    directory: where the log files are written, default_directory if unset.
+        Relative paths are taken from default_directory.
+    rotate: 'size' (default) to rotate at max_bytes, 'time' to rotate at the
+        interval given by when.
+    max_bytes: size at which a file is rotated, default 10 MiB.
+    when: rotation interval for TimedRotatingFileHandler, default 'midnight'.
+    backup_count: the number of rotated files kept, default 7.
+    queue_size: records held in memory before new ones are dropped, default
+        10000.
+
+  Calling this again with the same options is a no-op, so it is safe to call
+  on every request.
+  """
+  global _listener, _handler, _files, _configured
+  options = dict(options or {})
+  with _lock:
+    if options == _configured:
+      return
+    directory = os.path.join(default_directory,
+                             options.get('directory', default_directory))
+    os.makedirs(directory, exist_ok=True)
+    files = {}
+    handlers = {}
+    for name, filename in LOGGERS.items():
+      if filename not in files:
+        files[filename] = _FileHandler(os.path.join(directory, filename),
+                                       options)
+      handlers[name] = files[filename]
+    recordqueue = queue.Queue(int(options.get('queue_size', 10000)))
+    handler = QueueHandler(recordqueue)
+    listener = logging.handlers.QueueListener(recordqueue, _Writer(handlers))
+    listener.start()
+    for name in LOGGERS:
+      logger = logging.getLogger(name)
+      if _handler is not None:
+        logger.removeHandler(_handler)
+      logger.addHandler(handler)
+      logger.setLevel(logging.INFO)
+      logger.propagate = False
+    if _listener is not None:
+      _listener.stop()
+    for filehandler in _files:
+      filehandler.close()
+    _listener, _handler, _configured = listener, handler, options
+    _files = list(files.values())
+
+
+def Dropped():
+  """Returns the number of records dropped because the queue was full."""
+  return _handler.dropped if _handler is not None else 0
+
+
+@atexit.register
+def Flush():
+  """Writes out the queued records and stops the background writer."""
+  global _listener
+  with _lock:
+    if _listener is not None:
+      _listener.stop()
+      _listener = None
@@ -0,0 +1,233 @@
+#!/usr/bin/python
+"""Maintenance commands for the ublog database.
+
+Run them through manage.py in the project root, for example:
+
+  python manage.py recount-comments
+"""
+
+# Standard modules
+import argparse
+import configparser
+import datetime
+import os
+import time
+
+# Third-party modules
+import uweb3
+from uweb3 import templateparser
+from uweb3.ext_lib.libs.sqltalk import mysql
+
+# Application components
+from . import export
+from . import model
+from . import pages
+from . import queries
+from . import rendering
+from . import templating
+
+CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini')
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'templates')
+
+
+def ReadConfig(path=CONFIG):
+  """Returns the parsed configuration file."""
+  config = configparser.ConfigParser()
+  config.read(path)
+  return config
+
+
+def Connect(config):
+  """Returns a database connection configured by the [mysql] section."""
+  options = config['mysql']
+  return mysql.Connect(host=options.get('host', 'localhost'),
+                       user=options.get('user'),
+                       passwd=options.get('password'),
+                       db=options.get('database'),
+                       charset='utf8')
+
+
+def RecountComments(connection, args):
+  """Recomputes the comment counters on all articles."""
+  model.Article.RecountComments(connection)
+  print('Comment counters recomputed.')
+
+
+def RebuildMonths(connection, args):
+  """Rebuilds the histogram of public articles per month."""
+  model.Article.RecountMonths(connection)
+  print('Month histogram rebuilt.')
+
+
+def RebuildTagcloud(connection, args):
+  """Rebuilds the public article counts of all tags."""
+  model.Tags.RebuildCounts(connection)
+  print('Tag counts rebuilt.')
+
+
+def RebuildExcerpts(connection, args):
+  """Renders and stores the listing excerpts and titles of all articles."""
+  updated = model.Article.RebuildExcerpts(connection)
+  print('Excerpts of %d articles rebuilt.' % updated)
+
+
+def BenchmarkQueries(connection, args):
+  """Times the listing queries with and without server-side preparing."""
+  with connection as cursor:
+    tags = queries.Execute(connection, cursor, 'tagcloud_top', limit=1)
+    authors = queries.Execute(connection, cursor, 'authors')
+  year = datetime.date.today().year
+  listings = [('article_lastn', {'public': 'true', 'before': None,
+                                 'count': 10, 'offset': 0}),
+              ('article_count', {'public': 'true'}),
+              ('article_daterange', {'start': '%04d-01-01' % year,
+                                     'end': '%04d-01-01' % (year + 1),
+                                     'count': 10, 'offset': 0}),
+              ('tagcloud_top', {'limit': 10})]
+  if tags:
+    listings.append(('article_tag', {'tag': tags[0]['name'], 'count': 10,
+                                     'offset': 0}))
+  if authors:
+    listings.append(('article_user', {'user': authors[0]['ID'], 'count': 10,
+                                      'offset': 0}))
+  prepared = queries.PREPARED
+  print('%-20s %12s %12s %8s' % ('query', 'text ms', 'prepared ms', 'ratio'))
+  try:
+    for name, params in listings:
+      timings = []
+      for mode in (False, True):
+        queries.PREPARED = mode
+        with connection as cursor:
+          queries.Execute(connection, cursor, name, **params)
+          start = time.perf_counter()
+          for _repeat in range(args.repeat):
+            queries.Execute(connection, cursor, name, **params)
+        timings.append((time.perf_counter() - start) * 1000 / args.repeat)
+      print('%-20s %12.3f %12.3f %8.2f' % (
+          name, timings[0], timings[1], timings[0] / timings[1]))
+  finally:
+    queries.PREPARED = prepared
+
+
+def BenchmarkTemplates(connection, args):
+  """Times page renders with the uWeb3 parser and the compiled parsers.
+
+  The uWeb3 parser renders every listing row, the compiled parsers take them
+  from the fragment cache.
+  """
+  articles = rendering.AddExcerpts(list(model.Article.LastN(connection)))
+  sidebars = {}
+  with connection as cursor:
+    for block, (name, params) in queries.SIDEBAR.items():
+      sidebars[block] = queries.Execute(connection, cursor, name, **params)
+  blog = args.config_data['blog']
+  year = time.strftime('%Y')
+  pagination = {'currentpage': 1, 'totalpages': 1, 'pagenumbers': [1],
+                'before': None}
+  bodies = [('index.html', {'articles': articles, 'blogname': blog['name'],
+                            'pagination': pagination,
+                            'unpubpagination': None}),
+            ('articles.html', {'articles': articles, 'title': 'Benchmark'}),
+            ('alltags.html', {'tags': sidebars['tagcloud']}),
+            ('allmonths.html', {'menuitems': sidebars['activemonths']})]
+  parsers = [('uweb3', templateparser.Parser(TEMPLATES)),
+             ('compiled', templating.Parser(TEMPLATES)),
+             ('strict', templating.Parser(TEMPLATES, strict=True))]
+  for _name, parser in parsers:
+    parser.RegisterFunction('creole', rendering.Creole)
+    parser.RegisterFunction('indextext', rendering.indexText)
+    parser.RegisterFunction('slashfilter', pages.slashfilter)
+    if isinstance(parser, templating.Parser):
+      parser.Compile()
+
+  def Render(parser, template, replacements):
+    footer = {'blogcopyright': year, 'blogtitle': blog['title'], 'user': None,
+              'blogpoweredby': uweb3.__version__}
+    if isinstance(parser, templating.Parser):
+      footer = parser.ParseStatic('footer.html', (year, blog['title'], False),
+                                  **footer)
+      articlerows = rendering.ArticleRows(parser, articles)
+    else:
+      footer = parser.Parse('footer.html', **footer)
+      articlerows = ''.join(str(parser.Parse('blogpost.html', article=article))
+                            for article in articles)
+    header = parser.Parse('header.html', blogname=blog['name'],
+                          blogtitle=blog['title'],
+                          blogsubtitle=blog['subtitle'], blogurl=blog['url'],
+                          page=template, javascripts=None,
+                          menuitems=sidebars['activemonths'][:10],
+                          tags=sidebars['toptags'], user=None,
+                          xsrftoken=pages.PageMaker.XSRF_PLACEHOLDER,
+                          users=sidebars['authors'][:10], OGdata=None)
+    return parser.Parse(template, header=header, footer=footer,
+                        articlerows=articlerows,
+                        xsrftoken=pages.PageMaker.XSRF_PLACEHOLDER,
+                        **replacements)
+
+  print('%-16s %12s %12s %12s %8s' % (
+      'template', 'uweb3 ms', 'compiled ms', 'strict ms', 'ratio'))
+  for template, replacements in bodies:
+    timings = []
+    for _name, parser in parsers:
+      Render(parser, template, replacements)
+      start = time.perf_counter()
+      for _repeat in range(args.repeat):
+        Render(parser, template, replacements)
+      timings.append((time.perf_counter() - start) * 1000 / args.repeat)
+    print('%-16s %12.3f %12.3f %12.3f %8.2f' % (
+        template, timings[0], timings[1], timings[2],
+        timings[0] / timings[2]))
+
+
+def ExportStatic(connection, args):
+  """Renders the public pages into a directory for nginx to serve."""
+  start = time.perf_counter()
+  result = export.Export(connection, args.config_data, args.output,
+                         full=args.full, jobs=args.jobs)
+  print('%d pages rendered, %d unchanged, %d removed in %.1f s.' % (
+      result['rendered'], result['unchanged'], result['removed'],
+      time.perf_counter() - start))
+  for path in result['failed']:
+    print('Not exported, no 200 response: %s' % path)
+
+
+def main(argv=None):
+  """Parses the command line and runs the requested command."""
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--config', default=CONFIG,
+                      help='configuration file, default %(default)s')
+  commands = parser.add_subparsers(dest='command', required=True)
+  command = commands.add_parser('recount-comments',
+                                help=RecountComments.__doc__)
+  command.set_defaults(function=RecountComments)
+  command = commands.add_parser('rebuild-months', help=RebuildMonths.__doc__)
+  command.set_defaults(function=RebuildMonths)
+  command = commands.add_parser('rebuild-tagcloud',
+                                help=RebuildTagcloud.__doc__)
+  command.set_defaults(function=RebuildTagcloud)
+  command = commands.add_parser('rebuild-excerpts',
+                                help=RebuildExcerpts.__doc__)
+  command.set_defaults(function=RebuildExcerpts)
+  command = commands.add_parser('benchmark-queries',
+                                help=BenchmarkQueries.__doc__)
+  command.add_argument('--repeat', type=int, default=200,
+                       help='executions per query, default %(default)s')
+  command.set_defaults(function=BenchmarkQueries)
+  command = commands.add_parser('benchmark-templates',
+                                help=BenchmarkTemplates.__doc__)
+  command.add_argument('--repeat', type=int, default=200,
+                       help='renders per page, default %(default)s')
+  command.set_defaults(function=BenchmarkTemplates)
+  command = commands.add_parser('export-static', help=ExportStatic.__doc__)
+  command.add_argument('output', help='directory the pages are written to')
+  command.add_argument('--full', action='store_true',
+                       help='render all pages, not only the changed ones')
+  command.add_argument('--jobs', type=int, default=None,
+                       help='worker processes, default one per core')
+  command.set_defaults(function=ExportStatic)
+  args = parser.parse_args(argv)
+  config = args.config_data = ReadConfig(args.config)
+  if 'mysql' in config:
+    queries.Configure(config['mysql'])
+  args.function(Connect(config), args)
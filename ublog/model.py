@@ -2,11 +2,19 @@
 """Database abstraction model for ublog."""
 
 import binascii
+import datetime
 import hashlib
+import logging
+import re
+import threading
 
 # Custom modules
 from uweb3 import model
 from . import decorators
+from . import queries
+from . import rendering
+
+ERROR_LOGGER = logging.getLogger('ublog.error')
 
 class Article(model.Record):
   """Abstraction class for the article table."""
@@ -17,72 +25,209 @@ class Article(model.Record):
   def ByUser(cls, connection, user):
     """Get articles by user."""
     with connection as cursor:
-      articles = cursor.Execute("""
-                            SELECT *
-                            FROM article
-                            WHERE user=%s""" % connection.EscapeValues(user))
+      articles = queries.Execute(connection, cursor, 'article_byuser',
+                                 user=user)
     for article in articles:
       yield cls(connection, article)
 
   @classmethod
-  def LastN(cls, connection, count=10, public=True):
+  def LastN(cls, connection, count=10, public=True, offset=0, before=None):
     """A list of the last N posts that were made. (title and blurb).
 
+    Only the IDs of the requested page are read from the article table before
+    the rows of those articles and their authors are joined in, so the cost
+    of a page does not grow with the size of the archive. The rows carry the
+    excerpt stored with the article and its comment count column, not the
+    content.
+
     Arguments:
       count: int (opt), the number of posts to yield. Default 10.
+      public: bool (opt), yield published or unpublished posts.
+      offset: int (opt), number of posts to skip before yielding.
+      before: int (opt), only yield posts with an ID lower than this. Used for
+          keyset pagination, in which case the offset is ignored.
 
     Yields:
       list that specifies the posts id, title and a blurb of content.
-      indices: 0:'articleid' (int), 1:'title' (str), 2:'content' (str),
+      indices: 0:'articleid' (int), 1:'title' (str), 2:'excerpt' (str),
             3:'username' (str), 4:'userid' (int), 5:'date' (str),
             6:'commentcount' (int).
     """
     with connection as cursor:
-      articles = cursor.Execute("""
-          select
-            article.ID,
-            article.title,
-            article.content,
-            user.author,
-            article.user,
-            article.date,
-            count(comment.ID) as comments,
-            article.commentable,
-            article.public
-          from
-            user,
-            article
-              left join comment on (comment.article = article.ID)
-          where
-            article.public = '%s' and
-            article.user = user.ID
-          group by article.ID
-          order by article.ID desc
-          limit %d
-          """ % (str(public).lower(), count))
+      articles = queries.Execute(
+          connection, cursor, 'article_lastn', public=str(public).lower(),
+          before=None if before is None else int(before),
+          count=int(count), offset=0 if before is not None else int(offset))
     for article in articles:
       article['date'] = article['date'].strftime('%Y-%m-%d %H:%M:%S')
-      yield cls(connection, article)
+      yield cls(connection, _StoreRendered(connection, article))
+
+  @classmethod
+  def Count(cls, connection, public=True):
+    """Returns the number of published or unpublished articles."""
+    with connection as cursor:
+      result = queries.Execute(
+          connection, cursor, 'article_count', public=str(public).lower())
+    return int(result[0]['count'])
+
+  @classmethod
+  def Validator(cls, connection, articleid):
+    """Returns what a cache needs to know whether an article page changed.
+
+    This reads no content, so it is cheap enough to run before the page.
+
+    Returns:
+      dictionary with keys: 'ID' (int), 'lastchange' (datetime),
+          'lastcomment' (datetime or None), 'comments' (int).
+    """
+    with connection as cursor:
+      validator = queries.Execute(connection, cursor, 'article_validator',
+                                  article=int(articleid))
+    if not validator:
+      raise cls.NotExistError('No article with ID %r' % articleid)
+    return validator[0]
+
+  @classmethod
+  def CommentAdded(cls, connection, articleid, date):
+    """Updates the comment counters of an article for a new comment."""
+    with connection as cursor:
+      queries.Execute(connection, cursor, 'article_commentadded',
+                      date=str(date), article=int(articleid))
+
+  @classmethod
+  def RecountComments(cls, connection, articleids=None):
+    """Recomputes the comment counters from the comment table.
+
+    Arguments:
+      articleids: iterable of ints (opt), the articles to recount. All
+          articles are recounted when this is not given.
+    """
+    condition = ''
+    if articleids is not None:
+      articleids = ', '.join('%d' % int(articleid) for articleid in articleids)
+      if not articleids:
+        return
+      condition = 'where article.ID in (%s)' % articleids
+    with connection as cursor:
+      cursor.Execute("""
+          update article
+          set
+            comment_count = (select count(*)
+                             from comment
+                             where comment.article = article.ID),
+            lastcomment = (select max(comment.date)
+                           from comment
+                           where comment.article = article.ID)
+          %s
+          """ % condition)
 
   @classmethod
   def ActiveMonths(cls, connection):
-    """Yields all months in which articles were created."""
+    """Yields all months in which articles were created.
+
+    This reads the month histogram that RecountMonths maintains.
+    """
     with connection as cursor:
-      months = cursor.Execute("""
-        select
-          month(article.date) as month,
-          year(article.date) as year,
-          count(article.ID) as count
-        from
-          article
-        where
-          article.public = 'true'
-        group by month, year
-        order by month, year desc
-        """)
+      months = queries.Execute(connection, cursor, 'activemonths')
     for month in months:
       yield month
 
+  @classmethod
+  def RecountMonths(cls, connection, dates=None):
+    """Updates the month histogram of public articles.
+
+    Arguments:
+      dates: iterable of datetimes or 'YYYY-MM-DD HH:MM:SS' strings (opt), the
+          months these fall in are recounted. When not given, the whole
+          histogram is rebuilt.
+    """
+    if dates is None:
+      with connection as cursor:
+        cursor.Execute('delete from articlemonths')
+        cursor.Execute("""
+            insert into articlemonths (year, month, count)
+            select year(date), month(date), count(*)
+            from article
+            where public = 'true'
+            group by year(date), month(date)
+            """)
+      return
+    months = set()
+    for date in dates:
+      date = _ParseDate(date)
+      months.add((date.year, date.month))
+    with connection as cursor:
+      for year, month in months:
+        queries.Execute(connection, cursor, 'articlemonths_recount',
+                        year=year, month=month, **MonthRange(year, month))
+
+  @classmethod
+  def RebuildExcerpts(cls, connection, batch=100):
+    """Renders and stores the excerpt and title html of every article.
+
+    Articles are read in batches of the given size, so the content of the
+    whole archive is never held at once.
+
+    Returns:
+      int, the number of articles updated.
+    """
+    updated = after = 0
+    while True:
+      with connection as cursor:
+        articles = list(queries.Execute(connection, cursor, 'article_contents',
+                                        after=after, count=batch))
+        for article in articles:
+          queries.Execute(connection, cursor, 'article_setrendered',
+                          article=article['ID'],
+                          excerpt=rendering.Excerpt(article['content']),
+                          titlehtml=rendering.TitleHtml(article['title']))
+      if not articles:
+        return updated
+      updated += len(articles)
+      after = articles[-1]['ID']
+
+  @classmethod
+  def Create(cls, connection, record):
+    """Creates the article with its excerpt and title html, counts it in the
+    month histogram.
+    """
+    record['excerpt'] = rendering.Excerpt(record['content'])
+    record['titlehtml'] = rendering.TitleHtml(record['title'])
+    article = super(Article, cls).Create(connection, record)
+    cls.RecountMonths(connection, [record['date']])
+    return article
+
+  def Save(self, *args, **kwargs):
+    """Saves the article and its excerpt, updates the month and tag counters.
+
+    The excerpt and the title html are rendered again only when the content
+    or the title changed. Saving may change the visibility of the article, in
+    which case it is added to or removed from the counts of its month and
+    tags.
+    """
+    with self.connection as cursor:
+      previous = queries.Execute(self.connection, cursor, 'article_stored',
+                                 article=int(self['ID']))
+    if (not previous or previous[0]['content'] != self['content'] or
+        self.get('excerpt') is None):
+      self['excerpt'] = rendering.Excerpt(self['content'])
+    if (not previous or previous[0]['title'] != self['title'] or
+        self.get('titlehtml') is None):
+      self['titlehtml'] = rendering.TitleHtml(self['title'])
+    result = super(Article, self).Save(*args, **kwargs)
+    self.RecountMonths(self.connection, [self['date']])
+    if previous and previous[0]['public'] != self['public']:
+      Tags.AdjustCounts(self.connection, self.TagIDs(),
+                        1 if self['public'] == 'true' else -1)
+    return result
+
+  def TagIDs(self):
+    """Returns the IDs of the tags that belong to the article."""
+    with self.connection as cursor:
+      tags = queries.Execute(self.connection, cursor, 'article_tagids',
+                             article=int(self['ID']))
+    return [tag['tagid'] for tag in tags]
+
   def Comments(self, connection, limit=10, offset=0):
     """Yield comments that belong to an article, with optional limit and offset.
 
@@ -96,180 +241,186 @@ class Article(model.Record):
             'author' (str), 'email' (str), 'website' (str), 'userid' (int)
     """
     with connection as cursor:
-      comments = cursor.Select(
-        table=('comment', 'user'),
-        fields=('comment.ID', 'content', 'author', 'user', 'date'),
-        conditions=('comment.user=user.ID', 'comment.article=%i' % self['ID']),
-        order=[('date', True)],
-        limit=limit,
-        offset=offset,
-        escape=False)
+      comments = queries.Execute(
+          connection, cursor, 'article_comments', article=int(self['ID']),
+          limit=int(limit), offset=int(offset))
     for comment in comments:
       yield Comment(connection, comment)
 
   def Tags(self):
     """Yield tags that belong to an article."""
     with self.connection as cursor:
-      tags = cursor.Select(
-        table=('articletags', 'tags'),
-        fields='name',
-        conditions=('articleid=%d' % self['ID'], 'articletags.tagid=tags.ID'))
+      tags = queries.Execute(
+          self.connection, cursor, 'article_tags', article=int(self['ID']))
     return tags
 
   @classmethod
-  def Month(cls, connection, month, year):
+  def Month(cls, connection, month, year, count=10, offset=0):
     """A quick overview of the posts made in the given month (title and blurb).
 
     Arguments:
       month: int, number of the month (1-based).
       year:  int, year that the month is in.
+      count: int (opt), the number of posts to yield. Default 10.
+      offset: int (opt), number of posts to skip before yielding.
 
     Yields:
       list that specifies the posts id, title and a blurb of content.
-      indices: 0:'articleid' (int), 1:'title' (str), 2:'content' (str),
+      indices: 0:'articleid' (int), 1:'title' (str), 2:'excerpt' (str),
             3:'authorname' (str), 4:'authorid' (int), 5:'date' (str),
             6:'commentcount' (int).
     """
-    with connection as cursor:
-      articles = cursor.Execute("""
-        select
-          article.ID,
-          article.title,
-          article.content,
-          user.author,
-          article.user,
-          article.date,
-          count(comment.ID) as comments
-        from
-          user,
-          article
-            left join comment on (comment.article = article.ID)
-        where
-          article.public = 'true' and
-          article.user = user.ID and
-          month(article.date) = %i and
-          year(article.date) = %i
-        group by article.ID
-        order by article.ID desc
-        """ % (int(month), int(year)))
-    for article in articles:
-      article['date'] = article['date'].strftime('%Y-%m-%d %H:%M:%S')
-      yield cls(connection, article)
+    return cls._Listing(connection, 'article_daterange', count, offset,
+                        **MonthRange(int(year), int(month)))
 
   @classmethod
-  def Year(cls, connection, year):
+  def Year(cls, connection, year, count=10, offset=0):
     """A quick overview of the posts made in a given year.
 
     Arguments:
       year: int, year to provide details of.
+      count: int (opt), the number of posts to yield. Default 10.
+      offset: int (opt), number of posts to skip before yielding.
 
     Yields:
       list that specifies the posts id, title and a blurb of content.
-      indices: 0:'articleid' (int), 1:'title' (str), 2:'content' (str),
+      indices: 0:'articleid' (int), 1:'title' (str), 2:'excerpt' (str),
             3:'authorname' (str), 4:'authorid' (int), 5:'date' (str),
             6:'commentcount' (int).
     """
-    with connection as cursor:
-      articles = cursor.Execute("""
-        select
-          article.ID,
-          article.title,
-          article.content,
-          user.author,
-          article.user,
-          article.date,
-          count(comment.ID) as comments
-        from
-          user,
-          article
-          left join comment on (comment.article = article.ID)
-        where
-          article.public = 'true' and
-          article.user = user.ID and
-          year(article.date) = %i
-        group by article.ID
-        order by article.ID desc
-        """ % int(year))
-    for article in articles:
-      article['date'] = article['date'].strftime('%Y-%m-%d %H:%M:%S')
-      yield cls(connection, article)
+    return cls._Listing(connection, 'article_daterange', count, offset,
+                        **YearRange(int(year)))
 
   @classmethod
-  def Tag(cls, connection, tag):
-    """A quick overview of the posts made in the given month (title and blurb).
+  def Tag(cls, connection, tag, count=10, offset=0):
+    """A quick overview of the posts with the given tag (title and blurb).
 
     Arguments:
-      month: int, number of the month (1-based).
-      year:  int, year that the month is in.
+      tag: str, name of the tag.
+      count: int (opt), the number of posts to yield. Default 10.
+      offset: int (opt), number of posts to skip before yielding.
 
     Yields:
       list that specifies the posts id, title and a blurb of content.
-      indices: 0:'articleid' (int), 1:'title' (str), 2:'content' (str),
+      indices: 0:'articleid' (int), 1:'title' (str), 2:'excerpt' (str),
             3:'authorname' (str), 4:'authorid' (int), 5:'date' (str),
             6:'commentcount' (int).
     """
+    return cls._Listing(connection, 'article_tag', count, offset, tag=tag)
+
+  @classmethod
+  def User(cls, connection, userid, count=10, offset=0):
+    """Yields a page of the articles written by the given user."""
+    return cls._Listing(connection, 'article_user', count, offset,
+                        user=int(userid))
+
+  @classmethod
+  def _Listing(cls, connection, name, count, offset, **params):
     with connection as cursor:
-      articles = cursor.Execute("""
-        select
-          article.ID,
-          article.title,
-          article.content,
-          user.author,
-          article.user,
-          article.date,
-          count(comment.ID) as comments
-        from
-          articletags,
-          tags,
-          user,
-          article
-            left join comment on (comment.article = article.ID)
-        where
-          article.public = 'true' and
-          article.user = user.ID and
-          articletags.articleid = article.ID and
-          articletags.tagid = tags.ID and
-          tags.name = "%s"
-        group by article.ID
-        order by article.ID desc
-        """ % (tag))
+      articles = queries.Execute(connection, cursor, name, count=int(count),
+                                 offset=int(offset), **params)
     for article in articles:
       article['date'] = article['date'].strftime('%Y-%m-%d %H:%M:%S')
-      yield cls(connection, article)
+      yield cls(connection, _StoreRendered(connection, article))
+
+  @classmethod
+  def MonthCount(cls, connection, month, year):
+    """Returns the number of public articles in the given month."""
+    return cls._ListingCount(connection, 'article_daterange_count',
+                             **MonthRange(int(year), int(month)))
+
+  @classmethod
+  def YearCount(cls, connection, year):
+    """Returns the number of public articles in the given year."""
+    return cls._ListingCount(connection, 'article_daterange_count',
+                             **YearRange(int(year)))
+
+  @classmethod
+  def TagCount(cls, connection, tag):
+    """Returns the number of public articles with the given tag."""
+    return cls._ListingCount(connection, 'article_tag_count', tag=tag)
+
+  @classmethod
+  def UserCount(cls, connection, userid):
+    """Returns the number of public articles written by the given user."""
+    return cls._ListingCount(connection, 'article_user_count',
+                             user=int(userid))
+
+  @staticmethod
+  def _ListingCount(connection, name, **params):
+    with connection as cursor:
+      result = queries.Execute(connection, cursor, name, **params)
+    return int(result[0]['count'])
+
+  @classmethod
+  def SearchQuery(cls, text):
+    """Turns user input into a boolean mode FULLTEXT query.
+
+    Every word is required and matched as a prefix. Words shorter than the
+    InnoDB minimum token size are dropped, as are words past the tenth.
+
+    Returns:
+      str, the boolean query, empty if nothing searchable was given.
+    """
+    words = [word for word in re.findall(r'\w+', text or '', re.UNICODE)
+             if len(word) >= 3][:10]
+    return ' '.join('+%s*' % word for word in words)
 
   @classmethod
-  def User(cls, connection, userid):
-    """Yields all articles written by the given user."""
+  def Search(cls, connection, query, count=10, offset=0):
+    """Yields public articles matching a query, best match first.
+
+    Arguments:
+      query: str, boolean mode query as returned by SearchQuery.
+      count: int (opt), the number of articles to yield. Default 10.
+      offset: int (opt), number of articles to skip before yielding.
+
+    Yields:
+      articles with the same fields as LastN, plus their 'score' (float).
+    """
+    if not query:
+      return
     with connection as cursor:
-      articles = cursor.Execute("""
-        select
-          article.ID,
-          article.title,
-          article.content,
-          user.author,
-          article.user,
-          article.date,
-          count(comment.ID) as comments
-        from
-          user,
-          article
-            left join comment on (comment.article = article.ID)
-        where
-          article.public = 'true' and
-          article.user = user.ID and
-          article.user = %s
-        group by article.ID
-        order by article.ID desc
-        """ % (userid))
+      articles = queries.Execute(connection, cursor, 'article_search',
+                                 query=query, count=int(count),
+                                 offset=int(offset))
     for article in articles:
       article['date'] = article['date'].strftime('%Y-%m-%d %H:%M:%S')
-      yield cls(connection, article)
+      yield cls(connection, _StoreRendered(connection, article))
 
-  def Delete(self, connection):
-    """Deletes all the article's comments before deleting itself."""
-    for comment in Comment.ByArticle(connection, self['ID']):
-      comment.Delete()
-    super(Article, self).Delete()
+  @classmethod
+  def SearchCount(cls, connection, query):
+    """Returns the number of public articles matching a query."""
+    if not query:
+      return 0
+    with connection as cursor:
+      result = queries.Execute(connection, cursor, 'article_searchcount',
+                               query=query)
+    return int(result[0]['count'])
+
+  def Delete(self, connection, chunksize=None, background=False,
+             callback=None):
+    """Deletes the article together with its comments and tag links.
+
+    Arguments are as for DeleteRows, which does the actual deleting.
+    """
+    articleid = int(self['ID'])
+    date = self['date']
+    tagids = self.TagIDs() if self['public'] == 'true' else []
+
+    def _Recount():
+      try:
+        Article.RecountMonths(connection, [date])
+        Tags.AdjustCounts(connection, tagids, -1)
+      finally:
+        if callback:
+          callback()
+
+    return DeleteRows(connection, [('comment', 'article = %d' % articleid),
+                                   ('articletags', 'articleid = %d' % articleid),
+                                   ('article', 'ID = %d' % articleid)],
+                      chunksize=chunksize, background=background,
+                      callback=_Recount)
 
 
 class Tags(model.Record):
@@ -277,33 +428,54 @@ class Tags(model.Record):
   _PRIMARY_KEY = 'ID'
 
   @classmethod
-  def Tagcloud(cls, connection):
-    """Lists all active tags.
+  def Tagcloud(cls, connection, limit=None):
+    """Lists all active tags, most used first.
+
+    This reads the tagcounts table, whose count index keeps the tags ordered,
+    so the top of the cloud is read without sorting. Tags used equally often
+    are listed by name in the full cloud, and newest first in its top, which
+    follows the index.
+
+    Arguments:
+      limit: int (opt), only list the most used tags.
 
     Returns a tuple: (tagid, name, count)
 
-    Count is the number of articles related to the tag.
+    Count is the number of public articles related to the tag.
     """
     with connection as cursor:
-      tags = cursor.Select(
-        table=('articletags', 'tags', 'article'),
-        fields=('tagid', 'name', 'count(tagid) as count'),
-        conditions=('articletags.tagid=tags.ID',
-                    'articletags.articleid=article.ID',
-                    'article.public="true"'),
-        group='tagid',
-        order=[('count', True)],
-        escape=False)
+      if limit:
+        tags = queries.Execute(
+            connection, cursor, 'tagcloud_top', limit=int(limit))
+      else:
+        tags = queries.Execute(connection, cursor, 'tagcloud')
     return (tag for tag in tags)
 
+  @classmethod
+  def RebuildCounts(cls, connection):
+    """Recomputes the tagcounts table from the tag links of public articles."""
+    with connection as cursor:
+      cursor.Execute('delete from tagcounts')
+      cursor.Execute("""
+          insert into tagcounts (tagid, count)
+          select articletags.tagid, count(*)
+          from articletags
+            join article on (article.ID = articletags.articleid)
+          where article.public = 'true'
+          group by articletags.tagid
+          """)
+
+  @classmethod
+  def AdjustCounts(cls, connection, tagids, delta):
+    """Adds delta to the public article count of each of the given tags."""
+    with connection as cursor:
+      _AdjustTagCounts(cursor, tagids, delta)
+
   @classmethod
   def FromName(cls, connection, name):
     """Get tag by name."""
     with connection as cursor:
-      tag = cursor.Execute("""
-                            SELECT *
-                            FROM tags
-                            WHERE name=%s LIMIT 1""" % connection.EscapeValues(name))
+      tag = queries.Execute(connection, cursor, 'tag_byname', tag=name)
     if tag:
       tag = Tags(connection, tag[0])
       return tag
@@ -312,26 +484,37 @@ class Tags(model.Record):
   @classmethod
   def removeFromArticle(cls, connection, id):
     """Remove all tags from article with id."""
-    with connection as cursor:
-      result = cursor.Execute("""
-                              DELETE
-                              FROM articletags
-                              where articleid=%s""" %
-                              id)
-    return result
+    return Articletags.Sync(connection, id, ())
 
 
 class Comment(model.Record):
-  """Abstraction class for the comment table."""
+  """Abstraction class for the comment table.
+
+  Creating and deleting comments keeps the comment counters on the article
+  table up to date.
+  """
+
+  @classmethod
+  def Create(cls, connection, record):
+    """Creates the comment and counts it on its article."""
+    comment = super(Comment, cls).Create(connection, record)
+    Article.CommentAdded(connection, record['article'], record['date'])
+    return comment
+
+  def Delete(self):
+    """Deletes the comment and recounts the comments on its article."""
+    articleid = self['article']
+    if isinstance(articleid, dict):
+      articleid = articleid['ID']
+    super(Comment, self).Delete()
+    Article.RecountComments(self.connection, [articleid])
 
   @classmethod
   def ByUser(cls, connection, user):
     """Get comments by user."""
     with connection as cursor:
-      comments = cursor.Execute("""
-                            SELECT *
-                            FROM comment
-                            WHERE user=%s""" % connection.EscapeValues(user))
+      comments = queries.Execute(connection, cursor, 'comment_byuser',
+                                 user=user)
     for comment in comments:
       yield cls(connection, comment)
 
@@ -339,11 +522,8 @@ class Comment(model.Record):
   def ByArticle(cls, connection, article):
     """Get comments by article."""
     with connection as cursor:
-      comments = cursor.Execute("""
-                            SELECT *
-                            FROM comment
-                            WHERE article=%s"""
-                                % connection.EscapeValues(article))
+      comments = queries.Execute(connection, cursor, 'comment_byarticle',
+                                 article=article)
     for comment in comments:
       yield cls(connection, comment)
 
@@ -356,10 +536,8 @@ class User(model.Record):
   def FromName(cls, connection, username):
     """Returns a User object based on the given username."""
     with connection as cursor:
-      safe_name = connection.EscapeValues(username)
-      user = cursor.Select(
-          table=cls.TableName(),
-          conditions='name=%s' % safe_name)
+      user = queries.Execute(connection, cursor, 'user_byname',
+                             username=username)
     if not user:
       raise cls.NotExistError('No user with name %r' % username)
     return cls(connection, user[0])
@@ -406,11 +584,8 @@ class User(model.Record):
   def FromEmail(cls, connection, email):
     """Get user by email."""
     with connection as cursor:
-      userquery = cursor.Execute("""
-                            SELECT *
-                            FROM user
-                            WHERE name=%s"""
-                                 % connection.EscapeValues(email))
+      userquery = queries.Execute(connection, cursor, 'user_byname',
+                                  username=email)
     if userquery:
       return cls(connection, userquery[0])
     else:
@@ -420,11 +595,8 @@ class User(model.Record):
   def FromAuthor(cls, connection, name):
     """Get user by id."""
     with connection as cursor:
-      userquery = cursor.Execute("""
-                            SELECT *
-                            FROM user
-                            WHERE author=%s"""
-                                 % connection.EscapeValues(name))
+      userquery = queries.Execute(connection, cursor, 'user_byauthor',
+                                  author=name)
     if userquery:
       return cls(connection, userquery[0])
     else:
@@ -434,11 +606,7 @@ class User(model.Record):
   def FromID(cls, connection, id):
     """Get user by id."""
     with connection as cursor:
-      userquery = cursor.Execute("""
-                            SELECT *
-                            FROM user
-                            WHERE ID=%s"""
-                                 % connection.EscapeValues(id))
+      userquery = queries.Execute(connection, cursor, 'user_byid', user=id)
     if userquery:
       return cls(connection, userquery[0])
     else:
@@ -447,58 +615,267 @@ class User(model.Record):
   def Comments(self, connection, limit=10, offset=0):
     """Yield comments that belong to a user, with optional limit and offset.
 
+    The ID and title of the commented article are joined in, so listing a
+    page of comments costs a single query.
+
     Arguments:
       limit:  int (opt), maximum amount of comments to grab.
       offset: int (opt), number of comments to skip before yielding.
 
     Yields:
-      dictionary with the comments index, contents and author information.
-      keys: 'index' (int), 'content' (unicode), 'date' (str, ISO-6801),
-            'name' (str), 'email' (str), 'website' (str), 'authorid' (int)
+      dictionary with the comments index, contents and article information.
+      keys: 'ID' (int), 'content' (unicode), 'date' (datetime),
+            'user' (int), 'article' (dict with 'ID' and 'title')
     """
     with connection as cursor:
-      comments = cursor.Select(
-        table=('comment', 'article'),
-        fields=('comment.ID', 'comment.content', 'comment.date',
-                'comment.user', 'comment.article'),
-        conditions=('comment.user=%i' % self['ID'],
-                    'article.ID=comment.article'),
-        order=[('article.ID', True), ('date', True)],
-        limit=limit,
-        offset=offset,
-        escape=False)
+      comments = queries.Execute(connection, cursor, 'user_comments',
+                                 user=int(self['ID']), limit=int(limit),
+                                 offset=int(offset))
     for comment in comments:
+      comment = dict(comment)
+      comment['article'] = {'ID': comment['article'],
+                            'title': comment.pop('title')}
       yield comment
 
+  def CommentCount(self, connection):
+    """Returns the number of comments this user placed on existing articles."""
+    with connection as cursor:
+      result = queries.Execute(connection, cursor, 'user_commentcount',
+                               user=int(self['ID']))
+    return int(result[0]['count'])
+
   @classmethod
   def authors(self, connection):
     """Returns all authors."""
     with connection as cursor:
-      users = cursor.Execute("""
-        select
-        user.ID, author,
-        count(article.user) as count
-        FROM user, article
-        WHERE user.admin = true
-        AND user.active = true
-        AND user.ID = article.user
-        AND article.public = true
-        GROUP BY user.ID
-        """)
+      users = queries.Execute(connection, cursor, 'authors')
     for user in users:
       yield user
 
-  def Delete(self, connection):
-    """Deletes all articles and comments before deleting itself."""
-    for comment in Comment.ByUser(connection, self['ID']):
-      comment.Delete()
-    for article in Article.ByUser(connection, self['ID']):
-      article.Delete(self.connection)
-    super(User, self).Delete()
+  def Delete(self, connection, chunksize=None, background=False,
+             callback=None):
+    """Deletes the user with their comments, articles and everything on them.
+
+    Arguments are as for DeleteRows, which does the actual deleting.
+    """
+    userid = int(self['ID'])
+    with connection as cursor:
+      articles = queries.Execute(connection, cursor, 'user_articleids',
+                                 user=userid)
+      commented = queries.Execute(connection, cursor, 'user_commented',
+                                  user=userid)
+    commented = [row['article'] for row in commented]
+
+    def _Recount():
+      try:
+        Article.RecountComments(connection, commented)
+        Article.RecountMonths(connection)
+        Tags.RebuildCounts(connection)
+      finally:
+        if callback:
+          callback()
+
+    steps = [('comment', 'user = %d' % userid)]
+    if articles:
+      articleids = ', '.join('%d' % article['ID'] for article in articles)
+      steps.extend([('comment', 'article in (%s)' % articleids),
+                    ('articletags', 'articleid in (%s)' % articleids)])
+    steps.extend([('article', 'user = %d' % userid),
+                  ('user', 'ID = %d' % userid)])
+    return DeleteRows(connection, steps, chunksize=chunksize,
+                      background=background, callback=_Recount)
 
 
 class Articletags(model.Record):
   """Abstraction class for the articletags table."""
 
   _PRIMARY_KEY = 'tagid', 'articleid'
+
+  @classmethod
+  def Sync(cls, connection, articleid, names):
+    """Makes the article carry exactly the given tags, in one transaction.
+
+    All names are resolved with a single IN query, missing tags are created
+    with a single multi-row insert and only the links that differ from the
+    current ones are deleted or inserted.
+
+    Arguments:
+      articleid: int, the article to tag.
+      names: iterable of tag names. Names that differ only in case are
+          treated as the same tag, like the column collation does.
+
+    Returns:
+      dictionary with the lists of tag names that were 'added' and 'removed'.
+    """
+    wanted = {}
+    for name in names:
+      wanted.setdefault(name.lower(), name)
+    articleid = int(articleid)
+    with connection as cursor:
+      tagids = _TagIDs(connection, cursor, wanted.values())
+      missing = [name for key, name in wanted.items() if key not in tagids]
+      if missing:
+        cursor.Execute("""
+            insert into tags (name)
+            values %s
+            """ % ', '.join('(%s)' % connection.EscapeValues(name)
+                            for name in missing))
+        tagids.update(_TagIDs(connection, cursor, missing))
+      current = dict((row['tagid'], row['name']) for row in queries.Execute(
+          connection, cursor, 'article_taglinks', article=articleid))
+      wantedids = dict((tagids[key], name) for key, name in wanted.items())
+      removed = [tagid for tagid in current if tagid not in wantedids]
+      added = [tagid for tagid in wantedids if tagid not in current]
+      if removed:
+        cursor.Execute("""
+            delete from articletags
+            where articleid = %d and tagid in (%s)
+            """ % (articleid, ', '.join('%d' % tagid for tagid in removed)))
+      if added:
+        cursor.Execute("""
+            insert into articletags (articleid, tagid)
+            values %s
+            """ % ', '.join('(%d, %d)' % (articleid, tagid)
+                            for tagid in added))
+      public = queries.Execute(connection, cursor, 'article_public',
+                               article=articleid)
+      if public and public[0]['public'] == 'true':
+        _AdjustTagCounts(cursor, added, 1)
+        _AdjustTagCounts(cursor, removed, -1)
+    return {'added': [wantedids[tagid] for tagid in added],
+            'removed': [current[tagid] for tagid in removed]}
+
+
+def _ParseDate(date):
+  """Returns a datetime for a datetime or a 'YYYY-MM-DD HH:MM:SS' string."""
+  if isinstance(date, datetime.datetime):
+    return date
+  return datetime.datetime.strptime(str(date), '%Y-%m-%d %H:%M:%S')
+
+
+def MonthRange(year, month):
+  """Returns the half-open date range covering a month, as 'start' and 'end'."""
+  if not 1 <= month <= 12:
+    raise ValueError('Month should be in 1..12, got %r' % month)
+  if month == 12:
+    return {'start': '%04d-12-01' % year, 'end': '%04d-01-01' % (year + 1)}
+  return {'start': '%04d-%02d-01' % (year, month),
+          'end': '%04d-%02d-01' % (year, month + 1)}
+
+
+def YearRange(year):
+  """Returns the half-open date range covering a year, as 'start' and 'end'."""
+  return {'start': '%04d-01-01' % year, 'end': '%04d-01-01' % (year + 1)}
+
+
+def _StoreRendered(connection, article):
+  """Fills in the excerpt and title html of a listing row missing either.
+
+  Articles written before those columns existed have neither until
+  rebuild-excerpts ran, the first listing showing one renders and stores them.
+
+  Returns:
+    the listing row, with its excerpt and title html.
+  """
+  if article['excerpt'] is None or article['titlehtml'] is None:
+    with connection as cursor:
+      if article['excerpt'] is None:
+        content = queries.Execute(connection, cursor, 'article_content',
+                                  article=int(article['ID']))
+        article['excerpt'] = rendering.Excerpt(
+            content[0]['content'] if content else '')
+      if article['titlehtml'] is None:
+        article['titlehtml'] = rendering.TitleHtml(article['title'])
+      queries.Execute(connection, cursor, 'article_setrendered',
+                      article=int(article['ID']), excerpt=article['excerpt'],
+                      titlehtml=article['titlehtml'])
+  return article
+
+
+def DeleteRows(connection, steps, chunksize=None, background=False,
+               callback=None):
+  """Runs set-based deletes for a list of (table, condition) steps, in order.
+
+  Arguments:
+    steps: list of (table, condition) tuples, the condition being a trusted
+        SQL expression.
+    chunksize: int (opt), without it all steps run in a single transaction.
+        With it every step is repeated with this LIMIT until it runs out of
+        rows, each chunk in a transaction of its own, so other requests get
+        to use the connection and the rows in between.
+    background: bool (opt), run the deletes in a background thread. The
+        connection is then used by that thread alone, so it must not be the
+        connection of the request that starts the delete.
+    callback: callable (opt), called without arguments once the steps ran,
+        also when one of them failed, to release the connection and drop
+        cached data.
+
+  Returns:
+    the threading.Thread doing the work when running in the background.
+  """
+  def _Steps():
+    if chunksize:
+      for table, condition in steps:
+        while True:
+          with connection as cursor:
+            result = cursor.Execute("""
+                delete from %s
+                where %s
+                limit %d
+                """ % (table, condition, int(chunksize)))
+          if result.affected < chunksize:
+            break
+    else:
+      with connection as cursor:
+        for table, condition in steps:
+          cursor.Execute("""
+              delete from %s
+              where %s
+              """ % (table, condition))
+
+  def _Run():
+    try:
+      _Steps()
+    finally:
+      if callback:
+        callback()
+
+  def _Background():
+    try:
+      _Run()
+    except Exception:
+      ERROR_LOGGER.exception('Background delete of %s failed',
+                             ', '.join(table for table, _ in steps))
+
+  if background:
+    thread = threading.Thread(target=_Background, name='ublog-delete',
+                              daemon=True)
+    thread.start()
+    return thread
+  _Run()
+
+
+def _AdjustTagCounts(cursor, tagids, delta):
+  """Adds delta to the tagcounts rows of the given tags, within a cursor."""
+  if not tagids:
+    return
+  cursor.Execute("""
+      insert into tagcounts (tagid, count)
+      values %s
+      on duplicate key update count = count + values(count)
+      """ % ', '.join('(%d, %d)' % (int(tagid), int(delta))
+                      for tagid in tagids))
+
+
+def _TagIDs(connection, cursor, names):
+  """Returns a mapping of lowercased tag name to tag ID for existing tags."""
+  names = list(names)
+  if not names:
+    return {}
+  tags = cursor.Execute("""
+      select ID, name
+      from tags
+      where name in (%s)
+      """ % ', '.join(connection.EscapeValues(name) for name in names))
+  return dict((tag['name'].lower(), tag['ID']) for tag in tags)
 """Abstraction for the `user` table."""
@@ -2,31 +2,45 @@
 """Html generators for the base uweb3 server."""
 
 import datetime
+import email.utils
+import functools
+import logging
+import re
 import time
 import binascii
+import hashlib
 import os
+import weakref
 import uweb3
-from creole import creole2html
 from . import admin
+from . import batch
+from . import cache
+from . import logs
+from . import pool
+from . import profiling
+from . import queries
+from . import rendering
 from . import model
+from . import templating
+from . import timing
 from . import decorators
 from uweb3.response import Redirect
 
 
-def indexText(blogpost):
-  """Cuts down a string to a maximum of 50 words.
+SIDEBAR_MENUS = ('toptags', 'authors', 'activemonths')
 
-  to be used in the admin index
-  """
-  blogpost = blogpost.split()
-  blogpost = blogpost[:50]
+ACCESS_LOGGER = logging.getLogger('ublog.access')
+ERROR_LOGGER = logging.getLogger('ublog.error')
 
-  if len(blogpost) >= 50:
-    output = " ".join(blogpost) + " ..."
-  else:
-    output = " ".join(blogpost)
 
-  return output
+@functools.lru_cache(maxsize=1024)
+def _Route(path):
+  """Returns the (pattern, presenter name) of the route that serves path."""
+  from . import ROUTES
+  for pattern, presenter in ROUTES:
+    if re.match('^%s$' % pattern, path):
+      return pattern, presenter
+  return None, None
 
 
 def slashfilter(text):
@@ -73,22 +87,45 @@ class PageMaker(uweb3.DebuggingPageMaker,
   """
 
   ULF_SESSION_NAME = 'ulf_session_id'
+  # Stands in for the visitor's xsrf token in cached pages. It is the same in
+  # every process, so pages cached on the shared memcached backend can have
+  # the token filled in by any worker.
+  XSRF_PLACEHOLDER = 'ublog-xsrf-placeholder-9c1e5f7a'
   incorrect_xsrf_token = False
+  querytimings = ()
+  querycounter = None
+  timer = None
+  cachestatus = None
+  _pooledconnection = None
+  _release = None
+  _render_xsrf = None
+  _validator = None
 
   def __init__(self, *args, **kwds):
     """Overwrites the default init to add extra templateparser functions."""
+    self.started = time.perf_counter()
     super(PageMaker, self).__init__(*args, **kwds)
     LoginMixin.__init__(self)
-    self.parser.RegisterFunction("creole", creole2html)
-    self.parser.RegisterFunction("indextext", indexText)
+    logs.Configure(self.options.get('logging'),
+                   os.path.dirname(os.path.abspath(__file__)))
+    self.querytimings = []
+    cache.Configure(self.options.get('cache'))
+    queries.Configure(self.options.get('mysql'))
+    profiling.Configure(self.options.get('profiling'))
+    timing.Configure(self.options.get('timing'))
+    self.timer = timing.Start()
+    self.querycounter = timing.StartCounting()
+    self.parser.RegisterFunction("creole", rendering.Creole)
+    self.parser.RegisterFunction("indextext", rendering.indexText)
     self.parser.RegisterFunction("slashfilter", slashfilter)
-    if 'xsrf' in self.cookies:
-      self.req.AddCookie('xsrf', self.cookies['xsrf'], path='/',
-                         max_age=108000)
-    else:
-      self.req.AddCookie('xsrf', binascii.hexlify(os.urandom(16)),
-                         max_age=108000)
-      self.incorrect_xsrf_token = True
+    with timing.Phase('cookie'):
+      if 'xsrf' in self.cookies:
+        self.req.AddCookie('xsrf', self.cookies['xsrf'], path='/',
+                           max_age=108000)
+      else:
+        self.req.AddCookie('xsrf', binascii.hexlify(os.urandom(16)),
+                           max_age=108000)
+        self.incorrect_xsrf_token = True
 
     if self.post:
       try:
@@ -100,13 +137,13 @@ class PageMaker(uweb3.DebuggingPageMaker,
     if self.incorrect_xsrf_token is True:
       self.post.list = []
 
+  @decorators.PageCached(
+      key=lambda self, page=1, unpubpage=1: (int(page), self._GetBefore()),
+      generation='index')
   def Index(self, page=1, unpubpage=1):
     """Returns the index.html template."""
-    articles = list(model.Article.LastN(self.connection, count=1000))
-    pagination = self.MakePagination(int(page), len(articles))
-    if articles:
-      articles = articles[10*(pagination['currentpage']-1):
-                          10*pagination['currentpage']]
+    pagination = self.MakePagination(int(page), self._ArticleCount(True))
+    articles = self._ArticlePage(pagination, True, self._GetBefore())
 
     try:
       user = self._GetUserLoggedIn()
@@ -114,26 +151,65 @@ class PageMaker(uweb3.DebuggingPageMaker,
       pass
     else:
       if user['admin'] == 'true':
-        unpubarticles = list(model.Article.LastN(self.connection, public=False,
-                                                 count=1000))
         if unpubpage is None:
           unpubpage = 1
-        unpubpagination = self.MakePagination(int(unpubpage), len(unpubarticles))
-        if unpubpagination:
-          unpubarticles = unpubarticles[10*(unpubpagination['currentpage']-1):
-                                        10*unpubpagination['currentpage']]
+        unpubpagination = self.MakePagination(int(unpubpage),
+                                              self._ArticleCount(False))
+        unpubarticles = self._ArticlePage(unpubpagination, False)
+        notmodified = self._ListingNotModified(
+            articles + unpubarticles, pagination, unpubpagination)
+        if notmodified:
+          return notmodified
         return self.parser.Parse('admin/adminindex.html', articles=articles,
                                  unpubarticles=unpubarticles,
                                  pagination=pagination,
                                  unpubpagination=unpubpagination,
                                  **self.CommonBlocks('Index'))
 
+    notmodified = self._ListingNotModified(articles, pagination)
+    if notmodified:
+      return notmodified
     return self.parser.Parse('index.html', articles=articles,
+                             articlerows=rendering.ArticleRows(self.parser,
+                                                               articles),
                              blogname=self.options['blog']['name'],
                              pagination=pagination,
                              unpubpagination=None,
                              **self.CommonBlocks('Index'))
 
+  def _ArticleCount(self, public):
+    """Returns the cached number of published or unpublished articles."""
+    return cache.COUNTS.Get(('articles', public), lambda: model.Article.Count(
+        self.connection, public=public))
+
+  def _ArticlePage(self, pagination, public, before=None, pageposts=10):
+    """Returns the articles for the current page of the given pagination.
+
+    When `before` holds the ID of the last article on the previous page, the
+    page is read with a keyset condition instead of an offset. The ID of the
+    last article on this page is stored as pagination['before'] for the link
+    to the next page.
+    """
+    if not pagination:
+      return []
+    if before:
+      articles = model.Article.LastN(self.connection, count=pageposts,
+                                     public=public, before=before)
+    else:
+      offset = pageposts * (pagination['currentpage'] - 1)
+      articles = model.Article.LastN(self.connection, count=pageposts,
+                                     public=public, offset=offset)
+    articles = rendering.AddExcerpts(list(articles))
+    pagination['before'] = articles[-1]['ID'] if articles else None
+    return articles
+
+  def _GetBefore(self):
+    """Returns the keyset pagination ID from the query string, if any."""
+    try:
+      return int(self.get.getfirst('before'))
+    except (TypeError, ValueError):
+      return None
+
   @decorators.TemplateParser('login.html', 'Login')
   def Login(self):
     """Returns the login.html template."""
@@ -199,82 +275,188 @@ class PageMaker(uweb3.DebuggingPageMaker,
     message = 'Your account has successfully been created.'
     return self.RequestMessage(message, 'Success', '/home')
 
+  @decorators.PageCached(key=lambda self, number, title: (int(number),))
   def Article(self, number, title):
     """Returns the singlepost.html template."""
+    try:
+      validator = model.Article.Validator(self.connection, int(number))
+    except (uweb3.model.NotExistError, ValueError):
+      return Redirect('/', httpcode=303)
+    notmodified = self._NotModified(
+        (validator['lastchange'], validator['lastcomment']),
+        validator['ID'], validator['comments'])
+    if notmodified:
+      return notmodified
     try:
       user = self._GetUserLoggedIn()
     except (uweb3.model.NotExistError, self.NoSessionError, TypeError):
       user = None
-    try:
-      article = model.Article.FromPrimary(self.connection, int(number))
-      article['date'] = article['date'].strftime('%Y-%m-%d %H:%M:%S')
-      javascripts = ['validate.js', 'newcomment.js']
-      tags = article.Tags()
-    except (uweb3.model.NotExistError, ValueError):
+    querybatch = self._QueryBatch()
+    querybatch.Add('article', 'article_byid', article=validator['ID'])
+    querybatch.Add('tags', 'article_tags', article=validator['ID'])
+    querybatch.Add('comments', 'article_comments', article=validator['ID'],
+                   limit=10, offset=0)
+    _sidebars, results = self._Sidebars(SIDEBAR_MENUS, querybatch)
+    if not results['article']:
       return Redirect('/', httpcode=303)
-
+    article = model.Article(self.connection, results['article'][0])
+    article['user'] = model.User(self.connection, {
+        'ID': article['user'], 'author': article.pop('author')})
+    article['date'] = article['date'].strftime('%Y-%m-%d %H:%M:%S')
+    javascripts = ['validate.js', 'newcomment.js']
+    tags = results['tags']
+
+    article['html'] = rendering.ArticleHtml(article)
+    article['titlehtml'] = rendering.ArticleTitle(article)
     first = article['content'].find("{{")
     if first > 0:
       last = article['content'].find("|", first)
       article["image"] = article['content'][first+2:last]
     else:
       article["image"] = ""
-    try:
-      commentslist = list(article.Comments(self.connection))
-      rowtype = True
-      for comment in commentslist:
-        rowtype = not rowtype
-        comment['date'] = comment['date'].strftime('%Y-%m-%d %H:%M:%S')
-        comment['rowtype'] = rowtype and 'Even' or 'Odd'
-    except uweb3.model.NotExistError:
-      commentslist = False
+    commentslist = []
+    rowtype = True
+    for row in rendering.AddCommentHtml(results['comments']):
+      rowtype = not rowtype
+      comment = model.Comment(self.connection, row)
+      comment['user'] = model.User(self.connection, {
+          'ID': row['user'], 'author': comment.pop('author'),
+          'admin': comment.pop('admin')})
+      comment['date'] = comment['date'].strftime('%Y-%m-%d %H:%M:%S')
+      comment['rowtype'] = rowtype and 'Even' or 'Odd'
+      commentslist.append(comment)
     return self.parser.Parse('singlepost.html', article=article, tags=tags,
-                             commentslist=commentslist, user=user,
+                             commentslist=commentslist,
+                             commentrows=rendering.CommentRows(self.parser,
+                                                               commentslist),
+                             user=user,
                              **self.CommonBlocks(article['title'],
                                                  javascripts=javascripts,
                                                  OGdata=article))
 
+  @decorators.PageCached(
+      key=lambda self, year, month=None: (int(year), month and int(month),
+                                          self._GetPage()),
+      generation=lambda self, year, month=None: (
+          'ArticlesByDate', int(year), month and int(month)))
   def ArticlesByDate(self, year, month=None):
-    """Returns the articles.html template by date."""
+    """Returns a page of the articles.html template by date."""
     try:
       if month:
-        articles = list(model.Article.Month(self.connection, month, year))
+        pagination = self.MakePagination(self._GetPage(),
+                                         model.Article.MonthCount(
+                                             self.connection, month, year))
+        articles = self._ListingPage(pagination, model.Article.Month, month,
+                                     year)
+        title = 'Month: %s %s' % (year, month)
+        page = 'Month: %s %s' % (month, year)
       else:
-        articles = list(model.Article.Year(self.connection, year))
+        pagination = self.MakePagination(self._GetPage(),
+                                         model.Article.YearCount(
+                                             self.connection, year))
+        articles = self._ListingPage(pagination, model.Article.Year, year)
+        title = page = 'Year: %s' % year
     except (uweb3.model.NotExistError, ValueError, TypeError):
       return Redirect('/', httpcode=303)
-    title = 'Month: %s %s' % (year, month)
-    return self.parser.Parse('articles.html', articles=articles, title=title,
-                             **self.CommonBlocks('Month: %s %s' % (month,
-                                                                   year)))
-
+    notmodified = self._ListingNotModified(articles, pagination)
+    if notmodified:
+      return notmodified
+    return self._Listing(articles, pagination, title, page)
+
+  @decorators.PageCached(
+      key=lambda self, tag: (tag.replace('&-#', '/'), self._GetPage()),
+      generation=lambda self, tag: ('ArticlesByTag', tag.replace('&-#', '/')))
   def ArticlesByTag(self, tag):
-    """Returns the articles.html template by tag."""
+    """Returns a page of the articles.html template by tag."""
     tag = tag.replace('&-#', '/')
     try:
-      articles = list(model.Article.Tag(self.connection, tag))
+      pagination = self.MakePagination(
+          self._GetPage(), model.Article.TagCount(self.connection, tag))
+      articles = self._ListingPage(pagination, model.Article.Tag, tag)
     except (uweb3.model.NotExistError, ValueError, TypeError):
       return Redirect('/', httpcode=303)
+    notmodified = self._ListingNotModified(articles, pagination)
+    if notmodified:
+      return notmodified
     title = 'Tag: %s' % tag
-    return self.parser.Parse('articles.html', articles=articles, title=title,
-                             **self.CommonBlocks('Tag: %s' % tag))
+    return self._Listing(articles, pagination, title, title)
 
+  @decorators.PageCached(
+      key=lambda self, user, title: (int(user), self._GetPage()),
+      generation=lambda self, user, title: ('ArticlesByUser', int(user)))
   def ArticlesByUser(self, user, title):
-    """Returns the articles.html template by user."""
+    """Returns a page of the articles.html template by user."""
     author = model.User.FromID(self.connection, user)
     try:
-      articles = list(model.Article.User(self.connection, user))
+      pagination = self.MakePagination(
+          self._GetPage(), model.Article.UserCount(self.connection, user))
+      articles = self._ListingPage(pagination, model.Article.User, user)
     except (uweb3.model.NotExistError, ValueError, TypeError):
       return Redirect('/', httpcode=303)
     if author:
+      notmodified = self._ListingNotModified(articles, pagination,
+                                             author['author'])
+      if notmodified:
+        return notmodified
       title = 'Author: %s' % author["author"]
-      return self.parser.Parse('articles.html', articles=articles, title=title,
-                               **self.CommonBlocks(title))
+      return self._Listing(articles, pagination, title, title)
     else:
       title = 'no user found'
-      return uweb3.Response(self.parser.Parse('articles.html',
-                           articles=articles, title=title,
-                           **self.CommonBlocks(title)), httpcode=404)
+      return uweb3.Response(self._Listing(articles, pagination, title, title),
+                            httpcode=404)
+
+  def _GetPage(self):
+    """Returns the page number from the query string, 1 if there is none."""
+    try:
+      return max(int(self.get.getfirst('page')), 1)
+    except (TypeError, ValueError):
+      return 1
+
+  def _ListingPage(self, pagination, listing, *args, pageposts=10):
+    """Returns the articles on the current page of a listing.
+
+    Arguments:
+      pagination: dict from MakePagination, None for an empty listing.
+      listing: the model.Article method that yields a page of the listing.
+      *args: the arguments for listing, before the count and offset.
+    """
+    if not pagination:
+      return []
+    return rendering.AddExcerpts(list(listing(
+        self.connection, *args, count=pageposts,
+        offset=pageposts * (pagination['currentpage'] - 1))))
+
+  def _Listing(self, articles, pagination, title, page):
+    """Returns the articles.html template for a page of a listing."""
+    return self.parser.Parse('articles.html', articles=articles, title=title,
+                             articlerows=rendering.ArticleRows(self.parser,
+                                                               articles),
+                             pagination=pagination,
+                             path=self.req.env.get('PATH_INFO'),
+                             **self.CommonBlocks(page))
+
+  def Search(self):
+    """Returns the search.html template with the articles matching ?q=."""
+    text = (self.get.getfirst('q') or '').strip()
+    query = model.Article.SearchQuery(text)
+    try:
+      page = int(self.get.getfirst('page') or 1)
+    except ValueError:
+      page = 1
+    pagination = None
+    articles = []
+    if query:
+      pagination = self.MakePagination(
+          page, model.Article.SearchCount(self.connection, query))
+    if pagination:
+      articles = rendering.AddExcerpts(list(model.Article.Search(
+          self.connection, query,
+          offset=10 * (pagination['currentpage'] - 1))))
+    return self.parser.Parse('search.html', query=text, articles=articles,
+                             articlerows=rendering.ArticleRows(self.parser,
+                                                               articles),
+                             pagination=pagination,
+                             **self.CommonBlocks('Search: %s' % text))
 
   def Comment(self, comment):
     """Returns the singlecomment.html template."""
@@ -285,29 +467,30 @@ class PageMaker(uweb3.DebuggingPageMaker,
     try:
       comment = model.Comment.FromPrimary(self.connection, comment)
       comment['date'] = comment['date'].strftime('%Y-%m-%d %H:%M:%S')
+      comment['html'] = rendering.CommentHtml(comment)
     except (uweb3.model.NotExistError, TypeError):
       return Redirect('/', httpcode=303)
     return self.parser.Parse('singlecomment.html', comment=comment, user=user,
                              **self.CommonBlocks('Comment # %s'
                                                  % comment['ID']))
 
+  @decorators.PageCached()
   @decorators.TemplateParser('alltags.html', 'alltags')
   def alltags(self):
     """Returns the alltags.html template."""
-    tags = list(model.Tags.Tagcloud(self.connection))
-    return {'tags': tags}
+    return {'tags': self._Sidebar('tagcloud')}
 
+  @decorators.PageCached()
   @decorators.TemplateParser('allauthors.html', 'allauthors')
   def allauthors(self):
     """Returns the allauthors.html template."""
-    users = list(model.User.authors(self.connection))
-    return {'users': users}
+    return {'users': self._Sidebar('authors')}
 
+  @decorators.PageCached()
   @decorators.TemplateParser('allmonths.html', 'allmonths')
   def allmonths(self):
     """Returns the allmonths.html template."""
-    menuitems = list(model.Article.ActiveMonths(self.connection))
-    return {'menuitems': menuitems}
+    return {'menuitems': self._Sidebar('activemonths')}
 
   @decorators.checkxsrf
   @decorators.TemplateParser('message.html', 'Success')
@@ -351,6 +534,7 @@ class PageMaker(uweb3.DebuggingPageMaker,
         message = 'The comment is too long.'
         return self.RequestMessage(message, 'Error', '/home')
     model.Comment.Create(self.connection, comment)
+    self._PurgePages(article, [tag['name'] for tag in article.Tags()])
     message = 'Your message has successfully been added.'
     refresh = '/home'
     return {'message': message, 'refresh': refresh, 'article': None}
@@ -375,21 +559,24 @@ class PageMaker(uweb3.DebuggingPageMaker,
   def _Login_Success(self, user):
     secure_user = { key : value for key, value in user.items() if key not in ('password', 'salt')}
 
-    self.Create('login',
-                secure_user,
-                max_age='172800')
+    with timing.Phase('cookie'):
+      self.Create('login',
+                  secure_user,
+                  max_age='172800')
     message = 'You have been logged in.'
     return self.RequestMessage(message, 'Success', '/home')
 
   def _GetUserLoggedIn(self):
     """Gets the user that is logged in from the current session."""
-    self.user = self.cookiejar.get('login')
-    print(self.cookiejar)
+    with timing.Phase('cookie'):
+      self.user = self.cookiejar.get('login')
     if self.user:
       return self.user
     raise self.NoSessionError("security error for session")
 
   def _GetXSRF(self):
+    if self._render_xsrf:
+      return self._render_xsrf
     if 'xsrf' in self.cookies:
       return self.cookies['xsrf']
 
@@ -399,10 +586,34 @@ class PageMaker(uweb3.DebuggingPageMaker,
                                   **self.CommonBlocks('Invalid XSRF token'))
     return uweb3.Response(content=page_data, httpcode=403)
 
+  def InternalServerError(self, exc_type, exc_value, traceback):
+    """Logs the exception, answers 503 when the database pool ran dry.
+
+    The request connection goes back to the pool on every error, rather than
+    when the PageMaker is garbage collected.
+    """
+    ERROR_LOGGER.error('Uncaught exception for %s %s',
+                       self.req.env.get('REQUEST_METHOD'),
+                       self.req.env.get('PATH_INFO'),
+                       exc_info=(exc_type, exc_value, traceback))
+    try:
+      if isinstance(exc_value, pool.PoolExhaustedError):
+        return uweb3.Response(
+            self.parser.Parse('503.html',
+                              blogname=self.options['blog']['name']),
+            httpcode=503, headers={'Retry-After': '5'})
+      return super(PageMaker, self).InternalServerError(
+          exc_type, exc_value, traceback)
+    finally:
+      self._ReleaseConnection()
+
   def FourOhFour(self, path):
     """The request could not be fulfilled, self returns a 404."""
-    return uweb3.Response(self.parser.Parse('404.html', path=path,
-                         **self.CommonBlocks('404')), httpcode=404)
+    try:
+      return uweb3.Response(self.parser.Parse('404.html', path=path,
+                           **self.CommonBlocks('404')), httpcode=404)
+    finally:
+      self._ReleaseConnection()
 
   def CommonBlocks(self, page, javascripts=None, OGdata=None):
     """Returns a dictionary with the header and footer in it."""
@@ -410,9 +621,7 @@ class PageMaker(uweb3.DebuggingPageMaker,
     blogOptions = self.options['blog']
     blogcopyright = time.strftime('%Y')
     blogpoweredby = uweb3.__version__
-    tags = list(model.Tags.Tagcloud(self.connection))[:10]
-    users = list(model.User.authors(self.connection))[:10]
-    menuitems = list(model.Article.ActiveMonths(self.connection))[:10]
+    tags, users, menuitems = self._SidebarMenus()
     try:
       user = self._GetUserLoggedIn()
     except (uweb3.model.NotExistError, self.NoSessionError):
@@ -427,11 +636,239 @@ class PageMaker(uweb3.DebuggingPageMaker,
                                     menuitems=menuitems, tags=tags, user=user,
                                     xsrftoken=xsrftoken,
                                     users=users, OGdata=OGdata),
-        'footer': self.parser.Parse('footer.html', blogcopyright=blogcopyright,
-                                    blogtitle=blogOptions['title'], user=user,
-                                    blogpoweredby=blogpoweredby),
+        'footer': self.parser.ParseStatic(
+            'footer.html', (blogcopyright, blogOptions['title'], bool(user)),
+            blogcopyright=blogcopyright, blogtitle=blogOptions['title'],
+            user=user, blogpoweredby=blogpoweredby),
         'xsrftoken': xsrftoken}
 
+  def _Sidebar(self, block):
+    """Returns the full dataset for one of the sidebar blocks.
+
+    The datasets are shared through the sidebar cache, the admin pages
+    invalidate them whenever an article, tag or user is written.
+    """
+    return self._Sidebars((block,))[0][block]
+
+  def _Sidebars(self, blocks, querybatch=None):
+    """Returns the datasets for the given sidebar blocks, and batch results.
+
+    Blocks that are not cached are loaded in a single query batch, together
+    with the queries already added to the given batch.
+
+    Returns:
+      (dict of datasets by block, dict of rows by key for the batch queries)
+    """
+    querybatch = querybatch or self._QueryBatch()
+    sidebars = {}
+    for block in blocks:
+      sidebars[block] = cache.SIDEBAR.Peek(block)
+      if sidebars[block] is None:
+        name, params = queries.SIDEBAR[block]
+        querybatch.Add(('sidebar', block), name, **params)
+    results = self._RunBatch(querybatch) if querybatch.queries else {}
+    for block in blocks:
+      if sidebars[block] is None:
+        sidebars[block] = results.pop(('sidebar', block))
+        cache.SIDEBAR.Set(block, sidebars[block])
+    return sidebars, results
+
+  def _SidebarMenus(self):
+    """Returns the tags, authors and months as shown in the sidebar menus."""
+    sidebars, _results = self._Sidebars(SIDEBAR_MENUS)
+    return (sidebars['toptags'],
+            sidebars['authors'][:10],
+            sidebars['activemonths'][:10])
+
+  @property
+  def connection(self):
+    """Returns the connection of this request, checked out of the pool.
+
+    The connection returns to the pool once the response is built, or once
+    the error page is built when the request failed. Garbage collection of
+    the PageMaker returns it as a last resort.
+    """
+    if self._pooledconnection is None:
+      connectionpool = pool.Configure(self.options.get('mysql'))
+      with timing.Phase('db'):
+        self._pooledconnection = connectionpool.Checkout()
+      self._release = weakref.finalize(
+          self, connectionpool.Checkin, self._pooledconnection)
+    return self._pooledconnection
+
+  def _ReleaseConnection(self):
+    """Returns the request connection to the pool, if one was checked out."""
+    if self._release is not None:
+      self._release()
+      self._pooledconnection = self._release = None
+
+  def _QueryBatch(self):
+    """Returns a new batch of queries to run on the connection pool."""
+    return batch.QueryBatch(pool.Configure(self.options.get('mysql')),
+                            self.connection)
+
+  def _RunBatch(self, querybatch):
+    """Runs a query batch and records its timings for this request."""
+    try:
+      with timing.Phase('db'):
+        return querybatch.Run()
+    finally:
+      self.querytimings.extend(querybatch.timings)
+
+  @property
+  def parser(self):
+    """Returns the compiled template parser, timing it when sampled."""
+    parser = templating.Configure(
+        self.options.get('templates'),
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+    if self.timer is None:
+      return parser
+    return timing.TimedParser(parser)
+
+  def _PostRequest(self, response):
+    """Releases the connection and reports the request to the access log.
+
+    Every access record has the number of statements the request sent and
+    the time they took. Sampled requests also get a Server-Timing header, and
+    their phase timings in the access record. In development mode the query
+    batch timings are added as well.
+    """
+    response = super(PageMaker, self)._PostRequest(response)
+    self._ReleaseConnection()
+    method = self.req.env.get('REQUEST_METHOD')
+    path = self.req.env.get('PATH_INFO')
+    route, presenter = _Route(path or '/')
+    fields = {'method': method,
+              'path': path,
+              'route': route,
+              'presenter': presenter,
+              'status': getattr(response, 'httpcode', None),
+              'latency_ms': round((time.perf_counter() - self.started) * 1000,
+                                  1),
+              'cache': self.cachestatus,
+              'remote': self.req.env.get('REMOTE_ADDR')}
+    if self.querycounter is not None:
+      fields['queries'] = self.querycounter.count
+      fields['query_ms'] = round(self.querycounter.seconds * 1000, 1)
+    if self.timer is not None:
+      response.headers['Server-Timing'] = self.timer.ServerTiming()
+      fields.update(('%s_ms' % phase, milliseconds) for phase, milliseconds
+                    in self.timer.Milliseconds().items() if phase != 'total')
+    timing.Stop()
+    ACCESS_LOGGER.info('%s %s', method, path, extra={'fields': fields})
+    if self.querytimings and self.options.get('development', {}).get(
+        'dev') == 'True':
+      response.headers['X-Query-Timings'] = ', '.join(
+          '%s;rows=%d;dur=%.1f' % (querytiming['query'], querytiming['rows'],
+                                   querytiming['seconds'] * 1000)
+          for querytiming in self.querytimings)
+    return response
+
+  def _SidebarFingerprint(self):
+    """Returns a digest of the sidebar menus as shown on every page."""
+    return cache.SIDEBAR.Get('fingerprint', lambda: hashlib.sha1(
+        repr(self._SidebarMenus()).encode('utf-8')).hexdigest())
+
+  def _PageKey(self, key, generation=None):
+    """Returns the page cache key for a presenter name and its arguments."""
+    return (cache.PAGES.Generation('pages'),
+            generation and cache.PAGES.Generation(generation), key)
+
+  def _NotModified(self, stamps, *identity, modifiedsince=True):
+    """Sets the cache validators for a page built from the given data.
+
+    The ETag covers the newest of the stamps, the identity of what is shown,
+    the sidebar and the visitor's xsrf and login cookies, since all of those
+    end up in the page. Last-Modified is the newest of the stamps.
+
+    Arguments:
+      stamps: iterable of datetimes (or None) at which the shown data changed.
+      *identity: further values that make up the page, such as article IDs.
+      modifiedsince: bool, answer If-Modified-Since. Listings pass False: an
+          article dropping out of a listing, or an older one moving in, does
+          not move the newest stamp, so only the ETag tells those apart.
+
+    Returns:
+      uweb3.Response with status 304 if the client's copy is still current,
+      None otherwise, in which case the validators are added to the response.
+    """
+    stamps = [stamp for stamp in stamps if stamp]
+    if not stamps or self.req.env.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+      return None
+    lastmodified = max(stamps).replace(microsecond=0)
+    self._validator = lastmodified, identity, modifiedsince
+    timestamp = time.mktime(lastmodified.timetuple())
+    etag = 'W/"%s"' % hashlib.sha1(repr((
+        lastmodified, identity, self._SidebarFingerprint(),
+        self.cookies.get('xsrf'), self.cookies.get('login'))).encode(
+            'utf-8')).hexdigest()[:24]
+    headers = {'ETag': etag,
+               'Last-Modified': email.utils.formatdate(timestamp, usegmt=True),
+               'Cache-Control': 'private, no-cache'}
+    nonematch = self.req.env.get('HTTP_IF_NONE_MATCH')
+    ifmodifiedsince = self.req.env.get('HTTP_IF_MODIFIED_SINCE')
+    if nonematch is not None:
+      tags = [tag.strip().replace('W/', '', 1) for tag in nonematch.split(',')]
+      fresh = '*' in tags or etag.replace('W/', '', 1) in tags
+    elif ifmodifiedsince and modifiedsince:
+      try:
+        fresh = email.utils.parsedate_to_datetime(
+            ifmodifiedsince).timestamp() >= timestamp
+      except (TypeError, ValueError):
+        fresh = False
+    else:
+      fresh = False
+    if fresh:
+      return uweb3.Response(content='', httpcode=304, headers=headers)
+    for name, value in headers.items():
+      self.req.AddHeader(name, value)
+    return None
+
+  def _ListingNotModified(self, articles, *identity):
+    """Runs _NotModified for a page that lists the given articles."""
+    stamps = [article['lastchange'] for article in articles]
+    stamps.extend(article['lastcomment'] for article in articles)
+    return self._NotModified(
+        stamps, [article['ID'] for article in articles], *identity,
+        modifiedsince=False)
+
+  def _CachedPage(self, key, generation, render):
+    """Returns the page for key from the page cache, rendering it on a miss.
+
+    Only anonymous GET requests are served from the cache. Pages are rendered
+    with a placeholder for the xsrf token, which is filled in per request, and
+    stored with the sidebar fingerprint they were rendered with so a changed
+    sidebar makes them stale.
+    """
+    if self.req.env.get('REQUEST_METHOD') != 'GET' or 'login' in self.cookies:
+      self.cachestatus = 'bypass'
+      return render()
+    key = self._PageKey(key, generation)
+    fingerprint = self._SidebarFingerprint()
+    entry = cache.PAGES.Peek(key)
+    self.cachestatus = 'hit'
+    if entry is None or entry[0] != fingerprint:
+      self.cachestatus = 'miss'
+      self._render_xsrf = self.XSRF_PLACEHOLDER
+      try:
+        page = render()
+      finally:
+        self._render_xsrf = None
+      if isinstance(page, uweb3.Response):
+        page.content = page.content.replace(self.XSRF_PLACEHOLDER,
+                                            str(self._GetXSRF()))
+      if not isinstance(page, str):
+        return page
+      entry = fingerprint, str(page), self._validator
+      cache.PAGES.Set(key, entry)
+    elif entry[2]:
+      lastmodified, identity, modifiedsince = entry[2]
+      notmodified = self._NotModified((lastmodified,), *identity,
+                                      modifiedsince=modifiedsince)
+      if notmodified:
+        return notmodified
+    return entry[1].replace(self.XSRF_PLACEHOLDER, str(self._GetXSRF()))
+
   def MakePagination(self, currentpage, totalcount, pageposts=10, maxlinks=10):
     """Returns a dictionary with pages and page information.
 
@@ -450,7 +887,7 @@ class PageMaker(uweb3.DebuggingPageMaker,
       first: int of first page, if necessary
       last: int of last page, if necessary
       """
-    totalpages = int(((totalcount + (pageposts - 1)) / pageposts))
+    totalpages = (totalcount + (pageposts - 1)) // pageposts
     if totalpages < 1:
       return None
     currentpage = min(max(currentpage, 1), totalpages)
@@ -463,13 +900,13 @@ class PageMaker(uweb3.DebuggingPageMaker,
     pagination['last'] = totalpages if currentpage != totalpages else None
     pagination['pagenumbers'] = []
     if totalpages <= maxlinks + 1:
-      pagination['pagenumbers'] = range(1, totalpages + 1)
+      pagination['pagenumbers'] = list(range(1, totalpages + 1))
     else:
-      for x in xrange(currentpage - (maxlinks / 2), currentpage):
+      for x in range(currentpage - (maxlinks // 2), currentpage):
         if x > 0:
           pagination['pagenumbers'].append(x)
       pagination['pagenumbers'].append(currentpage)
-      for x in xrange(currentpage + 1, currentpage + (maxlinks / 2) + 1):
+      for x in range(currentpage + 1, currentpage + (maxlinks // 2) + 1):
         if x <= totalpages:
           pagination['pagenumbers'].append(x)
     return pagination
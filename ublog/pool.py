@@ -0,0 +1,215 @@
+#!/usr/bin/python
+"""A process-wide pool of MySQL connections.
+
+The PageMaker checks its request connection out of this pool, and query
+batches borrow further connections from it to run queries in parallel. The
+pool is configured by the [mysql] section of the configuration, so a worker
+keeps a bounded number of connections open instead of opening one for every
+request.
+"""
+
+# Standard modules
+import collections
+import contextlib
+import threading
+import time
+
+# Third-party modules
+from uweb3.ext_lib.libs.sqltalk import mysql
+
+# Application components
+from . import profiling
+
+
+class PoolExhaustedError(Exception):
+  """No connection became available within the pool's checkout timeout."""
+
+
+class ConnectionPool(object):
+  """Hands out up to `size` connections, creating them as they are needed.
+
+  Arguments:
+    options: dict, the connection settings of the [mysql] section.
+    size: int, the maximum number of open connections.
+    max_idle: int (opt), the maximum number of idle connections kept open.
+        Connections returned beyond that are closed. Defaults to size.
+    recycle: int, seconds after which a connection is replaced on checkout,
+        0 to keep connections for ever.
+    ping: bool, whether a connection is pinged on checkout and replaced if
+        the server went away.
+    timeout: float, seconds a checkout waits for a connection to be returned
+        when all of them are in use.
+  """
+
+  def __init__(self, options, size=4, max_idle=None, recycle=3600, ping=True,
+               timeout=10):
+    self.options = dict(options)
+    self.size = size
+    self.max_idle = size if max_idle is None else max_idle
+    self.recycle = recycle
+    self.ping = ping
+    self.timeout = timeout
+    self._idle = collections.deque()
+    self._born = {}
+    self._open = 0
+    self._condition = threading.Condition()
+    self.checkouts = 0
+    self.waits = 0
+    self.waittime = 0.0
+    self.maxwait = 0.0
+    self.timeouts = 0
+    self.created = 0
+    self.recycled = 0
+    self.pingfailures = 0
+
+  def _Connect(self):
+    connection = mysql.Connect(host=self.options.get('host', 'localhost'),
+                               user=self.options.get('user'),
+                               passwd=self.options.get('password'),
+                               db=self.options.get('database'),
+                               charset='utf8')
+    profiling.Instrument(connection)
+    with self._condition:
+      self._born[id(connection)] = time.monotonic()
+      self.created += 1
+    return connection
+
+  def _Close(self, connection):
+    """Closes a connection and forgets about it, the caller holds the lock."""
+    self._born.pop(id(connection), None)
+    try:
+      connection.close()
+    except Exception:
+      pass
+
+  def Checkout(self, timeout=None):
+    """Returns a connection for the exclusive use of the caller.
+
+    Arguments:
+      timeout: float (opt), seconds to wait when the pool is exhausted,
+          defaults to the timeout of the pool. 0 does not wait at all.
+
+    Raises:
+      PoolExhaustedError: no connection became available in time.
+    """
+    timeout = self.timeout if timeout is None else timeout
+    start = time.monotonic()
+    with self._condition:
+      while not self._idle and self._open >= self.size:
+        remaining = start + timeout - time.monotonic()
+        if remaining <= 0:
+          self.timeouts += 1
+          raise PoolExhaustedError(
+              'All %d database connections are in use.' % self.size)
+        self._condition.wait(remaining)
+      waited = time.monotonic() - start
+      self.checkouts += 1
+      if waited > 0.001:
+        self.waits += 1
+        self.waittime += waited
+        self.maxwait = max(self.maxwait, waited)
+      if self._idle:
+        connection = self._idle.pop()
+      else:
+        connection = None
+        self._open += 1
+    try:
+      if connection is None:
+        return self._Connect()
+      return self._Validate(connection)
+    except Exception:
+      with self._condition:
+        self._open -= 1
+        self._condition.notify()
+      raise
+
+  def _Validate(self, connection):
+    """Returns the connection, or a new one if it is too old or went away."""
+    with self._condition:
+      born = self._born.get(id(connection), 0)
+    if self.recycle and time.monotonic() - born > self.recycle:
+      with self._condition:
+        self.recycled += 1
+        self._Close(connection)
+      return self._Connect()
+    if self.ping:
+      try:
+        connection.ping()
+      except Exception:
+        with self._condition:
+          self.pingfailures += 1
+          self._Close(connection)
+        return self._Connect()
+    return connection
+
+  def Checkin(self, connection):
+    """Returns a connection to the pool, or closes it if enough are idle."""
+    with self._condition:
+      if len(self._idle) >= self.max_idle:
+        self._Close(connection)
+        self._open -= 1
+      else:
+        self._idle.append(connection)
+      self._condition.notify()
+
+  @contextlib.contextmanager
+  def Connection(self, timeout=None):
+    """Yields a connection, which returns to the pool when the block exits."""
+    connection = self.Checkout(timeout=timeout)
+    try:
+      yield connection
+    finally:
+      self.Checkin(connection)
+
+  def Stats(self):
+    """Returns a dictionary with the state and wait-time metrics of the pool."""
+    with self._condition:
+      return {'size': self.size,
+              'open': self._open,
+              'idle': len(self._idle),
+              'inuse': self._open - len(self._idle),
+              'checkouts': self.checkouts,
+              'waits': self.waits,
+              'waittime': self.waittime,
+              'meanwait': self.waittime / self.waits if self.waits else 0.0,
+              'maxwait': self.maxwait,
+              'timeouts': self.timeouts,
+              'created': self.created,
+              'recycled': self.recycled,
+              'pingfailures': self.pingfailures}
+
+
+POOL = None
+_configured = None
+_configure_lock = threading.Lock()
+
+
+def Configure(options):
+  """Creates the pool from the [mysql] section, if it changed.
+
+  Recognised options, next to the connection settings:
+    pool_size: the maximum number of open connections, default 4.
+    pool_max_idle: the maximum number of idle connections, default pool_size.
+    pool_recycle: seconds after which connections are replaced, default 3600.
+    pool_ping: 'True' (default) to ping connections on checkout.
+    pool_timeout: seconds to wait for a connection when all are in use,
+        default 10.
+  """
+  global POOL, _configured
+  options = dict(options or {})
+  with _configure_lock:
+    if options != _configured:
+      size = int(options.get('pool_size', 4))
+      POOL = ConnectionPool(
+          options, size=size,
+          max_idle=int(options.get('pool_max_idle', size)),
+          recycle=int(options.get('pool_recycle', 3600)),
+          ping=options.get('pool_ping', 'True') == 'True',
+          timeout=float(options.get('pool_timeout', 10)))
+      _configured = options
+  return POOL
+
+
+def Stats():
+  """Returns the metrics of the configured pool, None if there is none."""
+  return POOL and POOL.Stats()
@@ -0,0 +1,197 @@
+#!/usr/bin/python
+"""Opt-in statistics on the queries, per query name.
+
+When the [profiling] section enables it, queries.Execute reports every query
+it runs here, with its duration, the number of rows it returned and the
+presenter it ran for. Statements sent through the cursor otherwise, such as
+those of uweb3 records and the tag sync, the recounts and the set-based
+deletes built by the model, are reported by the pooled connections under
+their statement and table. Queries slower than the configured threshold are
+logged with the EXPLAIN output of the statement.
+"""
+
+# Standard modules
+import collections
+import contextvars
+import logging
+import re
+import sys
+import threading
+import time
+
+# Application components
+from . import timing
+
+ENABLED = False
+SLOW_SECONDS = None
+SAMPLES = 1000
+
+LOGGER = logging.getLogger('ublog.slowquery')
+
+# Set while a query batch runs on behalf of a presenter in another thread.
+PRESENTER = contextvars.ContextVar('presenter', default=None)
+
+# Set while queries.Execute runs and records a registered query, so that the
+# statements it sends are not recorded a second time by the connection.
+QUERY = contextvars.ContextVar('query', default=None)
+
+
+class QueryStats(object):
+  """Counters for a single query name.
+
+  Percentiles are computed over the most recent SAMPLES durations.
+  """
+
+  def __init__(self, name):
+    self.name = name
+    self.count = 0
+    self.seconds = 0.0
+    self.maxseconds = 0.0
+    self.rows = 0
+    self.samples = collections.deque(maxlen=SAMPLES)
+    self.presenters = collections.Counter()
+
+  def Add(self, seconds, rows, presenter):
+    self.count += 1
+    self.seconds += seconds
+    self.maxseconds = max(self.maxseconds, seconds)
+    self.rows += rows
+    self.samples.append(seconds)
+    self.presenters[presenter] += 1
+
+  def Percentile(self, percent):
+    """Returns the given percentile of the sampled durations, in seconds."""
+    if not self.samples:
+      return 0.0
+    samples = sorted(self.samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+  def Summary(self):
+    """Returns the counters as a dictionary, durations in milliseconds."""
+    return {'query': self.name,
+            'count': self.count,
+            'total_ms': round(self.seconds * 1000, 3),
+            'mean_ms': round(self.seconds * 1000 / self.count, 3),
+            'p50_ms': round(self.Percentile(50) * 1000, 3),
+            'p95_ms': round(self.Percentile(95) * 1000, 3),
+            'p99_ms': round(self.Percentile(99) * 1000, 3),
+            'max_ms': round(self.maxseconds * 1000, 3),
+            'rows': self.rows,
+            'mean_rows': round(float(self.rows) / self.count, 1),
+            'presenters': dict(self.presenters.most_common())}
+
+
+_stats = {}
+_lock = threading.Lock()
+
+
+def Configure(options):
+  """Reads the [profiling] section.
+
+  Recognised options:
+    enabled: 'True' to record query statistics, default 'False'.
+    slow_ms: queries taking at least this many milliseconds are logged with
+        their EXPLAIN output. Not set by default.
+  """
+  global ENABLED, SLOW_SECONDS
+  options = dict(options or {})
+  ENABLED = options.get('enabled', 'False') == 'True'
+  slow = options.get('slow_ms')
+  SLOW_SECONDS = float(slow) / 1000 if slow else None
+
+
+def CurrentPresenter():
+  """Returns the name of the presenter method the running query is for.
+
+  This is the outermost public method of a PageMaker on the stack, or the
+  presenter that started the running query batch.
+  """
+  from .pages import PageMaker
+  presenter = PRESENTER.get()
+  if presenter:
+    return presenter
+  frame = sys._getframe(1)
+  while frame is not None:
+    owner = frame.f_locals.get('self')
+    name = frame.f_code.co_name
+    if not name.startswith('_') and isinstance(owner, PageMaker):
+      presenter = '%s.%s' % (type(owner).__name__, name)
+    frame = frame.f_back
+  return presenter or '-'
+
+
+def Record(name, seconds, rows):
+  """Adds a query run to the statistics of its name."""
+  presenter = CurrentPresenter()
+  with _lock:
+    if name not in _stats:
+      _stats[name] = QueryStats(name)
+    _stats[name].Add(seconds, rows, presenter)
+
+
+def StatementName(statement):
+  """Returns the name statements outside the query registry are recorded as.
+
+  This is the statement's verb and the table it reads or writes, such as
+  'insert comment' or 'delete articletags'.
+  """
+  verb = statement.split(None, 1)[0].lower() if statement.strip() else '-'
+  table = re.search(r'\b(?:from|into|update)\s+`?(\w+)', statement, re.I)
+  return '%s %s' % (verb, table.group(1)) if table else verb
+
+
+def Instrument(connection):
+  """Makes a sqltalk connection report the statements it runs.
+
+  Every cursor method of sqltalk sends its statement through the Query method
+  of the connection, which is wrapped here. Each statement is counted towards
+  the running request by timing.CountQuery. When profiling is enabled it is
+  also recorded here, unless it belongs to a registered query, which
+  queries.Execute records under its query name.
+
+  Returns:
+    the connection.
+  """
+  query = connection.Query
+
+  def Query(statement, *args, **kwds):
+    start = time.perf_counter()
+    result = query(statement, *args, **kwds)
+    seconds = time.perf_counter() - start
+    timing.CountQuery(seconds)
+    if not ENABLED or QUERY.get() is not None:
+      return result
+    if isinstance(statement, bytes):
+      statement = statement.decode('utf-8')
+    name = StatementName(statement)
+    Record(name, seconds, len(result or ()))
+    if IsSlow(seconds) and name.startswith('select'):
+      LogSlow(name, seconds, statement, query('explain %s' % statement))
+    return result
+
+  connection.Query = Query
+  return connection
+
+
+def IsSlow(seconds):
+  return SLOW_SECONDS is not None and seconds >= SLOW_SECONDS
+
+
+def LogSlow(name, seconds, statement, explain):
+  """Logs a slow query with the rows of its EXPLAIN output."""
+  LOGGER.warning('Slow query %s took %.1f ms for %s:\n%s\n%s', name,
+                 seconds * 1000, CurrentPresenter(), statement.strip(),
+                 '\n'.join(repr(dict(row)) for row in explain))
+
+
+def Stats():
+  """Returns the statistics of all query names, most total time first."""
+  with _lock:
+    summaries = [stats.Summary() for stats in _stats.values()]
+  return sorted(summaries, key=lambda summary: -summary['total_ms'])
+
+
+def Reset():
+  """Discards all collected statistics."""
+  with _lock:
+    _stats.clear()
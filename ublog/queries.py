@@ -0,0 +1,557 @@
+#!/usr/bin/python
+"""The registry of SQL statements used by the model and the async presenters.
+
+Each statement is defined once, with its values bound through %(name)s
+placeholders, so the same text serves the sqltalk cursor (through Execute)
+and DB-API drivers such as aiomysql, which bind the parameters themselves.
+Parameters are passed as keyword arguments next to the query name, so none
+may be called 'name', 'connection' or 'cursor'.
+Statements built around IN lists of variable length, such as the tag sync,
+the counter recounts and the set-based deletes, are not registered; the
+model builds those itself from integers and escaped values.
+
+When the [mysql] section sets prepared_statements, Execute prepares each
+statement on the server once per connection. Otherwise, and by default, the
+values are escaped into the statement text. The sqltalk cursor speaks the
+text protocol only, so a prepared statement with parameters costs two round
+trips per run, SET and EXECUTE, against one for a text query. That is
+slower unless the server spends more time parsing and planning a statement
+than a round trip takes; compare both on your setup with
+'python manage.py benchmark-queries' before enabling it.
+"""
+
+# Standard modules
+import re
+import threading
+import time
+import weakref
+
+# Application components
+from . import profiling
+from . import timing
+
+LISTING_FIELDS = """
+      article.ID,
+      article.title,
+      article.titlehtml,
+      article.excerpt,
+      user.author,
+      article.user,
+      article.date,
+      article.lastchange,
+      article.comment_count as comments,
+      article.lastcomment"""
+
+QUERIES = {
+    'article_lastn': """
+        select""" + LISTING_FIELDS + """,
+          article.commentable,
+          article.public
+        from
+          (select ID
+           from article
+           where
+             public = %(public)s and
+             (%(before)s is null or ID < %(before)s)
+           order by ID desc
+           limit %(count)s offset %(offset)s) as page
+          join article on (article.ID = page.ID)
+          join user on (article.user = user.ID)
+        order by article.ID desc
+        """,
+
+    'article_count': """
+        select count(*) as count
+        from article
+        where public = %(public)s
+        """,
+
+    'article_daterange': """
+        select""" + LISTING_FIELDS + """
+        from
+          user,
+          article
+        where
+          article.public = 'true' and
+          article.user = user.ID and
+          article.date >= %(start)s and
+          article.date < %(end)s
+        order by article.date desc, article.ID desc
+        limit %(count)s offset %(offset)s
+        """,
+
+    'article_daterange_count': """
+        select count(*) as count
+        from article
+        where
+          public = 'true' and
+          date >= %(start)s and
+          date < %(end)s
+        """,
+
+    'article_tag': """
+        select""" + LISTING_FIELDS + """
+        from
+          user,
+          article
+        where
+          article.public = 'true' and
+          article.user = user.ID and
+          article.ID in (select articletags.articleid
+                         from articletags, tags
+                         where articletags.tagid = tags.ID and
+                               tags.name = %(tag)s)
+        order by article.ID desc
+        limit %(count)s offset %(offset)s
+        """,
+
+    'article_tag_count': """
+        select count(*) as count
+        from
+          articletags
+          join tags on (tags.ID = articletags.tagid)
+          join article on (article.ID = articletags.articleid)
+        where
+          tags.name = %(tag)s and
+          article.public = 'true'
+        """,
+
+    'article_user': """
+        select""" + LISTING_FIELDS + """
+        from
+          user,
+          article
+        where
+          article.public = 'true' and
+          article.user = user.ID and
+          article.user = %(user)s
+        order by article.ID desc
+        limit %(count)s offset %(offset)s
+        """,
+
+    'article_user_count': """
+        select count(*) as count
+        from article
+        where
+          public = 'true' and
+          user = %(user)s
+        """,
+
+    'article_byid': """
+        select
+          article.*,
+          user.author
+        from
+          article
+          join user on (article.user = user.ID)
+        where article.ID = %(article)s
+        """,
+
+    'article_tags': """
+        select tags.name
+        from
+          articletags,
+          tags
+        where
+          articletags.articleid = %(article)s and
+          articletags.tagid = tags.ID
+        """,
+
+    'article_comments': """
+        select
+          comment.ID,
+          comment.content,
+          user.author,
+          comment.user,
+          user.admin,
+          comment.date
+        from
+          comment,
+          user
+        where
+          comment.user = user.ID and
+          comment.article = %(article)s
+        order by comment.date desc
+        limit %(limit)s offset %(offset)s
+        """,
+
+    'tagcloud': """
+        select
+          tagcounts.tagid,
+          tags.name,
+          tagcounts.count
+        from
+          tagcounts,
+          tags
+        where
+          tagcounts.tagid = tags.ID and
+          tagcounts.count > 0
+        order by tagcounts.count desc, tags.name
+        """,
+
+    'tagcloud_top': """
+        select
+          tagcounts.tagid,
+          tags.name,
+          tagcounts.count
+        from
+          tagcounts,
+          tags
+        where
+          tagcounts.tagid = tags.ID and
+          tagcounts.count > 0
+        order by tagcounts.count desc, tagcounts.tagid desc
+        limit %(limit)s
+        """,
+
+    'authors': """
+        select
+          user.ID,
+          author,
+          count(article.user) as count
+        from
+          user,
+          article
+        where
+          user.admin = true and
+          user.active = true and
+          user.ID = article.user and
+          article.public = true
+        group by user.ID
+        """,
+
+    'activemonths': """
+        select
+          month,
+          year,
+          count
+        from
+          articlemonths
+        where
+          count > 0
+        order by month, year desc
+        """,
+
+    'user_byid': """
+        select *
+        from user
+        where ID = %(user)s
+        """,
+
+    'user_byname': """
+        select *
+        from user
+        where name = %(username)s
+        """,
+
+    'user_byauthor': """
+        select *
+        from user
+        where author = %(author)s
+        """,
+
+    'user_comments': """
+        select
+          comment.ID,
+          comment.content,
+          comment.date,
+          comment.user,
+          comment.article,
+          article.title
+        from
+          comment,
+          article
+        where
+          comment.user = %(user)s and
+          article.ID = comment.article
+        order by article.ID desc, comment.date desc
+        limit %(limit)s offset %(offset)s
+        """,
+
+    'user_commentcount': """
+        select count(*) as count
+        from comment
+          join article on (article.ID = comment.article)
+        where comment.user = %(user)s
+        """,
+
+    'user_articleids': """
+        select ID
+        from article
+        where user = %(user)s
+        """,
+
+    'user_commented': """
+        select distinct article
+        from comment
+        where user = %(user)s
+        """,
+
+    'article_byuser': """
+        select *
+        from article
+        where user = %(user)s
+        """,
+
+    'article_validator': """
+        select
+          ID,
+          lastchange,
+          lastcomment,
+          comment_count as comments
+        from article
+        where ID = %(article)s
+        """,
+
+    'article_public': """
+        select public
+        from article
+        where ID = %(article)s
+        """,
+
+    'article_tagids': """
+        select tagid
+        from articletags
+        where articleid = %(article)s
+        """,
+
+    'article_taglinks': """
+        select articletags.tagid, tags.name
+        from articletags
+          join tags on (tags.ID = articletags.tagid)
+        where articletags.articleid = %(article)s
+        """,
+
+    'article_commentadded': """
+        update article
+        set
+          comment_count = comment_count + 1,
+          lastcomment = greatest(coalesce(lastcomment, %(date)s), %(date)s)
+        where ID = %(article)s
+        """,
+
+    'articlemonths_recount': """
+        replace into articlemonths (year, month, count)
+        select %(year)s, %(month)s, count(*)
+        from article
+        where
+          public = 'true' and
+          date >= %(start)s and
+          date < %(end)s
+        """,
+
+    'tag_byname': """
+        select *
+        from tags
+        where name = %(tag)s
+        limit 1
+        """,
+
+    'comment_byuser': """
+        select *
+        from comment
+        where user = %(user)s
+        """,
+
+    'article_stored': """
+        select public, title, content
+        from article
+        where ID = %(article)s
+        """,
+
+    'article_content': """
+        select content
+        from article
+        where ID = %(article)s
+        """,
+
+    'article_contents': """
+        select ID, title, content
+        from article
+        where ID > %(after)s
+        order by ID
+        limit %(count)s
+        """,
+
+    'article_setrendered': """
+        update article
+        set
+          excerpt = %(excerpt)s,
+          titlehtml = %(titlehtml)s
+        where ID = %(article)s
+        """,
+
+    'export_articles': """
+        select
+          article.ID,
+          article.title,
+          article.user,
+          user.author,
+          article.date,
+          article.lastchange,
+          article.comment_count as comments,
+          article.lastcomment
+        from
+          article
+          join user on (article.user = user.ID)
+        where article.public = 'true'
+        order by article.ID desc
+        """,
+
+    'export_tags': """
+        select articletags.articleid, tags.name
+        from
+          articletags
+          join tags on (tags.ID = articletags.tagid)
+          join article on (article.ID = articletags.articleid)
+        where article.public = 'true'
+        """,
+
+    'comment_byarticle': """
+        select *
+        from comment
+        where article = %(article)s
+        """,
+}
+
+# Yields (ID, score) for every match of a boolean mode query. Articles are
+# scored on their title (weighted double) and their full text, comments add
+# half of their own score to the article they are on.
+SEARCH_HITS = """
+          select article.ID,
+                 2 * match(article.title) against (%(query)s in boolean mode) +
+                 match(article.title, article.content)
+                   against (%(query)s in boolean mode) as score
+          from article
+          where
+            article.public = 'true' and
+            match(article.title, article.content)
+              against (%(query)s in boolean mode)
+          union all
+          select comment.article as ID,
+                 0.5 * match(comment.content)
+                   against (%(query)s in boolean mode) as score
+          from comment
+            join article on (article.ID = comment.article)
+          where
+            article.public = 'true' and
+            match(comment.content) against (%(query)s in boolean mode)"""
+
+QUERIES['article_search'] = """
+        select""" + LISTING_FIELDS + """,
+          page.score
+        from
+          (select hits.ID, sum(hits.score) as score
+           from (""" + SEARCH_HITS + """) as hits
+           group by hits.ID
+           order by score desc, hits.ID desc
+           limit %(count)s offset %(offset)s) as page
+          join article on (article.ID = page.ID)
+          join user on (article.user = user.ID)
+        order by page.score desc, article.ID desc
+        """
+
+QUERIES['article_searchcount'] = """
+        select count(distinct hits.ID) as count
+        from (""" + SEARCH_HITS + """) as hits
+        """
+
+
+_PLACEHOLDER = re.compile(r'%\((\w+)\)s')
+
+PREPARED = False
+# The names of the statements prepared on each connection.
+_prepared = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+
+def Configure(options):
+  """Enables server-side prepared statements if the [mysql] section asks so."""
+  global PREPARED
+  PREPARED = dict(options or {}).get('prepared_statements', 'False') == 'True'
+
+
+def _Escape(connection, value):
+  """Escapes a value for the connection, None becomes SQL null."""
+  return 'null' if value is None else connection.EscapeValues(value)
+
+
+def Format(connection, name, **params):
+  """Returns the named query with the parameters escaped for the connection."""
+  return QUERIES[name] % dict(
+      (key, _Escape(connection, value)) for key, value in params.items())
+
+
+def Prepared(name):
+  """Returns the named query with ? markers, and the parameter for each."""
+  return (_PLACEHOLDER.sub('?', QUERIES[name]),
+          _PLACEHOLDER.findall(QUERIES[name]))
+
+
+def Execute(connection, cursor, name, **params):
+  """Runs the named query on a cursor of the connection, returns its result.
+
+  When profiling is enabled the run is recorded under the query name, and
+  slow selects are logged with their EXPLAIN output.
+  """
+  with timing.Phase('db'):
+    if not profiling.ENABLED:
+      return _Execute(connection, cursor, name, params)
+    token = profiling.QUERY.set(name)
+    try:
+      start = time.perf_counter()
+      result = _Execute(connection, cursor, name, params)
+      seconds = time.perf_counter() - start
+      profiling.Record(name, seconds, len(result))
+      if profiling.IsSlow(seconds) and QUERIES[name].lstrip().startswith(
+          'select'):
+        statement = Format(connection, name, **params)
+        profiling.LogSlow(name, seconds, statement,
+                          cursor.Execute('explain %s' % statement))
+      return result
+    finally:
+      profiling.QUERY.reset(token)
+
+
+def _Execute(connection, cursor, name, params):
+  """Runs the named query, preparing it on the server if that is enabled.
+
+  With prepared statements enabled, the statement is prepared on the first
+  use on a connection. The parameters are set as user variables and passed
+  to EXECUTE, as the sqltalk cursor speaks the text protocol only, which
+  takes an extra round trip per run. A statement the server lost, after a
+  reconnect, is prepared again.
+  """
+  if not PREPARED:
+    return cursor.Execute(Format(connection, name, **params))
+  statement = 'ublog_%s' % name
+  text, order = Prepared(name)
+  with _prepared_lock:
+    prepared = _prepared.setdefault(connection, set())
+  if name not in prepared:
+    cursor.Execute('prepare %s from %s' % (
+        statement, connection.EscapeValues(text)))
+    prepared.add(name)
+  execute = 'execute %s' % statement
+  if order:
+    cursor.Execute('set %s' % ', '.join(
+        '@ublog_%s = %s' % (key, _Escape(connection, params[key]))
+        for key in sorted(set(order))))
+    execute += ' using %s' % ', '.join('@ublog_%s' % key for key in order)
+  try:
+    return cursor.Execute(execute)
+  except Exception as error:
+    if 'Unknown prepared statement' not in str(error):
+      raise
+    prepared.discard(name)
+    cursor.Execute('prepare %s from %s' % (
+        statement, connection.EscapeValues(text)))
+    prepared.add(name)
+    return cursor.Execute(execute)
+
+
+# The query and parameters that load each of the sidebar blocks.
+SIDEBAR = {'tagcloud': ('tagcloud', {}),
+           'toptags': ('tagcloud_top', {'limit': 10}),
+           'authors': ('authors', {}),
+           'activemonths': ('activemonths', {})}
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+"""Rendered creole markup and listing rows for articles and comments.
+
+Articles are keyed on their ID and lastchange, so an edit produces new keys
+and stale renderings simply age out of the LRU. Comments cannot be edited and
+are keyed on their ID alone.
+"""
+
+# Third-party modules
+from creole import creole2html
+
+# Application components
+from . import cache
+from . import timing
+
+# creole2html, counted as creole time in sampled request timings.
+Creole = timing.Timed('creole', creole2html)
+
+
+def indexText(blogpost):
+  """Cuts down a string to a maximum of 50 words.
+
+  to be used in the admin index
+  """
+  blogpost = blogpost.split()
+  blogpost = blogpost[:50]
+
+  if len(blogpost) >= 50:
+    output = " ".join(blogpost) + " ..."
+  else:
+    output = " ".join(blogpost)
+
+  return output
+
+
+def _ArticleKey(article, kind):
+  return 'article', int(article['ID']), str(article['lastchange']), kind
+
+
+def ArticleHtml(article):
+  """Returns the full article content rendered to html."""
+  return cache.RENDERED.Get(_ArticleKey(article, 'body'),
+                            lambda: Creole(article['content']))
+
+
+def Excerpt(content):
+  """Returns the first 50 words of rendered article content, for storing."""
+  return indexText(Creole(content))
+
+
+def TitleHtml(title):
+  """Returns the article title rendered to html, for storing."""
+  return Creole(title)
+
+
+def ArticleTitle(article):
+  """Returns the rendered title of the article.
+
+  Rows carry the title html stored with the article. An article without one
+  has it rendered from its title.
+  """
+  if article.get('titlehtml') is not None:
+    return article['titlehtml']
+  return cache.RENDERED.Get(_ArticleKey(article, 'title'),
+                            lambda: TitleHtml(article['title']))
+
+
+def ArticleExcerpt(article):
+  """Returns the first 50 words of the rendered article, for listings.
+
+  Listing rows carry the excerpt stored with the article and no content. An
+  article without a stored excerpt has it rendered from its content, or gets
+  none if its row has no content either.
+  """
+  if article.get('excerpt') is not None:
+    return article['excerpt']
+  if 'content' not in article:
+    return ''
+  return cache.RENDERED.Get(_ArticleKey(article, 'excerpt'),
+                            lambda: indexText(ArticleHtml(article)))
+
+
+def CommentHtml(comment):
+  """Returns the comment content rendered to html."""
+  return cache.RENDERED.Get(('comment', int(comment['ID'])),
+                            lambda: Creole(comment['content']))
+
+
+def AddExcerpts(articles):
+  """Sets the 'excerpt' and 'titlehtml' keys on each of the given articles."""
+  for article in articles:
+    article['excerpt'] = ArticleExcerpt(article)
+    article['titlehtml'] = ArticleTitle(article)
+  return articles
+
+
+def AddCommentHtml(comments):
+  """Sets the 'html' key on each of the given comments."""
+  for comment in comments:
+    comment['html'] = CommentHtml(comment)
+  return comments
+
+
+def ArticleRows(parser, articles):
+  """Returns the blogpost.html rows for a listing of articles.
+
+  Rows come from the fragment cache, keyed on what they show: the article's
+  ID, lastchange, comment count and author.
+  """
+  return ''.join(parser.ParseFragment(
+      'blogpost.html', (int(article['ID']), str(article['lastchange']),
+                        int(article['comments']), article['author']),
+      article=article) for article in articles)
+
+
+def CommentRows(parser, comments):
+  """Returns the comment.html rows for the comments on an article.
+
+  Comments cannot be edited, so rows are keyed on the comment's ID and its
+  author as shown.
+  """
+  return ''.join(parser.ParseFragment(
+      'comment.html', (int(comment['ID']), comment['user']['author'],
+                       comment['user']['admin']),
+      comment=comment) for comment in comments)
+
+
+def Warm(article):
+  """Renders a freshly written article so readers never parse its markup."""
+  ArticleHtml(article)
+  ArticleExcerpt(article)
+  ArticleTitle(article)
@@ -8,12 +8,32 @@ CREATE TABLE IF NOT EXISTS `article` (
   `date` datetime NOT NULL,
   `lastchange` datetime NOT NULL,
   `content` text COLLATE utf8_unicode_ci NOT NULL,
+  `excerpt` text COLLATE utf8_unicode_ci DEFAULT NULL,
   `title` varchar(255) COLLATE utf8_unicode_ci NOT NULL,
+  `titlehtml` text COLLATE utf8_unicode_ci DEFAULT NULL,
   `public` enum('true','false') COLLATE utf8_unicode_ci NOT NULL DEFAULT 'false',
   `commentable` enum('true','false') COLLATE utf8_unicode_ci NOT NULL DEFAULT 'false',
+  `comment_count` mediumint(8) unsigned NOT NULL DEFAULT 0,
+  `lastcomment` datetime DEFAULT NULL,
   PRIMARY KEY (`ID`),
   KEY `author` (`user`),
-  KEY `public` (`public`,`commentable`)
+  KEY `public` (`public`,`commentable`),
+  KEY `public_date` (`public`,`date`,`ID`),
+  FULLTEXT KEY `search_title` (`title`),
+  FULLTEXT KEY `search` (`title`,`content`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `articlemonths`
+--
+
+CREATE TABLE IF NOT EXISTS `articlemonths` (
+  `year` smallint(5) unsigned NOT NULL,
+  `month` tinyint(3) unsigned NOT NULL,
+  `count` mediumint(8) unsigned NOT NULL DEFAULT 0,
+  PRIMARY KEY (`year`,`month`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
 
 -- --------------------------------------------------------
@@ -25,7 +45,21 @@ CREATE TABLE IF NOT EXISTS `article` (
 CREATE TABLE IF NOT EXISTS `articletags` (
    `articleid` mediumint(8) unsigned NOT NULL,
    `tagid` smallint(5) unsigned NOT NULL,
-   PRIMARY KEY (`articleid`,`tagid`)
+   PRIMARY KEY (`articleid`,`tagid`),
+   KEY `tagid` (`tagid`,`articleid`)
+ ) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
+
+-- --------------------------------------------------------
+
+--
+-- Table structure for table `tagcounts`
+--
+
+CREATE TABLE IF NOT EXISTS `tagcounts` (
+   `tagid` smallint(5) unsigned NOT NULL,
+   `count` int(11) NOT NULL DEFAULT 0,
+   PRIMARY KEY (`tagid`),
+   KEY `count` (`count`,`tagid`)
  ) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
 
 -- --------------------------------------------------------
@@ -59,7 +93,8 @@ CREATE TABLE IF NOT EXISTS `comment` (
    `date` datetime NOT NULL,
    `content` text COLLATE utf8_unicode_ci NOT NULL,
    PRIMARY KEY (`ID`),
-   KEY `article` (`article`,`user`)
+   KEY `article` (`article`,`user`),
+   FULLTEXT KEY `search` (`content`)
  ) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
 
 
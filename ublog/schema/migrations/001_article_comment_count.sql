@@ -0,0 +1,17 @@
+--
+-- Keeps the number of comments and the date of the newest comment on the
+-- article itself, so listings no longer join and group the comment table.
+--
+
+ALTER TABLE `article`
+  ADD COLUMN `comment_count` mediumint(8) unsigned NOT NULL DEFAULT 0,
+  ADD COLUMN `lastcomment` datetime DEFAULT NULL;
+
+UPDATE `article`
+SET
+  `comment_count` = (SELECT count(*)
+                     FROM `comment`
+                     WHERE `comment`.`article` = `article`.`ID`),
+  `lastcomment` = (SELECT max(`comment`.`date`)
+                   FROM `comment`
+                   WHERE `comment`.`article` = `article`.`ID`);
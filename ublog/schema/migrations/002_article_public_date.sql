@@ -0,0 +1,20 @@
+--
+-- Lets the month and year archives run as index range scans and keeps a
+-- histogram of public articles per month for the months menu.
+--
+
+ALTER TABLE `article`
+  ADD KEY `public_date` (`public`,`date`,`ID`);
+
+CREATE TABLE IF NOT EXISTS `articlemonths` (
+  `year` smallint(5) unsigned NOT NULL,
+  `month` tinyint(3) unsigned NOT NULL,
+  `count` mediumint(8) unsigned NOT NULL DEFAULT 0,
+  PRIMARY KEY (`year`,`month`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
+
+INSERT INTO `articlemonths` (`year`, `month`, `count`)
+SELECT year(`date`), month(`date`), count(*)
+FROM `article`
+WHERE `public` = 'true'
+GROUP BY year(`date`), month(`date`);
@@ -0,0 +1,21 @@
+--
+-- Keeps the number of public articles per tag, ordered by the count index,
+-- so the tag cloud no longer groups and sorts on every request.
+--
+
+ALTER TABLE `articletags`
+  ADD KEY `tagid` (`tagid`,`articleid`);
+
+CREATE TABLE IF NOT EXISTS `tagcounts` (
+   `tagid` smallint(5) unsigned NOT NULL,
+   `count` int(11) NOT NULL DEFAULT 0,
+   PRIMARY KEY (`tagid`),
+   KEY `count` (`count`,`tagid`)
+ ) ENGINE=InnoDB DEFAULT CHARSET=utf8 COLLATE=utf8_unicode_ci;
+
+INSERT INTO `tagcounts` (`tagid`, `count`)
+SELECT `articletags`.`tagid`, count(*)
+FROM `articletags`
+  JOIN `article` ON (`article`.`ID` = `articletags`.`articleid`)
+WHERE `article`.`public` = 'true'
+GROUP BY `articletags`.`tagid`;
@@ -0,0 +1,12 @@
+--
+-- FULLTEXT indexes for /search. InnoDB keeps them up to date on every insert
+-- and update, so articles and comments are searchable as soon as they are
+-- written.
+--
+
+ALTER TABLE `article`
+  ADD FULLTEXT KEY `search_title` (`title`),
+  ADD FULLTEXT KEY `search` (`title`,`content`);
+
+ALTER TABLE `comment`
+  ADD FULLTEXT KEY `search` (`content`);
@@ -0,0 +1,12 @@
+--
+-- Stores the rendered excerpt shown in listings on the article itself, so
+-- listings no longer read and render the full content of every article.
+-- Listings store the excerpt of an existing article the first time they
+-- show it. To fill in all of them at once after applying this, run:
+--
+--   python manage.py rebuild-excerpts
+--
+
+ALTER TABLE `article`
+  ADD COLUMN `excerpt` text COLLATE utf8_unicode_ci DEFAULT NULL
+    AFTER `content`;
@@ -0,0 +1,12 @@
+--
+-- Stores the rendered title on the article, next to the excerpt, so listings
+-- and article pages no longer render the creole markup of every title.
+-- Listings store the title html of an existing article the first time they
+-- show it. To fill in all of them at once after applying this, run:
+--
+--   python manage.py rebuild-excerpts
+--
+
+ALTER TABLE `article`
+  ADD COLUMN `titlehtml` text COLLATE utf8_unicode_ci DEFAULT NULL
+    AFTER `title`;
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+"""A template parser that compiles all templates once, at startup.
+
+The uWeb3 parser loads a template the first time it is used, and checks the
+modification time of its file on every parse, including for each partial it
+inlines, once per row in a loop. Parser compiles every template in the
+template directory up front; partials are inlined as the compiled template
+objects. In strict mode templates are compiled from their text alone, so no
+file is looked at after startup, and template changes need a restart.
+
+Templates whose output depends on a few values only, such as the footer,
+are rendered once per distinct set of those values with ParseStatic. Rows of
+listings are kept in the fragment cache by ParseFragment.
+"""
+
+# Standard modules
+import hashlib
+import os
+import threading
+
+# Third-party modules
+from uweb3 import templateparser
+
+# Application components
+from . import cache
+
+STATIC_SIZE = 64
+
+
+class Parser(templateparser.Parser):
+  """A templateparser.Parser that is filled completely when it is created.
+
+  Arguments:
+    path: str, the template directory.
+    strict: bool, compile templates without a modification time check.
+  """
+
+  def __init__(self, path, strict=False):
+    self.path = path
+    self.strict = strict
+    self._static = {}
+    self._digests = {}
+    self._lock = threading.Lock()
+    super(Parser, self).__init__(path)
+
+  def AddTemplate(self, location, name=None):
+    """Compiles the template at location, relative to the template directory.
+
+    In strict mode the template is compiled from its text, so it does not
+    reload when its file changes.
+    """
+    if not self.strict:
+      return super(Parser, self).AddTemplate(location, name=name)
+    filename = os.path.join(self.path, location)
+    try:
+      with open(filename, encoding='utf-8') as template:
+        raw = template.read()
+    except IOError:
+      raise templateparser.TemplateReadError(
+          'Could not load template %r' % filename)
+    self[name or location] = templateparser.Template(raw, parser=self)
+    self._digests[name or location] = hashlib.sha1(
+        raw.encode('utf-8')).hexdigest()
+
+  def Compile(self):
+    """Compiles every template in the template directory.
+
+    Returns:
+      int, the number of templates compiled.
+    """
+    for directory, _dirs, files in os.walk(self.path):
+      for filename in files:
+        if filename.endswith('.html'):
+          self[os.path.relpath(os.path.join(directory, filename), self.path
+                              ).replace(os.sep, '/')]
+    return len(self)
+
+  def ParseStatic(self, template, key, **replacements):
+    """Parses a template whose output only depends on key.
+
+    In strict mode the output is kept per key, so the template is parsed once
+    for every distinct key, up to STATIC_SIZE keys in all.
+    """
+    if not self.strict:
+      return self.Parse(template, **replacements)
+    cachekey = template, key
+    try:
+      return self._static[cachekey]
+    except KeyError:
+      output = self.Parse(template, **replacements)
+      with self._lock:
+        if len(self._static) >= STATIC_SIZE:
+          self._static.clear()
+        self._static[cachekey] = output
+      return output
+
+  def ParseFragment(self, template, key, **replacements):
+    """Parses a template for one row of a page, through the fragment cache.
+
+    The key identifies what the row shows, such as an article's ID and
+    lastchange. The version of the template is added to it: its digest in
+    strict mode, the modification time of its file otherwise.
+    """
+    if self.strict:
+      version = self._digests.get(template)
+    else:
+      version = os.path.getmtime(os.path.join(self.path, template))
+    return cache.FRAGMENTS.Get((template, version, key), lambda: str(
+        self.Parse(template, **replacements)))
+
+
+_parsers = {}
+_lock = threading.Lock()
+
+
+def Configure(options, path):
+  """Returns the compiled parser for the template directory path.
+
+  The parser is created and compiled on the first call, later calls return
+  the same parser.
+
+  Recognised options of the [templates] section:
+    strict: 'True' to skip the modification time checks, for production.
+        Default 'False'.
+  """
+  strict = dict(options or {}).get('strict', 'False') == 'True'
+  with _lock:
+    if (path, strict) not in _parsers:
+      parser = Parser(path, strict=strict)
+      parser.Compile()
+      _parsers[path, strict] = parser
+    return _parsers[path, strict]
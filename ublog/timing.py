@@ -0,0 +1,193 @@
+#!/usr/bin/python
+"""Per-request timings of the phases a page spends its time in.
+
+A sampled request gets a RequestTimer, which the code running for it reports
+to through Phase and Timed. Phases are timed exclusively: time spent in a
+nested phase, such as creole markup rendered from within a template, counts
+towards the inner phase only. Requests that are not sampled pay for a single
+thread-local lookup per phase.
+
+Every request, sampled or not, counts the statements it sends to the database
+and the time they take, through a QueryCounter.
+"""
+
+# Standard modules
+import contextlib
+import contextvars
+import functools
+import random
+import threading
+import time
+
+PHASES = 'db', 'template', 'creole', 'cookie'
+
+SAMPLE_RATE = 0.0
+
+_local = threading.local()
+
+# The QueryCounter of the running request. Query batches run their queries in
+# a copy of the request's context, so those count towards the request too.
+_counter = contextvars.ContextVar('querycounter', default=None)
+
+
+class RequestTimer(object):
+  """Accumulates the exclusive time spent in each phase of one request."""
+
+  def __init__(self):
+    self.start = time.perf_counter()
+    self.phases = dict((phase, 0.0) for phase in PHASES)
+    self._stack = []
+
+  def Enter(self, phase):
+    now = time.perf_counter()
+    if self._stack:
+      outer, since = self._stack[-1]
+      self.phases[outer] += now - since
+    self._stack.append((phase, now))
+
+  def Exit(self):
+    now = time.perf_counter()
+    phase, since = self._stack.pop()
+    self.phases[phase] = self.phases.get(phase, 0.0) + now - since
+    if self._stack:
+      self._stack[-1] = self._stack[-1][0], now
+
+  def Total(self):
+    """Returns the seconds since the request started."""
+    return time.perf_counter() - self.start
+
+  def ServerTiming(self):
+    """Returns the timings as the value of a Server-Timing header."""
+    timings = ['%s;dur=%.1f' % (phase, seconds * 1000)
+               for phase, seconds in self.phases.items()]
+    timings.append('total;dur=%.1f' % (self.Total() * 1000))
+    return ', '.join(timings)
+
+  def Milliseconds(self):
+    """Returns the phase timings and the total in milliseconds."""
+    timings = dict((phase, round(seconds * 1000, 1))
+                   for phase, seconds in self.phases.items())
+    timings['total'] = round(self.Total() * 1000, 1)
+    return timings
+
+
+class QueryCounter(object):
+  """Counts the statements of one request and the seconds they took.
+
+  Queries that a batch runs in parallel are summed, so the seconds can exceed
+  the time the request spent waiting for them.
+  """
+
+  def __init__(self):
+    self.count = 0
+    self.seconds = 0.0
+    self._lock = threading.Lock()
+
+  def Add(self, seconds):
+    with self._lock:
+      self.count += 1
+      self.seconds += seconds
+
+
+def Configure(options):
+  """Reads the [timing] section.
+
+  Recognised options:
+    sample_rate: the fraction of requests that are timed, from 0 (default)
+        to 1. A small rate is cheap enough to leave on in production.
+  """
+  global SAMPLE_RATE
+  SAMPLE_RATE = float(dict(options or {}).get('sample_rate', 0))
+
+
+def Start():
+  """Starts timing the request of the running thread, if it is sampled.
+
+  Returns:
+    RequestTimer for a sampled request, None otherwise.
+  """
+  timer = None
+  if SAMPLE_RATE and random.random() < SAMPLE_RATE:
+    timer = RequestTimer()
+  _local.timer = timer
+  return timer
+
+
+def StartCounting():
+  """Starts counting the statements of the running request.
+
+  Returns:
+    QueryCounter, which the statements of the request are added to.
+  """
+  counter = QueryCounter()
+  _counter.set(counter)
+  return counter
+
+
+def CountQuery(seconds):
+  """Adds a statement to the counter of the running request, if any."""
+  counter = _counter.get()
+  if counter is not None:
+    counter.Add(seconds)
+
+
+def Stop():
+  """Ends timing and counting the request of the running thread."""
+  _local.timer = None
+  _counter.set(None)
+
+
+def Current():
+  """Returns the timer of the running request, None if it is not sampled."""
+  return getattr(_local, 'timer', None)
+
+
+@contextlib.contextmanager
+def Phase(phase):
+  """Counts the time spent in the with-block towards the given phase."""
+  timer = Current()
+  if timer is None:
+    yield
+    return
+  timer.Enter(phase)
+  try:
+    yield
+  finally:
+    timer.Exit()
+
+
+def Timed(phase, function):
+  """Returns function wrapped so that its calls count towards phase."""
+  @functools.wraps(function)
+  def wrapper(*args, **kwargs):
+    timer = Current()
+    if timer is None:
+      return function(*args, **kwargs)
+    timer.Enter(phase)
+    try:
+      return function(*args, **kwargs)
+    finally:
+      timer.Exit()
+  return wrapper
+
+
+class TimedParser(object):
+  """Wraps a template parser so that parsing counts as template time."""
+
+  def __init__(self, parser):
+    self._parser = parser
+
+  def Parse(self, *args, **kwargs):
+    with Phase('template'):
+      return self._parser.Parse(*args, **kwargs)
+
+  def ParseStatic(self, *args, **kwargs):
+    with Phase('template'):
+      return self._parser.ParseStatic(*args, **kwargs)
+
+  def ParseFragment(self, *args, **kwargs):
+    with Phase('template'):
+      return self._parser.ParseFragment(*args, **kwargs)
+
+  def __getattr__(self, name):
+    return getattr(self._parser, name)